@@ -85,20 +85,95 @@ warnings.simplefilter('ignore', category=UserWarning)
 # This cell is responsible for importing the raw data from the specified source into the notebook environment. The data could come from various sources, such as a file or table in your lakehouse.
 # 
 # Once loaded, this data will serve as the input for subsequent steps, such as data transformation, model training, and evaluation.
+# 
+# A stable split bucket derived from `route_id` is computed in Spark, so the train/validation/test split is the same on every retrain.
+# The whole table is transferred with Arrow, in chunks of Spark partitions, with columns downcast in Spark (float32, int16) so each chunk crosses the wire already compact.
+# The memory needed is estimated first: if it exceeds `driver_memory_fraction` of the free driver memory, the data is reduced by stratified sampling over `hour_of_day` × `congestion_score` bucket instead of a blind `limit`, so rare traffic conditions stay represented.
 
 # CELL ********************
 
 import re
 import pandas as pd
 import numpy as np
+from pyspark import StorageLevel
+from pyspark.sql import functions as F
+from pyspark.sql.types import DoubleType, FloatType, IntegerType, LongType, ShortType, BooleanType
+
+driver_memory_fraction = 0.4  # share of free driver memory the training frame may take
+chunk_partitions = 8           # Spark partitions transferred per Arrow chunk
+min_rows_per_stratum = 50      # rows always kept per stratum when sampling
+INT16_COLS = {"hour_of_day", "dow", "telemetry_points"}
+
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+spark.conf.set("spark.sql.execution.arrow.pyspark.fallback.enabled", "false")
 
-df = spark.read.format("delta").load(
+raw = spark.read.format("delta").load(
     "Tables/dbo/ml_siren_advantage_regression"
-).cache()
-# Transform to pandas according to the selected models
-X = df.limit(100000).toPandas() # Use df.toPandas() to use all the data
+)
+
+# --- Downcast in Spark, drop the key (not a feature) ---
+# the key is replaced by a stable split bucket (0..99): a route keeps its train/val/test side across retrains
+casts = [F.pmod(F.xxhash64("route_id"), F.lit(100)).cast(ShortType()).alias("_split_bucket")]
+for field in raw.schema.fields:
+    if field.name == "route_id":
+        continue
+    if isinstance(field.dataType, DoubleType):
+        casts.append(F.col(field.name).cast(FloatType()).alias(field.name))
+    elif isinstance(field.dataType, (IntegerType, LongType)) and field.name in INT16_COLS:
+        casts.append(F.col(field.name).cast(ShortType()).alias(field.name))
+    else:
+        casts.append(F.col(field.name))
+base = raw.select(*casts).cache()
+df = base
+
+# --- Memory estimate before loading ---
+BYTES = {FloatType: 4, ShortType: 2, BooleanType: 1, IntegerType: 4, LongType: 8, DoubleType: 8}
+row_bytes = sum(BYTES.get(type(f.dataType), 16) + 1 for f in df.schema.fields)  # +1 for the null mask
+n_rows = df.count()
+estimated_bytes = n_rows * row_bytes * 2  # x2: concat of chunks briefly holds two copies
+
+try:
+    import psutil
+    free_bytes = psutil.virtual_memory().available
+except ImportError:
+    mem = spark.conf.get("spark.driver.memory", "8g").lower()
+    free_bytes = int(float(mem[:-1]) * {"k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}.get(mem[-1], 1))
+budget_bytes = int(free_bytes * driver_memory_fraction)
+
+print(f"rows={n_rows:,} | estimate={estimated_bytes / 2**20:,.1f} MiB | budget={budget_bytes / 2**20:,.1f} MiB")
+
+# --- Stratified sampling when the full table does not fit ---
+if estimated_bytes > budget_bytes:
+    frac = budget_bytes / estimated_bytes
+    df = df.withColumn(
+        "_stratum",
+        F.concat_ws("_", F.col("hour_of_day").cast("string"), F.round(F.col("congestion_score"), 1).cast("string")),
+    )
+    counts = {r["_stratum"]: r["count"] for r in df.groupBy("_stratum").count().collect()}
+    # proportional share, but never fewer than min_rows_per_stratum rows from a stratum
+    fractions = {k: min(1.0, max(frac, min_rows_per_stratum / c)) for k, c in counts.items()}
+    df = df.sampleBy("_stratum", fractions=fractions, seed=41).drop("_stratum")
+    print(f"Stratified sampling over {len(counts)} strata, base fraction={frac:.3f}")
+
+# --- Arrow transfer, chunk by chunk ---
+# the (sampled) frame is persisted once: every chunk filters its cached partitions instead of
+# re-running the sampling plan, and _pid stays the same across chunks
+df = df.withColumn("_pid", F.spark_partition_id()).persist(StorageLevel.MEMORY_AND_DISK)
+df.count()
+base.unpersist()
+n_parts = df.rdd.getNumPartitions()
+chunks = []
+for lo in range(0, n_parts, chunk_partitions):
+    chunk = df.filter((F.col("_pid") >= lo) & (F.col("_pid") < lo + chunk_partitions)).drop("_pid").toPandas()
+    if len(chunk):
+        chunks.append(chunk)
+X = pd.concat(chunks, ignore_index=True) if chunks else df.drop("_pid").limit(0).toPandas()
+del chunks
+df.unpersist()
 X = X.rename(columns = lambda c:re.sub('[^A-Za-z0-9_]+', '_', c))  # Replace not supported characters in column name with underscore to avoid invalid character for model training and saving
 
+print(f"Loaded {len(X):,} rows, {X.memory_usage(deep=True).sum() / 2**20:,.1f} MiB in memory")
+
 target_col = re.sub('[^A-Za-z0-9_]+', '_', "siren_advantage_real")
 
 
@@ -131,90 +206,60 @@ display(X)
 # CELL ********************
 
 # Set Functions if needed for Featurization
-def create_fillna_processor(
-    df, mean_features=None, median_features=None, mode_features=None
-):
-    """
-    Create a ColumnTransformer that fills missing values in a DataFrame using different strategies
-    based on the skewness of the numerical features and the specified feature lists.
+import pandas.api.types as ptypes
 
-    Parameters:
-    df (pd.DataFrame): The input DataFrame.
-    mean_features (list, optional): List of features to impute using the mean strategy. Defaults to None.
-    median_features (list, optional): List of features to impute using the median strategy. Defaults to None.
-    mode_features (list, optional): List of features to impute using the mode strategy. Defaults to None.
-
-    Returns:
-    ColumnTransformer: A fitted ColumnTransformer that can be used to transform the DataFrame.
-    list: List of all features supported by SimpleImputer in the DataFrame.
-    list: List of datetime features in the DataFrame.
-    """
-    if mean_features is None:
-        mean_features = []
-    if median_features is None:
-        median_features = []
-    if mode_features is None:
-        mode_features = []
-    all_features = mean_features + median_features + mode_features
-    # Group features by their imputation needs
-    mean_features = [
-        col
-        for col in df.select_dtypes(include=["number"]).columns
-        if df[col].skew(skipna=True) <= 1 and col not in all_features
-    ] + mean_features
-    median_features = [
-        col
-        for col in df.select_dtypes(include=["number"]).columns
-        if df[col].skew(skipna=True) > 1 and col not in all_features
-    ] + median_features
-    all_features = mean_features + median_features
-    datetime_features = df.select_dtypes(include=["datetime"]).columns.tolist()
-    mode_features = [col for col in df.columns.tolist() if col not in all_features + datetime_features]
-
-    transformers = []
-
-    if mean_features:
-        transformers.append(
-            ("mean_imputer", SimpleImputer(strategy="mean"), mean_features)
-        )
-    if median_features:
-        transformers.append(
-            ("median_imputer", SimpleImputer(strategy="median"), median_features)
-        )
-    if mode_features:
-        transformers.append(
-            ("mode_imputer", SimpleImputer(strategy="most_frequent"), mode_features)
-        )
-
-    column_transformer = ColumnTransformer(transformers=transformers)
-    all_features = mean_features + median_features + mode_features
-
-    return column_transformer.fit(df), all_features, datetime_features
-
-
-def fillna(df, processor, all_features, datetime_features):
+
+class FittedFillNa:
     """
-    Fill missing values in a DataFrame using a specified processor and mode imputation.
+    Fill missing values with imputation values fitted once on the training data.
 
-    Parameters:
-    df (pd.DataFrame): The input DataFrame with missing values.
-    processor (object): An object with a `transform` method that processes the DataFrame.
-    all_features (list): List of all features supported by SimpleImputer in the DataFrame.
-    datetime_features (list): List of datetime features in the DataFrame.
+    Strategies follow the wizard defaults:
+    - numerical features: mean if skewness <= 1, median otherwise
+    - other features: most frequent value
+    - datetime features: forward fill
+    The fitted values are stored in `fill_values_`, so transform() is a single vectorized
+    DataFrame.fillna and the object can be pickled inside the MLflow model.
 
-    Returns:
-    pd.DataFrame: A DataFrame with missing values filled.
+    Parameters:
+    mean_features (list, optional): Features forced to the mean strategy.
+    median_features (list, optional): Features forced to the median strategy.
+    mode_features (list, optional): Features forced to the mode strategy.
     """
-    filled_array = processor.transform(df)
-    filled_df = pd.DataFrame(filled_array, columns=all_features)
-    if datetime_features:
-        datetime_data = df[datetime_features]
-        datetime_data.ffill()
-        filled_df = pd.concat([datetime_data, filled_df], axis=1)
-    for col in df.columns:
-        filled_df[col].fillna(filled_df[col].mode()[0], inplace=True)
 
-    return filled_df
+    def __init__(self, mean_features=None, median_features=None, mode_features=None):
+        self.mean_features = list(mean_features or [])
+        self.median_features = list(median_features or [])
+        self.mode_features = list(mode_features or [])
+
+    def fit(self, df):
+        forced = set(self.mean_features + self.median_features + self.mode_features)
+        numeric = [c for c in df.select_dtypes(include=["number"]).columns if c not in forced]
+        skew = df[numeric].skew(skipna=True)
+
+        mean_cols = [c for c in numeric if skew[c] <= 1] + self.mean_features
+        median_cols = [c for c in numeric if not skew[c] <= 1] + self.median_features
+        self.datetime_features_ = df.select_dtypes(include=["datetime"]).columns.tolist()
+        mode_cols = [c for c in df.columns if c not in set(mean_cols + median_cols + self.datetime_features_)]
+
+        fill = {}
+        fill.update(df[mean_cols].mean().to_dict())
+        fill.update(df[median_cols].median().to_dict())
+        if mode_cols:
+            fill.update(df[mode_cols].mode(dropna=True).iloc[0].to_dict())
+        # keep integer columns integer
+        for col, value in fill.items():
+            if ptypes.is_integer_dtype(df[col]) and pd.notna(value):
+                fill[col] = int(round(value))
+
+        self.fill_values_ = {c: v for c, v in fill.items() if pd.notna(v)}
+        self.columns_ = df.columns.tolist()
+        return self
+
+    def transform(self, df):
+        out = df.fillna(value=self.fill_values_)
+        if self.datetime_features_:
+            out[self.datetime_features_] = out[self.datetime_features_].ffill()
+        return out
 
 
 # METADATA ********************
@@ -226,32 +271,35 @@ def fillna(df, processor, all_features, datetime_features):
 
 # CELL ********************
 
-from sklearn.pipeline import Pipeline
-from sklearn.impute import SimpleImputer
-from sklearn.compose import ColumnTransformer
-
-
-# convert object type to nearest dtype
-X = X.convert_dtypes()
+# convert remaining object columns to the nearest numpy dtype (the loader already returns float32/int16/bool)
+X = X.infer_objects()
 X = X.dropna(axis=1, how='all')
 
-# select columns for model training
+# select columns for model training; bool columns (is_weekend) stay out of the signature, the live
+# feature rows of hero_route_decision / hero_dispatch_consumer do not carry them
 X = X.select_dtypes(include=['number', 'datetime', 'category'])
 
-from sklearn.model_selection import train_test_split
+# Stored split: buckets 0-19 test, 20-34 validation, 35-99 train (stable per route_id across retrains)
+TEST_BUCKETS, VAL_BUCKETS = 20, 15
+split_bucket = X.pop("_split_bucket")
+X_test = X[split_bucket < TEST_BUCKETS].copy()
+X_val = X[(split_bucket >= TEST_BUCKETS) & (split_bucket < TEST_BUCKETS + VAL_BUCKETS)].copy()
+X_train = X[split_bucket >= TEST_BUCKETS + VAL_BUCKETS].copy()
 
-# You may need to update the test_size based on your scenario
-X_train, X_test = train_test_split(X, test_size=0.2, random_state=41)
-
-mean_features, median_features, mode_features = [], [], []
- 
-preprocessor, all_features, datetime_features = create_fillna_processor(X_train, mean_features, median_features, mode_features)
-X_train = fillna(X_train, preprocessor, all_features, datetime_features)
-X_test = fillna(X_test, preprocessor, all_features, datetime_features)
- 
 y_train = X_train.pop(target_col)
+y_val = X_val.pop(target_col)
 y_test = X_test.pop(target_col)
 
+mean_features, median_features, mode_features = [], [], []
+
+# raw feature frames, used for the model signature: serving receives un-imputed features
+X_train_raw = X_train
+
+preprocessor = FittedFillNa(mean_features, median_features, mode_features).fit(X_train)
+X_train = preprocessor.transform(X_train)
+X_val = preprocessor.transform(X_val)
+X_test = preprocessor.transform(X_test)
+
 display(X_train[:10])
 
 
@@ -296,29 +344,56 @@ mlflow.set_experiment("ml_siren_advantage-AutoMLExperiment")
 # #### Configure the AutoML trial and settings
 # 
 # These configurations are driven by the AutoML mode and task selected in the wizard. For example, if you select "quick prototype", you'll see a setting for time budget.
+# 
+# To explore more configurations in the same budget:
+# - trials run concurrently, one per available core (Spark backend)
+# - trials are scored on the stored validation split (holdout) instead of 3-fold CV, and there is no `max_iter` cap
+# - the search is warm-started from the best configuration per estimator of the latest registered model
 
 # CELL ********************
 
 # Import the AutoML class from the FLAML package
+import os
 import flaml
 from flaml import AutoML
+from mlflow.tracking import MlflowClient
+
+MODEL_NAME = "ml_siren_advantage-AutoMLModel"
+BEST_CONFIG_ARTIFACT = "flaml/best_config_per_estimator.json"
+
+# one trial per core: executor cores when Spark has them, driver cores otherwise
+n_cores = int(spark.sparkContext.defaultParallelism or os.cpu_count() or 1)
+n_concurrent_trials = max(1, n_cores)
+
+# Warm start from the previously registered model, if any
+starting_points = None
+try:
+    versions = MlflowClient().search_model_versions(f"name='{MODEL_NAME}'")
+    if versions:
+        latest = max(versions, key=lambda v: int(v.version))
+        starting_points = mlflow.artifacts.load_dict(f"runs:/{latest.run_id}/{BEST_CONFIG_ARTIFACT}")
+        print(f"Warm start from {MODEL_NAME} v{latest.version}: {sorted(starting_points)}")
+except Exception as e:
+    print(f"No warm start ({e}), searching from scratch")
 
 # Define AutoML settings
 settings = {
     "time_budget": 120, # Total running time in seconds
     "task": "regression",  # Task type 
     "log_file_name": "flaml_experiment.log",  # FLAML log file
-    "eval_method": "cv",
-    "n_splits": 3,
-    "max_iter": 10, 
+    "eval_method": "holdout",  # scored on the stored validation split
     "force_cancel": True, 
     "seed": 41 , # Random seed 
     "mlflow_exp_name": "ml_siren_advantage-AutoMLExperiment",  # MLflow experiment name
     "use_spark": True, # whether to use Spark for distributed training
-    "n_concurrent_trials": 3,  # the maximum number of concurrent trials 
+    "n_concurrent_trials": n_concurrent_trials,  # the maximum number of concurrent trials 
     "verbose": 1,  
     "featurization": "auto", 
 }
+if starting_points:
+    settings["starting_points"] = starting_points
+
+print(f"n_concurrent_trials={n_concurrent_trials}")
 
 if flaml.__version__ > "2.3.3":
     settings["entrypoint"] = "low-code"
@@ -346,8 +421,12 @@ with mlflow.start_run(nested=True, run_name="ml_siren_advantage-AutoMLModel"):
     automl.fit(
         X_train=X_train, 
         y_train=y_train,  # target column of the training data 
+        X_val=X_val,
+        y_val=y_val,
     )
 
+print(f"Trials: {len(automl.config_history)} | best: {automl.best_estimator} | val loss: {automl.best_loss:.4f}")
+
 # METADATA ********************
 
 # META {
@@ -360,13 +439,46 @@ with mlflow.start_run(nested=True, run_name="ml_siren_advantage-AutoMLModel"):
 # ## Step 4: Save the final machine learning model
 # 
 # Upon completing the AutoML trial, you can now save the final, tuned model as an ML model in Fabric.
+# 
+# The fitted `FittedFillNa` preprocessor is bundled with the best estimator in a single MLflow pyfunc model, so the live decision path (`hero_route_decision`) and batch scoring apply the same imputation values in one pass, with no recomputation.
 
 # CELL ********************
 
-model_path = f"runs:/{automl.best_run_id}/model"
+from mlflow.models.signature import infer_signature
+
+
+class SirenAdvantageModel(mlflow.pyfunc.PythonModel):
+    """Fitted preprocessing + FLAML best model, served as one pyfunc model."""
+
+    def __init__(self, preprocessor, automl, feature_cols):
+        self.preprocessor = preprocessor
+        self.automl = automl
+        self.feature_cols = feature_cols
+
+    def predict(self, context, model_input, params=None):
+        X = self.preprocessor.transform(model_input[self.feature_cols])
+        return self.automl.predict(X)
+
+
+feature_cols = X_train.columns.to_list()
+bundle = SirenAdvantageModel(preprocessor, automl, feature_cols)
+signature = infer_signature(X_train_raw.head(100), bundle.predict(None, X_train_raw.head(100)))
+
+with mlflow.start_run(run_name="ml_siren_advantage-AutoMLModel-bundle") as bundle_run:
+    mlflow.log_params({"best_estimator": automl.best_estimator, "source_run_id": automl.best_run_id})
+    # picked up as starting_points by the next retrain
+    mlflow.log_dict({k: v for k, v in automl.best_config_per_estimator.items() if v}, BEST_CONFIG_ARTIFACT)
+    mlflow.pyfunc.log_model(
+        artifact_path="model",
+        python_model=bundle,
+        signature=signature,
+        input_example=X_train_raw.head(5),
+    )
+
+model_path = f"runs:/{bundle_run.info.run_id}/model"
 
 # Register the model to the MLflow registry
-registered_model = mlflow.register_model(model_uri=model_path, name="ml_siren_advantage-AutoMLModel")
+registered_model = mlflow.register_model(model_uri=model_path, name=MODEL_NAME)
 
 # Print the registered model's name and version
 print(f"Model '{registered_model.name}' version {registered_model.version} registered successfully.")
@@ -395,7 +507,6 @@ print(f"Model '{registered_model.name}' version {registered_model.version} regis
 model_name = "ml_siren_advantage-AutoMLModel"
 from synapse.ml.predict import MLFlowTransformer
 
-feature_cols = X_train.columns.to_list()
 model = MLFlowTransformer(
     inputCols=feature_cols,
     outputCol=target_col,
@@ -403,7 +514,7 @@ model = MLFlowTransformer(
     modelVersion=registered_model.version,
 )
 
-df_test = spark.createDataFrame(X_test)
+df_test = spark.createDataFrame(X_test)  # the bundled preprocessor makes raw or imputed input equivalent
 batch_predictions = model.transform(df_test)
 
 
@@ -0,0 +1,247 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "synapse_pyspark"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     }
+# META   }
+# META }
+
+# MARKDOWN ********************
+
+# # Batch backfill scoring
+#
+# Scores historical routes with a registered siren-advantage model version and appends the predictions to `ml_siren_advantage_predictions`, keyed by `route_id` and model version.
+#
+# - **Source**: the training table (`training`) or every decision in `tb_route_analysis_silver` (`route_analysis`); with `route_analysis`, `telemetry_points` is the chosen route's point count (as in training), not the theoretical route's the live decision used
+# - **Incremental**: rows already scored by the same model version are skipped
+# - **Batches**: pending rows are split in `n_batches` stable hash buckets of `route_id`, scored with `MLFlowTransformer` (vectorized), appended one bucket at a time
+# - **Checkpoint**: the last completed bucket is stored in `ml_batch_scoring_checkpoint`, an interrupted run resumes from the next bucket
+#
+# Comparing versions is then a join of the predictions table with itself on `route_id`.
+
+# PARAMETERS CELL ********************
+
+model_name = "ml_siren_advantage-AutoMLModel"
+model_version = "latest"     # registry version number, or "latest"
+source = "training"          # "training" | "route_analysis"
+n_batches = 16
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+import time
+import mlflow
+from mlflow.tracking import MlflowClient
+from pyspark.sql import functions as F
+from synapse.ml.predict import MLFlowTransformer
+
+PREDICTIONS_TABLE = "lakehouse.dbo.ml_siren_advantage_predictions"
+CHECKPOINT_TABLE = "lakehouse.dbo.ml_batch_scoring_checkpoint"
+
+if str(model_version).lower() == "latest":
+    versions = MlflowClient().search_model_versions(f"name='{model_name}'")
+    model_version = max(int(v.version) for v in versions)
+model_version = int(model_version)
+
+# feature list comes from the model signature, so every version is scored with its own inputs
+model_info = mlflow.models.get_model_info(f"models:/{model_name}/{model_version}")
+feature_cols = [c.name for c in model_info.signature.inputs.inputs]
+
+# MLflow schema enforcement does not downcast (double -> float, bigint -> int): the Spark columns are cast
+# to the signature types before scoring
+SPARK_TYPES = {"boolean": "boolean", "integer": "int", "long": "bigint", "float": "float", "double": "double",
+               "string": "string", "datetime": "timestamp"}
+feature_types = {c.name: SPARK_TYPES.get(getattr(c.type, "name", None)) for c in model_info.signature.inputs.inputs}
+
+print(f"Scoring with {model_name} v{model_version} | source={source} | features={feature_cols}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- Tables ---
+spark.sql(f"""
+CREATE TABLE IF NOT EXISTS {PREDICTIONS_TABLE} (
+    route_id STRING,
+    model_name STRING,
+    model_version INT,
+    source STRING,
+    predicted_siren_advantage DOUBLE,
+    scored_at TIMESTAMP
+) USING DELTA
+PARTITIONED BY (model_version)
+""")
+
+spark.sql(f"""
+CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+    model_name STRING,
+    model_version INT,
+    source STRING,
+    last_batch INT,
+    n_batches INT,
+    updated_at TIMESTAMP
+) USING DELTA
+""")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- Source features ---
+if source == "training":
+    src = spark.table("lakehouse.dbo.ml_siren_advantage_regression")
+elif source == "route_analysis":
+    # same features as the live decision path in hero_route_decision, except telemetry_points: the live path
+    # counts the theoretical route's points, but only the chosen route (often Google's) reaches
+    # tb_route_segments and neither route_id links the mission to the other route. This is the chosen
+    # route's count, as ml_data_prep trains on; for Google-chosen missions the score can differ from the live one
+    points = (spark.table("lakehouse.dbo.tb_route_segments_silver")
+        .groupBy("route_id")
+        .agg(F.count("*").alias("telemetry_points")))
+    src = (spark.table("lakehouse.dbo.tb_route_analysis_silver")
+        .join(points, on="route_id", how="left")
+        .withColumn("analysis_ts", F.col("timestamp").cast("timestamp"))
+        .withColumn("hour_of_day", F.hour("analysis_ts"))
+        .withColumn("dow", F.dayofweek("analysis_ts"))
+        .withColumn("is_weekend", F.col("dow").isin(1, 7))
+        .withColumn("avg_speed_kmh", F.lit(50.0))
+    )
+else:
+    raise ValueError(f"Unknown source: {source}")
+
+src = (src
+    .select("route_id", *[F.col(c).cast(feature_types[c]).alias(c) if feature_types[c] else F.col(c)
+                          for c in feature_cols])
+    .dropDuplicates(["route_id"]))
+
+# fail fast on a schema mismatch: score a few rows with the pyfunc model before the batches
+probe = src.limit(5).toPandas()
+if len(probe):
+    probe_pred = mlflow.pyfunc.load_model(f"models:/{model_name}/{model_version}").predict(probe[feature_cols])
+    print(f"Schema check: {len(probe_pred)} rows scored with the model signature types")
+
+# skip rows already scored by this model version (partition pruning on model_version)
+scored = (spark.table(PREDICTIONS_TABLE)
+    .filter((F.col("model_version") == model_version) & (F.col("model_name") == model_name))
+    .select("route_id"))
+pending = (src
+    .join(scored, on="route_id", how="left_anti")
+    .withColumn("_batch", F.pmod(F.xxhash64("route_id"), F.lit(n_batches)).cast("int"))
+    .cache())
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- Resume from checkpoint ---
+ckpt = (spark.table(CHECKPOINT_TABLE)
+    .filter((F.col("model_name") == model_name) & (F.col("model_version") == model_version)
+            & (F.col("source") == source) & (F.col("n_batches") == n_batches))
+    .agg(F.max("last_batch").alias("last_batch"))
+    .first())
+last_batch = ckpt["last_batch"] if ckpt and ckpt["last_batch"] is not None else -1
+# a finished pass restarts from 0: the anti-join leaves only routes added since
+start_batch = 0 if last_batch >= n_batches - 1 else last_batch + 1
+
+scorer = MLFlowTransformer(
+    inputCols=feature_cols,
+    outputCol="predicted_siren_advantage",
+    modelName=model_name,
+    modelVersion=model_version,
+)
+
+
+def save_checkpoint(batch: int):
+    spark.sql(f"""
+    MERGE INTO {CHECKPOINT_TABLE} as t
+    USING (SELECT '{model_name}' AS model_name, {model_version} AS model_version, '{source}' AS source,
+                  {batch} AS last_batch, {n_batches} AS n_batches, current_timestamp() AS updated_at) as s
+    ON s.model_name = t.model_name AND s.model_version = t.model_version AND s.source = t.source
+    WHEN MATCHED THEN UPDATE SET *
+    WHEN NOT MATCHED THEN INSERT *
+    """)
+
+
+total = 0
+for batch in range(start_batch, n_batches):
+    t0 = time.time()
+    rows = pending.filter(F.col("_batch") == batch).drop("_batch")
+    out = (scorer.transform(rows)
+        .select(
+            "route_id",
+            F.lit(model_name).alias("model_name"),
+            F.lit(model_version).alias("model_version"),
+            F.lit(source).alias("source"),
+            F.col("predicted_siren_advantage").cast("double").alias("predicted_siren_advantage"),
+            F.current_timestamp().alias("scored_at")))
+    out.write.mode("append").format("delta").saveAsTable(PREDICTIONS_TABLE)
+    save_checkpoint(batch)
+    n = rows.count()
+    total += n
+    print(f"batch {batch + 1}/{n_batches}: {n} rows in {time.time() - t0:.1f}s")
+
+pending.unpersist()
+print(f"Scored {total} rows with {model_name} v{model_version}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- Version comparison over all scored history ---
+preds = spark.table(PREDICTIONS_TABLE).filter(F.col("model_name") == model_name)
+display(preds
+    .join(spark.table("lakehouse.dbo.ml_siren_advantage_regression").select("route_id", "siren_advantage_real"),
+          on="route_id", how="inner")
+    .groupBy("model_version")
+    .agg(
+        F.count("*").alias("routes"),
+        F.avg(F.abs(F.col("predicted_siren_advantage") - F.col("siren_advantage_real"))).alias("mae"),
+        F.sqrt(F.avg(F.pow(F.col("predicted_siren_advantage") - F.col("siren_advantage_real"), 2))).alias("rmse"))
+    .orderBy("model_version"))
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
@@ -20,10 +20,37 @@
 # META   }
 # META }
 
+# PARAMETERS CELL ********************
+
+# incremental = True  -> aggregate only routes with telemetry processed since the last watermark
+# incremental = False -> full rebuild over the whole telemetry history
+incremental = True
+grace_window_hours = 6        # late-arriving telemetry re-scanned behind the watermark
+completion_idle_minutes = 30  # a route without "arrived" is complete after this much silence
+max_mission_days = 1          # date partitions scanned before the window start, for missions spanning midnight
+telemetry_table = "lakehouse.dbo.tb_vehicles_telemetry_curated"  # date-partitioned copy maintained by ml_table_layout
+# incident "arrived" events of hero_geofence (OneLake shortcut to the Eventhouse table, like the silver telemetry):
+# they end the trip; routes without one fall back to the telemetry "arrived" status and the last fix
+geofence_table = "lakehouse.dbo.tb_geofence_events_silver"
+# include_synthetic = True -> also train on the missions written by hero_trajectory (synthetic_days > 0);
+# their fixes are backdated, so run it with incremental = False once after generating them
+include_synthetic = False
+synthetic_telemetry_table = "lakehouse.dbo.tb_vehicles_telemetry_synthetic"
+synthetic_analysis_table = "lakehouse.dbo.tb_route_analysis_synthetic"
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
 # CELL ********************
 
 from pyspark.sql import functions as F
 from pyspark.sql import Window as W
+from pyspark.sql.types import DoubleType, IntegerType, BooleanType
+from datetime import timedelta
 
 # METADATA ********************
 
@@ -34,26 +61,99 @@ from pyspark.sql import Window as W
 
 # CELL ********************
 
-from pyspark.sql import functions as F
+# --- Watermark ---
+WATERMARK_TABLE = "lakehouse.dbo.ml_data_prep_watermark"
+WATERMARK_NAME = "ml_siren_advantage_regression"
+
+spark.sql(f"""
+CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+    name STRING,
+    watermark TIMESTAMP,
+    updated_at TIMESTAMP
+) USING DELTA
+""")
+
+run_start = spark.sql("SELECT current_timestamp() AS ts").first()["ts"]
+completion_cutoff = run_start - timedelta(minutes=completion_idle_minutes)
+
+last_watermark = None
+if incremental:
+    row = (spark.table(WATERMARK_TABLE)
+        .filter(F.col("name") == WATERMARK_NAME)
+        .agg(F.max("watermark").alias("wm"))
+        .first())
+    last_watermark = row["wm"] if row else None
+
+print(f"incremental={incremental} | last watermark={last_watermark} | completion cutoff={completion_cutoff}")
 
 # --- Load data ---
 dec = spark.table("lakehouse.dbo.tb_route_analysis_silver")
-tel = spark.table("lakehouse.dbo.tb_vehicles_telemetry_silver")
-
-# --- Compute actual ETA from telemetry ---
+tel = spark.table(telemetry_table)
+if "traffic_source" in dec.columns:
+    # forecast rows carry the forecaster's congestion and ETA, not Google's: live decisions only
+    dec = dec.filter(F.col("traffic_source").isNull() | (F.col("traffic_source") == "live"))
+if include_synthetic:
+    # decision and telemetry rows of the same synthetic missions, joined on route_id like the live ones
+    dec = dec.unionByName(spark.table(synthetic_analysis_table), allowMissingColumns=True)
+    syn_tel = spark.table(synthetic_telemetry_table)
+    if "event_date" in tel.columns:
+        syn_tel = syn_tel.withColumn("event_date", F.to_date("timestamp"))
+    tel = tel.unionByName(syn_tel, allowMissingColumns=True)
+
+# --- Restrict to routes touched since the last run (minus grace window) ---
+if last_watermark is not None:
+    window_start = last_watermark - timedelta(hours=grace_window_hours)
+    if "event_date" in tel.columns:
+        # partition pruning: only the days a recent mission can span
+        tel = tel.filter(F.col("event_date") >= F.lit((window_start - timedelta(days=max_mission_days)).date()))
+    touched = (tel
+        .filter(F.col("processed_timestamp") > F.lit(window_start))
+        .select("route_id")
+        .distinct()
+    )
+    tel = tel.join(F.broadcast(touched), on="route_id", how="left_semi")
+
+# --- Compute actual ETA from telemetry (completed routes only) ---
+# Adaptive (dead-reckoning) telemetry skips fixes while the speed holds, so a plain mean over-weights
+# the dense stretches: each fix's speed counts for the seconds until the next one, as the emitter predicts it
+fix_order = W.partitionBy("route_id").orderBy("timestamp", "sequence")
+fix_s = F.col("timestamp").cast("timestamp").cast("double")
+tel = tel.withColumn("hold_s", F.coalesce(F.lead(fix_s).over(fix_order) - fix_s, F.lit(0.0)))
 tel_agg = (tel
     .groupBy("route_id")
     .agg(
         F.min("timestamp").alias("t_start"),
         F.max("timestamp").alias("t_end"),
-        F.avg("speed_kmh").alias("avg_speed_kmh"),
-        F.count("*").alias("telemetry_points")
+        F.coalesce(F.sum(F.col("speed_kmh") * F.col("hold_s")) / F.sum(F.when(F.col("speed_kmh").isNotNull(), F.col("hold_s"))),
+                   F.avg("speed_kmh")).alias("avg_speed_kmh"),  # time-weighted; plain mean if all fixes share one instant
+        (F.max("sequence") + 1).alias("telemetry_points"),  # route points, also with adaptive (dead-reckoning) telemetry
+        F.max("processed_timestamp").alias("last_processed"),
+        F.max(F.when(F.col("status") == "arrived", 1).otherwise(0)).alias("has_arrived")
+    )
+)
+if spark.catalog.tableExists(geofence_table):
+    arrivals = (spark.table(geofence_table)
+        .filter((F.col("event") == "arrived") & (F.col("fence_kind") == "incident"))
+        .groupBy("route_id")
+        .agg(F.min("timestamp").alias("t_arrived"))
+    )
+    tel_agg = (tel_agg
+        .join(arrivals, on="route_id", how="left")
+        .withColumn("t_end", F.coalesce("t_arrived", "t_end"))
+        .withColumn("has_arrived", F.when(F.col("t_arrived").isNotNull(), 1).otherwise(F.col("has_arrived")))
+        .drop("t_arrived")
     )
+tel_agg = (tel_agg
+    .filter((F.col("has_arrived") == 1) | (F.col("last_processed") <= F.lit(completion_cutoff)))
+    .drop("last_processed", "has_arrived")
     .withColumn("actual_eta_min", 
                 (F.unix_timestamp("t_end") - F.unix_timestamp("t_start")) / 60.0)
     .filter(F.col("actual_eta_min") > 0)
 )
 
+if last_watermark is not None:
+    dec = dec.join(tel_agg.select("route_id"), on="route_id", how="left_semi")
+
 # --- Join with route analysis ---
 df = (dec
     .join(tel_agg, on="route_id", how="inner")
@@ -120,7 +220,11 @@ df_train.createOrReplaceTempView("vw_siren_advantage_source")
 # CELL ********************
 
 # --- Save incrementally for AutoML ---
-df_train.createOrReplaceTempView("vw_siren_advantage_source")
+# MERGE source holds only keys not yet in the training table
+existing_keys = spark.table("lakehouse.dbo.ml_siren_advantage_regression").select("route_id")
+df_new = df_train.join(existing_keys, on="route_id", how="left_anti")
+
+df_new.createOrReplaceTempView("vw_siren_advantage_source")
 spark.sql("""
 MERGE INTO lakehouse.dbo.ml_siren_advantage_regression as t
 USING vw_siren_advantage_source as s
@@ -128,6 +232,19 @@ ON s.route_id = t.route_id
 WHEN NOT MATCHED THEN INSERT *
 """)
 
+# --- Advance watermark only after a successful MERGE ---
+# routes still running at the cutoff keep receiving telemetry, so they are picked up again next run
+spark.sql(f"""
+MERGE INTO {WATERMARK_TABLE} as t
+USING (SELECT '{WATERMARK_NAME}' AS name,
+              CAST('{completion_cutoff}' AS TIMESTAMP) AS watermark,
+              CAST('{run_start}' AS TIMESTAMP) AS updated_at) as s
+ON s.name = t.name
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *
+""")
+print(f"Watermark advanced to {completion_cutoff}")
+
 # METADATA ********************
 
 # META {
@@ -0,0 +1,255 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "synapse_pyspark"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     }
+# META   }
+# META }
+
+# MARKDOWN ********************
+
+# # Lakehouse table layout for ML
+#
+# `tb_vehicles_telemetry_silver` is a OneLake shortcut to the Eventhouse table, so its file layout cannot be changed from the lakehouse.
+# This notebook maintains a managed copy laid out for the ML jobs and keeps the training table compact:
+#
+# 1. **Curated telemetry** `tb_vehicles_telemetry_curated`: appended incrementally from the shortcut, partitioned by `event_date`, Z-ordered on `route_id`.
+# 2. **Compaction**: `OPTIMIZE` on the recent partitions only (where streaming ingestion leaves small files), `VACUUM` of old files.
+# 3. **Training table** `ml_siren_advantage_regression`: Z-ordered on `route_id`.
+# 4. **Benchmark** (optional): telemetry aggregation join and training read, shortcut vs curated layout.
+#
+# Runs before `ml_data_prep` in the `execute_ml_data_prep_notebook` pipeline.
+# To reproduce locally with open-source Spark + delta-spark, set `catalog = "default"` and `synthetic_days > 0`.
+
+# PARAMETERS CELL ********************
+
+catalog = "lakehouse.dbo"
+compact_recent_days = 3     # partitions re-compacted on each run
+vacuum_retain_hours = 168
+run_benchmark = False
+synthetic_days = 0          # > 0 generates synthetic source tables (local reproduction only)
+synthetic_routes_per_day = 2000
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+import time
+from datetime import date, timedelta
+from pyspark.sql import functions as F
+
+SOURCE_TELEMETRY = f"{catalog}.tb_vehicles_telemetry_silver"
+SOURCE_ANALYSIS = f"{catalog}.tb_route_analysis_silver"
+CURATED_TELEMETRY = f"{catalog}.tb_vehicles_telemetry_curated"
+TRAINING_TABLE = f"{catalog}.ml_siren_advantage_regression"
+
+# optimized writes bin-pack each append into fewer, larger files
+spark.conf.set("spark.databricks.delta.optimizeWrite.enabled", "true")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- Synthetic sources (local reproduction only) ---
+if synthetic_days > 0:
+    n_routes = synthetic_days * synthetic_routes_per_day
+    start = date.today() - timedelta(days=synthetic_days)
+    routes = (spark.range(n_routes)
+        .withColumn("route_id", F.concat(F.lit("r-"), F.col("id").cast("string")))
+        .withColumn("t0", F.expr(f"timestamp_seconds(unix_timestamp(to_timestamp('{start}')) + CAST(id * 86400 / {synthetic_routes_per_day} AS BIGINT))"))
+        .withColumn("n_points", (F.rand(41) * 150 + 50).cast("int"))
+    )
+    (routes
+        .select(
+            F.col("id").cast("int").alias("mission_id"),
+            "route_id",
+            F.concat(F.lit("AMB-"), (F.col("id") % 50).cast("string")).alias("vehicle_id"),
+            F.col("t0").alias("timestamp"),
+            (F.rand(1) * 15 + 5).alias("eta_google_aware_min"),
+            (F.rand(2) * 12 + 5).alias("eta_theoretical_min"),
+            (F.rand(3) * 12 + 4).alias("eta_hero_min"),
+            (F.rand(4) * 3).alias("time_saved_vs_google_min"),
+            (F.rand(5) * 9000 + 1000).cast("long").alias("distance_m_theoretical"),
+            (F.rand(6) * 9000 + 1000).cast("long").alias("distance_m_google"),
+            F.when(F.rand(7) > 0.5, "hero").otherwise("google").alias("decision"),
+            F.rand(8).alias("congestion_score"),
+            F.lit("MEDIUM").alias("congestion_label"),
+            F.col("t0").alias("processed_timestamp"))
+        .write.mode("overwrite").format("delta").saveAsTable(SOURCE_ANALYSIS))
+    (routes
+        .withColumn("sequence", F.explode(F.sequence(F.lit(0), F.col("n_points") - 1)))
+        .select(
+            "route_id",
+            F.concat(F.lit("AMB-"), (F.col("id") % 50).cast("string")).alias("vehicle_id"),
+            (F.lit(45.45) + F.rand(9) * 0.07).alias("latitude"),
+            (F.lit(9.15) + F.rand(10) * 0.10).alias("longitude"),
+            "sequence",
+            F.expr("timestamp_seconds(unix_timestamp(t0) + sequence * 6)").alias("timestamp"),
+            (F.col("sequence") * 100 / (F.col("n_points") - 1)).cast("int").alias("progress_pct"),
+            (F.rand(11) * 40 + 35).alias("speed_kmh"),
+            F.when(F.col("sequence") == F.col("n_points") - 1, "arrived").otherwise("en_route").alias("status"),
+            F.expr("timestamp_seconds(unix_timestamp(t0) + sequence * 6 + 2)").alias("processed_timestamp"))
+        .repartition(synthetic_days * 24)  # many small files, like streaming ingestion
+        .write.mode("overwrite").format("delta").saveAsTable(SOURCE_TELEMETRY))
+    print(f"Synthetic sources: {n_routes} routes over {synthetic_days} days")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- 1) Curated telemetry: date partitions, appended incrementally ---
+spark.sql(f"""
+CREATE TABLE IF NOT EXISTS {CURATED_TELEMETRY} (
+    route_id STRING,
+    vehicle_id STRING,
+    latitude DOUBLE,
+    longitude DOUBLE,
+    sequence INT,
+    timestamp TIMESTAMP,
+    progress_pct INT,
+    speed_kmh DOUBLE,
+    status STRING,
+    processed_timestamp TIMESTAMP,
+    event_date DATE
+) USING DELTA
+PARTITIONED BY (event_date)
+""")
+
+last_processed = spark.table(CURATED_TELEMETRY).agg(F.max("processed_timestamp").alias("ts")).first()["ts"]
+
+new_rows = spark.table(SOURCE_TELEMETRY)
+if last_processed is not None:
+    new_rows = new_rows.filter(F.col("processed_timestamp") > F.lit(last_processed))
+
+(new_rows
+    .select(
+        "route_id", "vehicle_id",
+        F.col("latitude").cast("double").alias("latitude"),
+        F.col("longitude").cast("double").alias("longitude"),
+        F.col("sequence").cast("int").alias("sequence"),
+        F.col("timestamp").cast("timestamp").alias("timestamp"),
+        F.col("progress_pct").cast("int").alias("progress_pct"),
+        F.col("speed_kmh").cast("double").alias("speed_kmh"),
+        "status",
+        F.col("processed_timestamp").cast("timestamp").alias("processed_timestamp"),
+        F.to_date("timestamp").alias("event_date"))
+    .write.mode("append").format("delta").saveAsTable(CURATED_TELEMETRY))
+
+print(f"Curated telemetry appended after processed_timestamp={last_processed}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- 2) Compaction of the partitions still receiving streaming appends ---
+since = date.today() - timedelta(days=compact_recent_days)
+t0 = time.time()
+spark.sql(f"OPTIMIZE {CURATED_TELEMETRY} WHERE event_date >= '{since}' ZORDER BY (route_id)")
+print(f"Compacted {CURATED_TELEMETRY} partitions since {since} in {time.time() - t0:.1f}s")
+
+spark.sql(f"VACUUM {CURATED_TELEMETRY} RETAIN {vacuum_retain_hours} HOURS")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- 3) Training table: data skipping on route_id ---
+if spark.catalog.tableExists(TRAINING_TABLE):
+    t0 = time.time()
+    spark.sql(f"OPTIMIZE {TRAINING_TABLE} ZORDER BY (route_id)")
+    spark.sql(f"VACUUM {TRAINING_TABLE} RETAIN {vacuum_retain_hours} HOURS")
+    print(f"Compacted {TRAINING_TABLE} in {time.time() - t0:.1f}s")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# --- 4) Benchmark: shortcut vs curated layout ---
+def _timed(label, fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        spark.catalog.clearCache()
+        t0 = time.time()
+        fn()
+        best = min(best, time.time() - t0)
+    return {"query": label, "best_s": round(best, 2)}
+
+
+def _agg_join(table, last_days=None):
+    tel = spark.table(table)
+    if last_days is not None:
+        tel = tel.filter(F.col("timestamp") >= F.date_sub(F.current_date(), last_days))
+        if "event_date" in tel.columns:
+            tel = tel.filter(F.col("event_date") >= F.date_sub(F.current_date(), last_days))
+    agg = tel.groupBy("route_id").agg(
+        F.min("timestamp").alias("t_start"),
+        F.max("timestamp").alias("t_end"),
+        F.avg("speed_kmh").alias("avg_speed_kmh"),
+        F.count("*").alias("telemetry_points"))
+    return spark.table(SOURCE_ANALYSIS).join(agg, on="route_id", how="inner").count()
+
+
+if run_benchmark:
+    results = [
+        _timed("agg_join_full_shortcut", lambda: _agg_join(SOURCE_TELEMETRY)),
+        _timed("agg_join_full_curated", lambda: _agg_join(CURATED_TELEMETRY)),
+        _timed("agg_join_last_day_shortcut", lambda: _agg_join(SOURCE_TELEMETRY, last_days=1)),
+        _timed("agg_join_last_day_curated", lambda: _agg_join(CURATED_TELEMETRY, last_days=1)),
+    ]
+    if spark.catalog.tableExists(TRAINING_TABLE):
+        results.append(_timed("training_read", lambda: spark.table(TRAINING_TABLE).toPandas()))
+    for name in (SOURCE_TELEMETRY, CURATED_TELEMETRY):
+        detail = spark.sql(f"DESCRIBE DETAIL {name}").select("numFiles", "sizeInBytes").first()
+        results.append({"query": f"files:{name}", "num_files": detail["numFiles"], "size_mb": round(detail["sizeInBytes"] / 2**20, 1)})
+    display(spark.createDataFrame([{k: str(v) for k, v in r.items()} for r in results]))
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
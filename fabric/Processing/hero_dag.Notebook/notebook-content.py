@@ -0,0 +1,227 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the executor with: %run hero_dag
+benchmark_dag = False               # serial vs DAG wall time on the decision pipeline shape
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+log = logging.getLogger("hero-dag")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Stage DAG executor
+# ----------------------------------------------------
+# - stages declare their dependencies by name and receive their results as keyword arguments
+# - a stage starts as soon as all its dependencies succeeded; independent branches run
+#   concurrently on a thread pool
+# - a failed stage only skips its own descendants, the other branches keep running
+# - the report gives per-stage timings and the critical path (the chain of stages that
+#   determined the end-to-end time)
+# ====================================================
+
+class StageFailed(Exception):
+    """A required stage failed or was skipped; raised by StageDAG.run() after all branches settled."""
+
+
+class DagReport:
+
+    def __init__(self, stages: dict, results: dict, errors: dict, deps: dict, wall_ms: float):
+        self.stages = stages            # name -> {status, start_ms, end_ms, duration_ms, error}
+        self.results = results
+        self.errors = errors
+        self._deps = deps
+        self.wall_ms = wall_ms
+
+    def result(self, name: str, default=None):
+        return self.results.get(name, default)
+
+    def ok(self, name: str) -> bool:
+        return self.stages[name]["status"] == "ok"
+
+    def ready_ms(self, *names) -> float:
+        """Time at which the last of the given stages finished (None if one of them did not run)."""
+        ends = [self.stages[n]["end_ms"] for n in names]
+        return None if None in ends else max(ends)
+
+    @property
+    def serial_ms(self) -> float:
+        """Sum of stage durations, i.e. the end-to-end time of running them one after the other."""
+        return round(sum(s["duration_ms"] for s in self.stages.values()), 2)
+
+    def critical_path(self) -> list:
+        """From the last stage to finish, back through the dependency that finished last each time."""
+        ran = {n: s for n, s in self.stages.items() if s["status"] != "skipped"}
+        if not ran:
+            return []
+        node = max(ran, key=lambda n: ran[n]["end_ms"])
+        path = [node]
+        while self._deps[node]:
+            node = max(self._deps[node], key=lambda d: self.stages[d]["end_ms"])
+            path.append(node)
+        return path[::-1]
+
+    def summary(self) -> dict:
+        path = self.critical_path()
+        return {
+            "wall_ms": self.wall_ms,
+            "serial_ms": self.serial_ms,
+            "critical_path": path,
+            "critical_path_ms": round(sum(self.stages[n]["duration_ms"] for n in path), 2),
+            "failed": [n for n, s in self.stages.items() if s["status"] == "error"],
+            "skipped": [n for n, s in self.stages.items() if s["status"] == "skipped"],
+        }
+
+
+class StageDAG:
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self._fns = {}
+        self._deps = {}
+
+    def add(self, name: str, fn, deps=()):
+        """Registers fn(**{dep: result}) under name; deps must already be registered, so the graph stays acyclic."""
+        if name in self._fns:
+            raise ValueError(f"Stage {name} already defined")
+        missing = [d for d in deps if d not in self._fns]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stage(s) {missing}")
+        self._fns[name] = fn
+        self._deps[name] = tuple(deps)
+        return self
+
+    def stage(self, name: str = None, deps=()):
+        """Decorator form of add(); the stage name defaults to the function name."""
+        def register(fn):
+            self.add(name or fn.__name__, fn, deps)
+            return fn
+        return register
+
+    def run(self, required=()) -> DagReport:
+        """Runs every stage once; raises StageFailed afterwards if a stage in required did not succeed."""
+        children = {n: [c for c, ds in self._deps.items() if n in ds] for n in self._fns}
+        waiting = {n: len(ds) for n, ds in self._deps.items()}
+        stages, results, errors = {}, {}, {}
+        t0 = time.perf_counter()
+
+        def ms():
+            return round((time.perf_counter() - t0) * 1000, 2)
+
+        def call(name):
+            start = ms()
+            try:
+                value = self._fns[name](**{d: results[d] for d in self._deps[name]})
+                return name, start, value, None
+            except Exception as e:
+                return name, start, None, e
+
+        def skip(name, cause):
+            for c in [name] + children[name]:
+                if c not in stages:
+                    stages[c] = {"status": "skipped", "start_ms": None, "end_ms": None, "duration_ms": 0.0,
+                                 "error": f"upstream {cause}"}
+                    if c != name:
+                        skip(c, cause)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hero-dag") as pool:
+            running = {pool.submit(call, n) for n, k in waiting.items() if k == 0}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, start, value, error = future.result()
+                    end = ms()
+                    stages[name] = {"status": "ok" if error is None else "error", "start_ms": start, "end_ms": end,
+                                    "duration_ms": round(end - start, 2),
+                                    "error": None if error is None else f"{type(error).__name__}: {error}"}
+                    if error is not None:
+                        errors[name] = error
+                        log.error(f"Stage {name} failed after {stages[name]['duration_ms']} ms: {error}")
+                        for c in children[name]:
+                            skip(c, name)
+                        continue
+                    results[name] = value
+                    for c in children[name]:
+                        waiting[c] -= 1
+                        if waiting[c] == 0 and c not in stages:
+                            running.add(pool.submit(call, c))
+
+        report = DagReport(stages, results, errors, self._deps, ms())
+        for name in required:
+            if not report.ok(name):
+                cause = errors.get(name) or next((errors[d] for d in self._ancestors(name) if d in errors), None)
+                raise StageFailed(f"Stage {name} {stages[name]['status']}: {stages[name]['error']}") from cause
+        return report
+
+    def _ancestors(self, name: str) -> list:
+        out = []
+        for d in self._deps[name]:
+            out += [d] + self._ancestors(d)
+        return out
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Benchmark (benchmark_dag = True) ----------
+# Latencies typical of one hero_route_decision run (UDF round trips), telemetry excluded.
+if benchmark_dag:
+    latency_s = {"theoretical": 0.35, "aware": 0.40, "decide": 0.05, "sms": 0.01,
+                 "publish_analysis": 0.15, "publish_segments": 0.25, "archive_flush": 0.08}
+
+    def _sleep(name):
+        return lambda **_: time.sleep(latency_s[name])
+
+    dag = StageDAG()
+    dag.add("theoretical", _sleep("theoretical"))
+    dag.add("aware", _sleep("aware"), deps=("theoretical",))
+    dag.add("decide", _sleep("decide"), deps=("theoretical", "aware"))
+    dag.add("archive_flush", _sleep("archive_flush"), deps=("aware",))
+    for branch in ("sms", "publish_analysis", "publish_segments"):
+        dag.add(branch, _sleep(branch), deps=("decide",))
+    report = dag.run()
+    print(report.summary())
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -0,0 +1,269 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# set to True to run the synthetic fleet comparison at the end of the notebook.
+# Other notebooks load the emitter with: %run hero_dead_reckoning
+run_benchmark = False
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import bisect
+import logging
+import math
+import random
+
+log = logging.getLogger("hero-dead-reckoning")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Dead-reckoning telemetry emission
+# ----------------------------------------------------
+# - The producer and the consumer both know the chosen route (tb_route_segments)
+# - From the last published fix, position is predicted along the route at the last observed speed
+# - A fix is published only if the vehicle is more than tolerance_m away from the prediction,
+#   if max_interval_s passed since the last one, or if the status changed
+# - reconstruct() fills the skipped route points for per-point consumers; the benchmark uses it for the
+#   reconstruction error, ml_data_prep needs no reconstruction (its speed average is time-weighted)
+# ====================================================
+
+EARTH_RADIUS_M = 6_371_000.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2) -> float:
+    """Great-circle distance in meters."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2.0) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+class RouteTrack:
+    """Route polyline with cumulative along-route distance per point (sequence = point index)."""
+
+    def __init__(self, points):
+        self.points = [(float(lat), float(lon)) for lat, lon in points]
+        self.cum_m = [0.0]
+        for (a_lat, a_lon), (b_lat, b_lon) in zip(self.points, self.points[1:]):
+            self.cum_m.append(self.cum_m[-1] + haversine_m(a_lat, a_lon, b_lat, b_lon))
+
+    @property
+    def length_m(self) -> float:
+        return self.cum_m[-1]
+
+    def position_at(self, along_m: float):
+        """(lat, lon) at along_m meters from the start, clamped to the route ends."""
+        if along_m <= 0 or len(self.points) == 1:
+            return self.points[0]
+        if along_m >= self.length_m:
+            return self.points[-1]
+        i = bisect.bisect_right(self.cum_m, along_m) - 1
+        seg = self.cum_m[i + 1] - self.cum_m[i]
+        f = (along_m - self.cum_m[i]) / seg if seg > 0 else 0.0
+        (a_lat, a_lon), (b_lat, b_lon) = self.points[i], self.points[i + 1]
+        return a_lat + f * (b_lat - a_lat), a_lon + f * (b_lon - a_lon)
+
+
+def _speed_mps(along0, ts0, along1, ts1) -> float:
+    return max(0.0, (along1 - along0) / (ts1 - ts0)) if ts1 > ts0 else 0.0
+
+
+class DeadReckoningEmitter:
+    """
+    Decides, fix by fix, whether a vehicle position has to be published.
+
+    - speed is the along-route speed between the last two published fixes (0 until there are two),
+      so the consumer can rebuild the exact same prediction from the published fixes alone
+    - offer() returns True when the fix must be published; the caller publishes it
+    - the consumer's dead-reckoned position never drifts more than tolerance_m from an offered fix
+    """
+
+    def __init__(self, track: RouteTrack, tolerance_m: float = 30.0, max_interval_s: float = 30.0):
+        self.track = track
+        self.tolerance_m = tolerance_m
+        self.max_interval_s = max_interval_s
+        self._last = None          # (ts_s, along_m, status) of the last published fix
+        self._speed_mps = 0.0
+        self.offered = 0
+        self.emitted = 0
+
+    def predict(self, ts_s: float):
+        ts0, along0, _ = self._last
+        return self.track.position_at(along0 + self._speed_mps * (ts_s - ts0))
+
+    def offer(self, sequence: int, lat: float, lon: float, ts_s: float, status: str = "en_route") -> bool:
+        self.offered += 1
+        along = self.track.cum_m[sequence]
+        if self._last is None:
+            emit = True
+        else:
+            ts0, along0, status0 = self._last
+            emit = (status != status0
+                    or ts_s - ts0 >= self.max_interval_s
+                    or haversine_m(lat, lon, *self.predict(ts_s)) > self.tolerance_m)
+            if emit:
+                self._speed_mps = _speed_mps(along0, ts0, along, ts_s)
+        if emit:
+            self._last = (ts_s, along, status)
+            self.emitted += 1
+        return emit
+
+    def stats(self) -> dict:
+        return {
+            "offered": self.offered,
+            "emitted": self.emitted,
+            "reduction": round(self.offered / self.emitted, 2) if self.emitted else None,
+        }
+
+
+def reconstruct(track: RouteTrack, events: list) -> list:
+    """
+    Consumer side: one fix per route point between the first and last published fix.
+    events: published telemetry dicts with 'sequence' and 'timestamp' (epoch ms).
+    Skipped points are timed with the emitter's own prediction (last published fix + last speed),
+    so they inherit its tolerance_m bound; 'reconstructed': True marks them.
+    """
+    published = sorted(events, key=lambda e: e["sequence"])
+    out = []
+    speed = 0.0
+    for k, (a, b) in enumerate(zip(published, published[1:])):
+        out.append(dict(a, reconstructed=False))
+        ta, tb = a["timestamp"] / 1000.0, b["timestamp"] / 1000.0
+        da, db = track.cum_m[a["sequence"]], track.cum_m[b["sequence"]]
+        if k > 0:
+            prev = published[k - 1]
+            speed = _speed_mps(track.cum_m[prev["sequence"]], prev["timestamp"] / 1000.0, da, ta)
+        for seq in range(a["sequence"] + 1, b["sequence"]):
+            if speed > 0:
+                t = min(ta + (track.cum_m[seq] - da) / speed, tb)
+            else:
+                # no speed yet: the vehicle stayed within tolerance of a, spread the points linearly
+                t = ta + (tb - ta) * ((track.cum_m[seq] - da) / (db - da) if db > da else 0.0)
+            lat, lon = track.points[seq]
+            out.append({
+                "vehicle_id": a.get("vehicle_id"),
+                "route_id": a.get("route_id"),
+                "sequence": seq,
+                "timestamp": int(round(t * 1000)),
+                "latitude": lat,
+                "longitude": lon,
+                "status": a.get("status"),
+                "reconstructed": True,
+            })
+    if published:
+        out.append(dict(published[-1], reconstructed=False))
+    return out
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Synthetic fleet comparison (run_benchmark = True)
+# ----------------------------------------------------
+# Routes and pacing mimic stream_telemetry_eta_based: ~40 m between points,
+# interval per point ±20% jitter, plus occasional stops at traffic lights.
+# ====================================================
+
+def _synthetic_route(rng, n_points):
+    lat, lon = 45.40 + rng.uniform(0, 0.15), 9.05 + rng.uniform(0, 0.25)
+    heading = rng.uniform(0, 2 * math.pi)
+    pts = []
+    for _ in range(n_points):
+        pts.append((lat, lon))
+        heading += rng.gauss(0, 0.25)
+        lat += 40 * math.cos(heading) / 111_320.0
+        lon += 40 * math.sin(heading) / (111_320.0 * math.cos(math.radians(lat)))
+    return pts
+
+
+def run_fleet(n_vehicles=500, tolerance_m=30.0, max_interval_s=30.0, seed=41):
+    rng = random.Random(seed)
+    offered = emitted = 0
+    live_err, recon_err = [], []
+    for v in range(n_vehicles):
+        track = RouteTrack(_synthetic_route(rng, rng.randint(80, 300)))
+        emitter = DeadReckoningEmitter(track, tolerance_m, max_interval_s)
+        base_interval = rng.uniform(3.0, 8.0)
+        ts, truth, published = 0.0, [], []
+        last = len(track.points) - 1
+        for seq, (lat, lon) in enumerate(track.points):
+            status = "arrived" if seq == last else "en_route"
+            truth.append((seq, ts))
+            if emitter.offer(seq, lat, lon, ts, status):
+                published.append({"sequence": seq, "timestamp": int(ts * 1000), "status": status})
+            elif emitter._last is not None:
+                live_err.append(haversine_m(lat, lon, *emitter.predict(ts)))
+            stop = rng.uniform(15, 45) if rng.random() < 0.03 else 0.0
+            ts += base_interval * rng.uniform(0.8, 1.2) + stop
+        # reconstruction error: where the consumer puts the vehicle at each true fix time
+        recon = reconstruct(track, published)
+        r_ts = [r["timestamp"] / 1000.0 for r in recon]
+        r_along = [track.cum_m[r["sequence"]] for r in recon]
+        for seq, t in truth:
+            j = min(max(bisect.bisect_right(r_ts, t) - 1, 0), len(r_ts) - 2)
+            f = (t - r_ts[j]) / (r_ts[j + 1] - r_ts[j]) if r_ts[j + 1] > r_ts[j] else 0.0
+            est = track.position_at(r_along[j] + min(max(f, 0.0), 1.0) * (r_along[j + 1] - r_along[j]))
+            recon_err.append(haversine_m(*track.points[seq], *est))
+        offered += emitter.offered
+        emitted += emitter.emitted
+
+    def pct(xs, q):
+        xs = sorted(xs)
+        return round(xs[min(len(xs) - 1, int(q * len(xs)))], 1) if xs else 0.0
+
+    return {
+        "tolerance_m": tolerance_m,
+        "max_interval_s": max_interval_s,
+        "events_every_point": offered,
+        "events_adaptive": emitted,
+        "reduction": round(offered / emitted, 2),
+        "live_err_m_p95": pct(live_err, 0.95),
+        "live_err_m_max": pct(live_err, 1.0),
+        "recon_err_m_p95": pct(recon_err, 0.95),
+        "recon_err_m_max": pct(recon_err, 1.0),
+    }
+
+
+if run_benchmark:
+    for tol in (15.0, 30.0, 60.0):
+        print(run_fleet(tolerance_m=tol))
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -0,0 +1,827 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     },
+# META     "environment": {}
+# META   }
+# META }
+
+# MARKDOWN ********************
+
+# # HERO dispatch consumer
+#
+# Long-running alternative to the Activator → `hero_route_decision` run per dispatch.
+# It reads the dispatch CDC stream directly and decides missions concurrently:
+#
+# - **Source**: `eventhub` reads the `HeroConsumer` custom endpoint of the `dispatch` Eventstream (raw CDC), `local` generates synthetic dispatches around Milan
+# - **Filter**: same as the Activator rule, `status == "dispatched"` and triage code other than `verde`
+# - **Workers**: missions run in a bounded thread pool (`max_workers`); each batch is checkpointed once all its missions are done (at-least-once)
+# - **Warm state**: model, UDF handles, Event Hub producers and a short-TTL route cache live for the whole session
+# - **Publishing**: with `publish_mode = "partitioned"` each hub gets a `hero_event_publisher` sender per partition (keys consistently hashed, per-key order kept); a batch is checkpointed only after its events are sent
+# - **Traffic history**: live traffic-aware responses are archived by `hero_traffic_history` (flushed every `archive_flush_s`); with `traffic_forecast = "auto"` a confident congestion forecast (or any forecast when the Routes API quota is exhausted) replaces the live call
+# - **Route store**: both geometries of every mission are appended to the `hero_route_store` memory-mapped store, of which this session is the single writer (it also folds the routes posted by `hero_route_decision` runs)
+# - **Geofences**: each mission adds an incident fence at its destination; every simulated fix goes through the `hero_geofence` engine (static fences from `Files/hero/geofences.json` too), the incident "arrived" event ends the trip; events go to the `geofence_events` Eventstream (`conn-str-geofence-events`, `tb_geofence_events`), where `ml_data_prep` takes arrivals from
+# - **Online learning**: each completed mission (end of its telemetry) updates the `hero_online_model` residual corrector on top of the AutoML model, checkpointed in `Files/hero/online_model/`
+# - **Checkpoint**: last processed offset per partition in `Files/hero/dispatch_consumer_checkpoint.json`; partitions without one start at the end of the stream (or `start_lookback_min` back), never at the start of the retention window
+# - **Stale dispatches**: events enqueued more than `max_event_age_s` ago are checkpointed but not decided, so a backlog replay sends no late SMS
+#
+# Decision logic is the same as `hero_route_decision` (steps 1–6); notifications go through `hero_outbox`.
+
+# PARAMETERS CELL ********************
+
+source = "eventhub"             # "eventhub" | "local"
+max_workers = 8
+run_minutes = 0                 # 0 = run until interrupted
+consumer_group = "$Default"
+start_lookback_min = 0          # partitions never checkpointed: 0 = only new events, N = events enqueued in the last N minutes
+max_event_age_s = 900           # older dispatches are skipped (no route, no SMS): the crew has long been sent
+route_cache_ttl_s = 120         # traffic-aware routes go stale quickly
+send_sms = True
+simulate_telemetry = False      # ETA-paced telemetry per mission, on its own pool
+telemetry_mode = "adaptive"     # "adaptive" (dead reckoning) | "every_point"
+telemetry_tolerance_m = 30.0
+telemetry_max_interval_s = 30.0
+traffic_forecast = "auto"       # "auto" (forecast when confident or on quota errors) | "off" | "force"
+forecast_min_confidence = 0.8
+archive_flush_s = 300           # live traffic rows reach the archive (and the forecaster / hotspot runs) within this
+local_dispatches = 200          # source = "local" only
+local_rate_per_s = 20.0
+publish_mode = "partitioned"    # "partitioned" (one ordered sender per Event Hub partition) | "single"
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import logging
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import sempy.fabric as fabric
+from mlflow.pyfunc import load_model
+from azure.eventhub import EventHubProducerClient, EventHubConsumerClient, EventData
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_outbox
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_dead_reckoning
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_trajectory
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_traffic_history
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_online_model
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_route_store
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_geofence
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_event_publisher
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- LOGGING ----------
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(threadName)s %(message)s")
+log = logging.getLogger("hero-consumer")
+
+# ---------- CONFIG (loaded once) ----------
+variable_lib = notebookutils.variableLibrary.getLibrary("Variables")
+VAULT_URL = variable_lib.getVariable("azure-key-vault")
+MODEL_NAME = variable_lib.getVariable("siren-model")
+
+def _secret(name, optional=False):
+    try:
+        return notebookutils.credentials.getSecret(VAULT_URL, name)
+    except Exception:
+        if optional:
+            return None
+        raise
+
+API_KEY = _secret("google-maps-api-key")
+EH_CONN_ANALYSIS = _secret("conn-str-route-analysis")
+EH_CONN_SEGMENTS = _secret("conn-str-route-segments")
+EH_CONN_TELEMETRY = _secret("conn-str-vehicles-telemetry")
+EH_CONN_METRICS = _secret("conn-str-pipeline-metrics", optional=True)
+EH_CONN_DISPATCH = _secret("conn-str-dispatch-consumer", optional=True)  # Listen key of the HeroConsumer endpoint
+EH_CONN_GEOFENCE = _secret("conn-str-geofence-events", optional=True)
+TWILIO_SID = _secret("twilio-sid")
+TWILIO_FROM = _secret("twilio-from-number")
+TWILIO_TOKEN = _secret("twilio-token")
+TO_PHONE = _secret("twilio-to-number")
+
+hero_functions = notebookutils.udf.getFunctions("hero_functions", fabric.get_workspace_id())
+
+CHECKPOINT_PATH = "/lakehouse/default/Files/hero/dispatch_consumer_checkpoint.json"
+EVENT_SCHEMA_VERSION = 2        # same as hero_functions
+REROUTE_THRESHOLD_MIN = 2.0
+INCIDENT_RADIUS_M = 75.0
+
+log.info("Config done")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Warm state shared by all workers
+# ====================================================
+
+# ---------- model ----------
+MODEL_URI = f"models:/{MODEL_NAME}/2"
+ml_model = load_model(MODEL_URI)
+try:
+    _input_schema = ml_model.metadata.get_input_schema()
+    SCHEMA_DTYPES = {c.name: c.type.to_numpy() for c in _input_schema.inputs} if _input_schema else {}
+except Exception:
+    SCHEMA_DTYPES = {}
+log.info(f"Loaded model {MODEL_NAME}")
+
+
+# ---------- producers ----------
+def _hub_name(conn_str: str) -> str:
+    return next((p.split("=", 1)[1] for p in conn_str.strip().split(";") if p.startswith("EntityPath=")), "hub")
+
+
+class ProducerPool:
+    """
+    One producer per connection string, opened on first use and reused by every mission.
+    partitioned: a PartitionedPublisher per hub, send() only enqueues and flush() waits for delivery.
+    Otherwise one EventHubProducerClient per hub; clients are not thread-safe, so sends to the same
+    hub are serialised by a per-client lock.
+    """
+
+    def __init__(self, partitioned: bool = True):
+        self.partitioned = partitioned
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def send(self, conn_str: str, events: list, partition_key: str = None):
+        with self._lock:
+            if conn_str not in self._clients:
+                self._clients[conn_str] = PartitionedPublisher(conn_str) if self.partitioned else \
+                    (EventHubProducerClient.from_connection_string(conn_str.strip()), threading.Lock())
+            entry = self._clients[conn_str]
+        if self.partitioned:
+            entry.send([dict(event, schema_version=EVENT_SCHEMA_VERSION) for event in events], partition_key)
+            return
+        client, client_lock = entry
+        with client_lock:
+            batch = client.create_batch(partition_key=partition_key)
+            for event in events:
+                data = EventData(json.dumps(dict(event, schema_version=EVENT_SCHEMA_VERSION)))
+                try:
+                    batch.add(data)
+                except ValueError:
+                    client.send_batch(batch)
+                    batch = client.create_batch(partition_key=partition_key)
+                    batch.add(data)
+            if len(batch) > 0:
+                client.send_batch(batch)
+
+    def flush(self, timeout: float = 60.0) -> bool:
+        """True once every event sent so far is delivered (always true for single producers)."""
+        with self._lock:
+            publishers = list(self._clients.values()) if self.partitioned else []
+        return all(p.flush(timeout) for p in publishers)
+
+    def dropped(self) -> int:
+        """Events given up since the session started (partitioned mode; single producers raise instead)."""
+        with self._lock:
+            publishers = list(self._clients.values()) if self.partitioned else []
+        return sum(p.stats()["dropped"] for p in publishers)
+
+    def stats(self) -> dict:
+        """Per hub (EntityPath): PartitionedPublisher.stats(), partitioned mode only."""
+        with self._lock:
+            items = list(self._clients.items()) if self.partitioned else []
+        return {_hub_name(conn_str): p.stats() for conn_str, p in items}
+
+    def close(self):
+        with self._lock:
+            for entry in self._clients.values():
+                if self.partitioned:
+                    entry.close()
+                else:
+                    entry[0].close()
+            self._clients.clear()
+
+
+producers = ProducerPool(partitioned=publish_mode == "partitioned")
+
+
+# ---------- route cache ----------
+class RouteCache:
+    """
+    get_route results keyed by rounded origin/destination and routing preference, expired after ttl_s.
+    A hit is a shallow copy under a fresh route_id: route_id identifies one mission's route in telemetry,
+    segments, training and online learning. Live responses (cache misses) are recorded in archive.
+    """
+
+    def __init__(self, ttl_s: float, max_size: int = 2048, archive: TrafficArchive = None):
+        self.ttl_s = ttl_s
+        self.max_size = max_size
+        self.archive = archive
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_route(self, o_lat, o_lon, d_lat, d_lon, preference):
+        key = (round(o_lat, 4), round(o_lon, 4), round(d_lat, 4), round(d_lon, 4), preference)
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and now - item[0] < self.ttl_s:
+                self.hits += 1
+                route_id = str(uuid.uuid4())
+                return dict(item[1], route_id=route_id,
+                            segments=[dict(seg, route_id=route_id) if "route_id" in seg else seg
+                                      for seg in item[1].get("segments") or []])
+            self.misses += 1
+        route = unpack_route(hero_functions.get_route(params={
+            "origin_lat": o_lat, "origin_lon": o_lon,
+            "dest_lat": d_lat, "dest_lon": d_lon,
+            "api_key": API_KEY,
+            "routing_preference": preference,
+            "response_format": "packed",
+        }))
+        if self.archive is not None:
+            try:
+                self.archive.record(route)
+            except Exception:
+                log.exception("Traffic archive record failed")
+        with self._lock:
+            self._items[key] = (now, route)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return route
+
+
+# ---------- traffic history ----------
+# forecaster state as of session start; hero_traffic_history (train_forecaster) refreshes it on its schedule
+traffic_archive = TrafficArchive(flush_s=archive_flush_s)
+forecaster = None
+if traffic_forecast != "off":
+    try:
+        forecaster = CongestionForecaster.load()
+        log.info(f"Congestion forecaster: {len(forecaster.stats)} (cell, hour) keys, watermark={forecaster.watermark}")
+    except Exception as e:
+        log.warning(f"Congestion forecaster unavailable, live traffic only: {e}")
+
+# ---------- online corrector ----------
+# this session is the single writer: it learns its own completions and folds the inbox of per-dispatch runs
+online_model = OnlineResidualModel.load(baseline=MODEL_URI)
+log.info(f"Online corrector: {fold_inbox(online_model)} queued completion(s) folded, {online_model.updates} total")
+
+routes = RouteCache(route_cache_ttl_s, archive=traffic_archive)
+route_store = RouteStoreWriter()       # this session is the store's single writer, it folds the runs' inbox too
+log.info(f"Route store: {fold_route_inbox(route_store)} posted route(s) folded")
+geofences = GeofenceEngine()
+log.info(f"Geofences: {load_geofences(geofences)} static fence(s) loaded")
+if simulate_telemetry and not EH_CONN_GEOFENCE:
+    log.warning("No conn-str-geofence-events: arrivals are not persisted, ml_data_prep falls back to the telemetry status")
+outbox = NotificationOutbox(hero_functions.send_sms_with_map) if send_sms else None
+telemetry_pool = ThreadPoolExecutor(max_workers=max(4, max_workers), thread_name_prefix="hero-telemetry")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Mission processing (steps 1-6 of hero_route_decision)
+# ====================================================
+
+def parse_dispatch(event: dict):
+    """Maps a raw CDC record (or an already flattened one) to a dispatch, None when the Activator rule would skip it."""
+    row = event.get("payload", {}).get("after") if "payload" in event else event
+    if not row or row.get("dispatch_id") is None:
+        return None
+    if row.get("status") != "dispatched" or str(row.get("dispatch_triage_code", "")).lower() == "verde":
+        return None
+
+    def coord(text, lat, lon):
+        if text:
+            a, b = str(text).split(",")
+            return float(a), float(b)
+        return float(lat), float(lon)
+
+    origin_lat, origin_lon = coord(row.get("origin_coordinate"), row.get("vehicle_origin_latitude"), row.get("vehicle_origin_longitude"))
+    dest_lat, dest_lon = coord(row.get("incident_coordinate"), row.get("incident_location_latitude"), row.get("incident_location_longitude"))
+    return {
+        "mission_id": int(row["dispatch_id"]),
+        "vehicle_id": str(row.get("vehicle_number")),
+        "origin_lat": origin_lat, "origin_lon": origin_lon,
+        "dest_lat": dest_lat, "dest_lon": dest_lon,
+    }
+
+
+def compute_hero_eta(eta_min: float, congestion_score: float) -> float:
+    """Heuristic fallback, same as hero_route_decision."""
+    advantage = min(0.35, 0.10 + 0.25 * congestion_score)
+    return round(eta_min * (1 - advantage), 2)
+
+
+def predict_advantage(congestion_score, eta_theoretical, dist_theoretical, n_points):
+    """Clamped advantage, the AutoML prediction it corrects and the feature row (kept for online learning)."""
+    now = datetime.utcnow()
+    features = pd.DataFrame([{
+        "congestion_score": congestion_score,
+        "eta_theoretical_min": eta_theoretical,
+        "distance_m_theoretical": dist_theoretical,
+        "hour_of_day": now.hour,
+        "dow": now.weekday(),
+        "avg_speed_kmh": 50,
+        "telemetry_points": n_points,
+    }])
+    features = features.astype({c: SCHEMA_DTYPES.get(c, "float64") for c in features.columns})
+    baseline = float(ml_model.predict(features)[0])
+    row = {k: float(v) for k, v in features.iloc[0].items()}
+    advantage = online_model.predict(row, baseline) if online_model.updates >= online_min_updates else baseline
+    return max(0.05, min(advantage, 0.35)), baseline, row
+
+
+def learn_completion(mission_id, features: dict, baseline_adv: float, eta_theoretical: float, actual_eta_min):
+    """Feeds a finished mission to the online corrector and checkpoints it now and then."""
+    target = completion_target(eta_theoretical, actual_eta_min)
+    if target is None:
+        return
+    online_model.update(features, baseline_adv, target, mission_id)
+    if online_model.maybe_save():
+        log.info(f"Online corrector checkpoint: {online_model.drift.status()}")
+
+
+def process_dispatch(dispatch: dict) -> dict:
+    t0 = time.perf_counter()
+    theoretical = routes.get_route(dispatch["origin_lat"], dispatch["origin_lon"],
+                                   dispatch["dest_lat"], dispatch["dest_lon"], "TRAFFIC_UNAWARE")
+    aware, traffic_source = traffic_aware_route(
+        lambda: routes.get_route(dispatch["origin_lat"], dispatch["origin_lon"],
+                                 dispatch["dest_lat"], dispatch["dest_lon"], "TRAFFIC_AWARE_OPTIMAL"),
+        theoretical, forecaster, traffic_forecast, forecast_min_confidence)
+
+    eta_google = float(aware["eta_min"])
+    eta_theoretical = float(theoretical["eta_min"])
+    congestion_score = aware["congestion_score"]
+    try:
+        predicted_adv, baseline_adv, features = predict_advantage(
+            congestion_score, eta_theoretical, int(theoretical["distance_m"]), len(theoretical["coordinates"]))
+        eta_theoretical_hero = round(eta_theoretical * (1 - predicted_adv), 2)
+    except Exception as e:
+        log.warning(f"Mission {dispatch['mission_id']}: ML prediction failed, fallback to heuristic: {e}")
+        eta_theoretical_hero = compute_hero_eta(eta_theoretical, congestion_score)
+        baseline_adv = features = None
+
+    decision = "hero" if eta_theoretical_hero < eta_google - REROUTE_THRESHOLD_MIN else "google"
+    chosen = theoretical if decision == "hero" else aware
+    chosen_eta = eta_theoretical_hero if decision == "hero" else eta_google
+    mission_id = dispatch["mission_id"]
+
+    if outbox is not None:
+        outbox.enqueue(TO_PHONE, {
+            "text_prefix": f"HERO REROUTE for {dispatch['vehicle_id']}:",
+            "gmaps_api_key": API_KEY,
+            "twilio_sid": TWILIO_SID,
+            "twilio_token": TWILIO_TOKEN,
+            "twilio_from": TWILIO_FROM,
+            "polyline": chosen["polyline"],
+            "decision": decision,
+        })
+
+    ts = int(time.time() * 1000)
+    producers.send(EH_CONN_ANALYSIS, [{
+        "mission_id": mission_id,
+        "timestamp": ts,
+        "vehicle_id": dispatch["vehicle_id"],
+        "route_id": chosen["route_id"],
+        "eta_google_aware_min": eta_google,
+        "eta_theoretical_min": eta_theoretical,
+        "eta_hero_min": chosen_eta,
+        "time_saved_vs_google_min": abs(round(eta_google - eta_theoretical_hero, 2)),
+        "distance_m_theoretical": int(theoretical["distance_m"]),
+        "distance_m_google": int(aware["distance_m"]),
+        "decision": decision,
+        "congestion_score": float(congestion_score),
+        "congestion_label": aware["congestion_label"],
+        # "forecast" / "forecast_quota": eta_google_aware_min is the forecaster's, not Google's
+        "traffic_source": traffic_source,
+        "forecast_confidence": aware.get("forecast_confidence"),
+    }], partition_key=str(mission_id))
+    producers.send(EH_CONN_SEGMENTS, [
+        {"mission_id": mission_id, "route_id": chosen["route_id"], "timestamp": ts,
+         "sequence": i, "latitude": float(lat), "longitude": float(lon)}
+        for i, (lat, lon) in enumerate(chosen["coordinates"])
+    ], partition_key=str(mission_id))
+    try:
+        route_store.put_many([theoretical, aware])
+    except Exception as e:
+        log.warning(f"Mission {mission_id}: route store write failed: {e}")
+
+    if simulate_telemetry:
+        incident_fence = f"incident-{mission_id}"
+        geofences.add_circle(incident_fence, dispatch["dest_lat"], dispatch["dest_lon"], INCIDENT_RADIUS_M,
+                             kind="incident", meta={"mission_id": mission_id})
+        geofences.assign(dispatch["vehicle_id"], incident_fence)
+
+        def drive():
+            try:
+                actual_eta_min = stream_telemetry(chosen["coordinates"], dispatch["vehicle_id"], chosen["route_id"],
+                                                  chosen_eta, chosen.get("segments"), incident_fence)
+            finally:
+                geofences.remove(incident_fence)
+            # forecast congestion is not what the model learns from, those missions are left out
+            if actual_eta_min is not None and baseline_adv is not None and traffic_source == "live":
+                learn_completion(mission_id, features, baseline_adv, eta_theoretical, actual_eta_min)
+        telemetry_pool.submit(drive)
+
+    return {"mission_id": mission_id, "decision": decision, "traffic_source": traffic_source,
+            "duration_ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+
+def publish_geofence_events(events: list):
+    for e in events:
+        log.info(f"Geofence {e['event']}: {e['vehicle_id']} {e['fence_id']} ({e['fence_kind']})")
+    if EH_CONN_GEOFENCE:
+        producers.send(EH_CONN_GEOFENCE, events, partition_key=events[0]["vehicle_id"])
+
+
+def stream_telemetry(points, vehicle_id, route_id, eta_min, segments=None, incident_fence=None):
+    """
+    ETA-paced telemetry (same route_profile timing and adaptive emission as hero_route_decision).
+    Every emitted fix goes through the geofence engine; the trip ends at the "arrived" event of
+    incident_fence (falls back to the last simulated point).
+    Returns the actual trip duration in minutes, None if the simulation did not complete.
+    """
+    n = len(points)
+    if n < 2:
+        return None
+    profile = route_profile(points, segments or [], max(10.0, float(eta_min) * 60.0) / 60.0)
+    emitter = DeadReckoningEmitter(RouteTrack(points), telemetry_tolerance_m, telemetry_max_interval_s) \
+        if telemetry_mode == "adaptive" else None
+    t_start = time.time()
+    arrived_at = None
+    try:
+        for i, (lat, lon) in enumerate(points):
+            status = "arrived" if i == n - 1 else "en_route"
+            if emitter is None or emitter.offer(i, lat, lon, time.time(), status):
+                fix = {
+                    "vehicle_id": vehicle_id,
+                    "route_id": route_id,
+                    "sequence": i,
+                    "timestamp": int(time.time() * 1000),
+                    "latitude": float(lat),
+                    "longitude": float(lon),
+                    "status": status,
+                    "progress_pct": int(round(100.0 * profile["cum_m"][i] / max(profile["cum_m"][-1], 1e-9))),
+                    "speed_kmh": round(float(profile["speed_kmh"][i]), 1) if i < n - 1 else 0.0,
+                }
+                producers.send(EH_CONN_TELEMETRY, [fix], partition_key=vehicle_id)
+                events = geofences.process(vehicle_id, fix["latitude"], fix["longitude"], ts=fix["timestamp"],
+                                           speed_kmh=fix["speed_kmh"], route_id=route_id)
+                if events:
+                    publish_geofence_events(events)
+                    if arrived_at is None:
+                        arrived_at = next((e["timestamp"] / 1000.0 for e in events
+                                           if e["event"] == "arrived" and e["fence_id"] == incident_fence), None)
+            if i < n - 1:
+                time.sleep(max(0.0, t_start + profile["t_s"][i + 1] - time.time()))
+    except Exception as e:
+        log.error(f"Telemetry simulation error for {vehicle_id}: {e}")
+        return None
+    return ((arrived_at or time.time()) - t_start) / 60.0
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Consumer: bounded worker pool + per-partition checkpoint
+# ====================================================
+
+class DispatchConsumer:
+    """
+    - submit_batch() fans a batch of events out to the worker pool and blocks until all missions are done,
+      so the checkpoint never moves past a mission still in flight
+    - the pool bounds concurrency across partitions; the Event Hub client delivers partitions on separate threads
+    - recently processed mission_ids are skipped, so a replay after restart does not re-decide them
+    """
+
+    def __init__(self, max_workers: int, checkpoint_path: str):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hero-mission")
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = self._load_checkpoint()
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self.results = deque(maxlen=10_000)     # latest missions, for the duration percentiles
+        self.processed = 0
+        self.forecasts = 0
+        self.errors = 0
+        self.skipped = 0
+        self.stale = 0
+        self.started = time.time()
+
+    def _load_checkpoint(self) -> dict:
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_checkpoint(self, partition_id: str, offset: str, sequence_number: int):
+        with self._lock:
+            self.checkpoint[partition_id] = {"offset": offset, "sequence_number": sequence_number,
+                                             "updated_at": datetime.utcnow().isoformat()}
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            tmp = self.checkpoint_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.checkpoint, f)
+            os.replace(tmp, self.checkpoint_path)
+
+    def _run_one(self, dispatch: dict):
+        try:
+            result = process_dispatch(dispatch)
+            log.info(f"Mission {result['mission_id']}: {result['decision']} in {result['duration_ms']} ms")
+        except Exception:
+            log.exception(f"Mission {dispatch['mission_id']} failed")
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            self.results.append(result)
+            self.processed += 1
+            self.forecasts += result["traffic_source"] != "live"
+
+    def submit_batch(self, dispatches: list):
+        todo = []
+        with self._lock:
+            for d in dispatches:
+                if d is None or d["mission_id"] in self._seen:
+                    self.skipped += 1
+                    continue
+                self._seen[d["mission_id"]] = True
+                if len(self._seen) > 10_000:
+                    self._seen.popitem(last=False)
+                todo.append(d)
+        for future in [self.pool.submit(self._run_one, d) for d in todo]:
+            future.result()
+
+    def on_event_batch(self, partition_context, events):
+        traffic_archive.flush_due()         # also called on the empty batches of idle partitions (max_wait_time)
+        if not events:
+            return
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_event_age_s)
+        fresh = [e for e in events if e.enqueued_time is None or e.enqueued_time >= cutoff]
+        if len(fresh) < len(events):
+            # still checkpointed below: a stale dispatch is dropped once, not on every restart
+            log.warning(f"Partition {partition_context.partition_id}: {len(events) - len(fresh)} dispatch(es) "
+                        f"older than {max_event_age_s}s skipped")
+            with self._lock:
+                self.stale += len(events) - len(fresh)
+        self.submit_batch([parse_dispatch(json.loads(e.body_as_str())) for e in fresh])
+        flushed = producers.flush()
+        if producers.dropped():
+            # output was lost: the checkpoint stays before it for the rest of the session, a restart replays
+            log.error(f"Partition {partition_context.partition_id}: {producers.dropped()} event(s) dropped, checkpoint frozen")
+            return
+        if not flushed:
+            # the next batch's checkpoint covers this one once its events are out
+            log.warning(f"Partition {partition_context.partition_id}: events still queued, checkpoint not moved")
+            return
+        last = events[-1]
+        self._save_checkpoint(partition_context.partition_id, last.offset, last.sequence_number)
+
+    def starting_position(self, partition_ids) -> dict:
+        """
+        Checkpointed offset per partition. Partitions never checkpointed start at the end of the stream
+        ("@latest"), or start_lookback_min back by enqueued time: "-1" would replay the whole CDC retention.
+        """
+        fallback = (datetime.now(timezone.utc) - timedelta(minutes=start_lookback_min)
+                    if start_lookback_min else "@latest")
+        return {pid: self.checkpoint[pid]["offset"] if pid in self.checkpoint else fallback for pid in partition_ids}
+
+    def stats(self) -> dict:
+        with self._lock:
+            durations = sorted(r["duration_ms"] for r in self.results)
+            processed, forecasts = self.processed, self.forecasts
+        n = len(durations)
+        elapsed = time.time() - self.started
+        return {
+            "processed": processed,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "stale": self.stale,
+            "missions_per_s": round(processed / elapsed, 2) if elapsed else None,
+            "duration_ms_p50": durations[n // 2] if n else None,
+            "duration_ms_p95": durations[int(n * 0.95)] if n else None,
+            "route_cache_hits": routes.hits,
+            "route_cache_misses": routes.misses,
+            "traffic_forecasts": forecasts,
+            "online_updates": online_model.updates,
+            "geofence_events": geofences.stats()["events"],
+        }
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def local_dispatch_feed(n: int, rate_per_s: float, seed: int = 41):
+    """Synthetic CDC records around Milan, emitted in batches of up to 16 at rate_per_s."""
+    rng = random.Random(seed)
+    depots = [(45.4642 + rng.uniform(-0.05, 0.05), 9.1900 + rng.uniform(-0.07, 0.07)) for _ in range(20)]
+    batch = []
+    for i in range(n):
+        o_lat, o_lon = rng.choice(depots)
+        batch.append({"payload": {"after": {
+            "dispatch_id": 900_000 + i,
+            "status": "dispatched",
+            "dispatch_triage_code": rng.choice(["rosso", "giallo", "verde"]),
+            "vehicle_number": f"AMB-{rng.randint(1, 60)}",
+            "origin_coordinate": f"{o_lat:.6f},{o_lon:.6f}",
+            "incident_coordinate": f"{45.4642 + rng.uniform(-0.06, 0.06):.6f},{9.1900 + rng.uniform(-0.08, 0.08):.6f}",
+        }}})
+        if len(batch) == 16 or i == n - 1:
+            yield batch
+            time.sleep(len(batch) / rate_per_s)
+            batch = []
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- RUN ----------
+consumer = DispatchConsumer(max_workers, CHECKPOINT_PATH)
+deadline = time.time() + run_minutes * 60 if run_minutes else None
+
+try:
+    if source == "local":
+        for batch in local_dispatch_feed(local_dispatches, local_rate_per_s):
+            consumer.submit_batch([parse_dispatch(e) for e in batch])
+            traffic_archive.flush_due()
+            if deadline and time.time() > deadline:
+                break
+    elif source == "eventhub":
+        if not EH_CONN_DISPATCH:
+            raise ValueError("Secret conn-str-dispatch-consumer is required for source='eventhub'")
+        client = EventHubConsumerClient.from_connection_string(EH_CONN_DISPATCH.strip(), consumer_group=consumer_group)
+        start = consumer.starting_position(client.get_partition_ids())
+        log.info(f"Consuming dispatches from {start}")
+        if deadline:
+            threading.Timer(deadline - time.time(), client.close).start()
+        with client:
+            client.receive_batch(
+                on_event_batch=consumer.on_event_batch,
+                starting_position=start,
+                starting_position_inclusive=False,
+                max_batch_size=max_workers * 2,
+                max_wait_time=1,
+            )
+    else:
+        raise ValueError(f"Unknown source: {source}")
+except KeyboardInterrupt:
+    log.info("Consumer interrupted")
+finally:
+    consumer.close()
+    if outbox is not None:
+        outbox.close(timeout=60)
+    telemetry_pool.shutdown(wait=simulate_telemetry)  # ETA-paced telemetry still needs the producers
+    producers.flush()
+    for hub, s in producers.stats().items():
+        log.info(f"Publisher {hub}: {s}")
+    producers.close()
+    traffic_archive.flush()
+    fold_inbox(online_model)
+    fold_route_inbox(route_store)
+    online_model.save()
+    log.info(f"Online corrector drift: {online_model.drift.status()}")
+    log.info(f"Consumer stats: {consumer.stats()}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -2,7 +2,7 @@ import logging
 import requests
 import polyline
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 import fabric.functions as fn
@@ -13,10 +13,162 @@ import time
 import sys
 from typing import List, Dict, Any, Tuple
 import base64
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 udf = fn.UserDataFunctions()
 
+# Versioned event schemas published to the Eventstreams; bronze tables in Eventhouse are declared with the same types.
+# v2: numbers as numbers, timestamps as epoch milliseconds (UTC), every event carries schema_version.
+EVENT_SCHEMA_VERSION = 2
+EVENT_SCHEMAS = {
+    "route_analysis": {
+        "mission_id": int,
+        "timestamp": int,
+        "vehicle_id": str,
+        "route_id": str,
+        "eta_google_aware_min": float,
+        "eta_theoretical_min": float,
+        "eta_hero_min": float,
+        "time_saved_vs_google_min": float,
+        "distance_m_theoretical": int,
+        "distance_m_google": int,
+        "decision": str,
+        "congestion_score": float,
+        "congestion_label": str,
+        "traffic_source": str,              # "live" | "forecast" | "forecast_quota", missing before forecasts
+        "forecast_confidence": float,       # forecasts only
+    },
+    "route_segments": {
+        "mission_id": int,
+        "route_id": str,
+        "timestamp": int,
+        "sequence": int,
+        "latitude": float,
+        "longitude": float,
+    },
+    "vehicle_telemetry": {
+        "vehicle_id": str,
+        "route_id": str,
+        "sequence": int,
+        "timestamp": int,
+        "latitude": float,
+        "longitude": float,
+        "status": str,
+        "progress_pct": int,
+        "speed_kmh": float,
+    },
+    "pipeline_span": {
+        "trace_id": str,
+        "mission_id": int,
+        "vehicle_id": str,
+        "stage": str,
+        "start_ts": int,
+        "duration_ms": float,
+        "payload_bytes": int,
+        "outcome": str,
+        "error": str,
+    },
+}
+
+# ---------- Invocation profiling (opt-in) ----------
+# HERO_UDF_PROFILING=1          record per-invocation stats, read them with get_udf_stats
+# HERO_UDF_CPROFILE_SAMPLE=0.05 share of profiled invocations also run under cProfile
+# Stats live in the worker process: a recycled worker starts again from a cold call.
+_PROFILING = os.environ.get("HERO_UDF_PROFILING", "0").lower() in ("1", "true", "yes")
+_CPROFILE_SAMPLE = float(os.environ.get("HERO_UDF_CPROFILE_SAMPLE", "0") or 0)
+_PROCESS_START = time.time()
+_STATS_LOCK = threading.Lock()
+_STATS: Dict[str, Dict] = {}
+_COLD: Dict[str, Dict] = {}         # first call of each UDF in this worker, kept across get_udf_stats(reset=True)
+_PROFILES = deque(maxlen=20)
+_io_local = threading.local()
+
+
+class _io_time:
+    """Accumulates time spent in external I/O (http, amqp) for the current invocation."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        acc = getattr(_io_local, "acc", None)
+        if acc is not None:
+            acc[self.kind] = acc.get(self.kind, 0.0) + (time.perf_counter() - self.t0) * 1000
+        return False
+
+
+def _json_size(obj) -> int:
+    try:
+        return len(json.dumps(obj, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _profiled(fn):
+    """Wraps a UDF to record cold/warm calls, wall vs I/O time, payload sizes and sampled cProfile dumps."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(params: dict) -> dict:
+        if not _PROFILING:
+            return fn(params)
+
+        _io_local.acc = {}
+        profiler = cProfile.Profile() if _CPROFILE_SAMPLE and random.random() < _CPROFILE_SAMPLE else None
+        outcome, result = "ok", None
+        t0 = time.perf_counter()
+        try:
+            if profiler:
+                result = profiler.runcall(fn, params)
+            else:
+                result = fn(params)
+            return result
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            wall_ms = (time.perf_counter() - t0) * 1000
+            io_ms = _io_local.acc
+            _io_local.acc = None
+            with _STATS_LOCK:
+                st = _STATS.setdefault(name, {
+                    "calls": 0, "cold_calls": 0, "errors": 0,
+                    # last 1000 calls, wall and I/O side by side so their averages cover the same window
+                    "wall_ms": deque(maxlen=1000), "io_ms": deque(maxlen=1000), "request_bytes": 0, "response_bytes": 0,
+                })
+                cold = name not in _COLD
+                st["calls"] += 1
+                st["cold_calls"] += int(cold)
+                st["errors"] += int(outcome == "error")
+                st["wall_ms"].append(wall_ms)
+                st["io_ms"].append(io_ms)
+                st["request_bytes"] += _json_size(params)
+                st["response_bytes"] += _json_size(result) if result is not None else 0
+                if cold:
+                    _COLD[name] = {"cold_wall_ms": round(wall_ms, 2),
+                                   "cold_after_process_start_s": round(time.time() - _PROCESS_START, 2)}
+            if profiler:
+                buf = io.StringIO()
+                pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(20)
+                _PROFILES.append({"function": name, "timestamp": _epoch_ms(), "wall_ms": round(wall_ms, 2), "stats": buf.getvalue()})
+
+    return wrapper
+
+
 @udf.function()
+@_profiled
 def get_route(params: dict) -> dict:
     """
     Fetches route with or without traffic data from Google Maps API.
@@ -28,6 +180,7 @@ def get_route(params: dict) -> dict:
       dest_lon: float
       api_key: str
       routing_preference: str (TRAFFIC_AWARE_OPTIMAL, TRAFFIC_AWARE, TRAFFIC_UNAWARE)
+      response_format: str (optional) "full" (default), "polyline" or "packed"
 
     Returns:
       {
@@ -41,6 +194,12 @@ def get_route(params: dict) -> dict:
         "congestion_score": float,
         "congestion_label": str
       }
+    "polyline" drops coordinates and segments (decode the polyline client-side).
+    "packed" replaces them with base64 little-endian arrays (see _pack_route):
+      "coordinates_f32": lat,lon pairs as float32
+      "segments_packed": start,end,category triplets as int16 (int32 if indices overflow, see "segments_dtype")
+      "speed_categories": category names indexed by the third value
+    Clients decode both with unpack_route in hero_trajectory.
     """
     logging.info("HERO | Fetching route from Google Routes API")
 
@@ -51,7 +210,10 @@ def get_route(params: dict) -> dict:
     dest_lon = params.get("dest_lon")
     api_key = params.get("api_key")
     routing_pref = params.get("routing_preference", "TRAFFIC_AWARE_OPTIMAL")
+    response_format = params.get("response_format", "full")
 
+    if response_format not in _ROUTE_FORMATS:
+        raise ValueError(f"Unknown response_format '{response_format}', expected one of {_ROUTE_FORMATS}")
     if not all([origin_lat, origin_lon, dest_lat, dest_lon, api_key]):
         raise ValueError("Missing required parameters: origin_lat, origin_lon, dest_lat, dest_lon, api_key")
 
@@ -81,7 +243,8 @@ def get_route(params: dict) -> dict:
 
     # --- Request ---
     try:
-        resp = requests.post(url, headers=headers, json=body, timeout=10)
+        with _io_time("http"):
+            resp = requests.post(url, headers=headers, json=body, timeout=10)
         resp.raise_for_status()
         data = resp.json()
         if not data.get("routes"):
@@ -125,23 +288,215 @@ def get_route(params: dict) -> dict:
         else:
             congestion_label = "HIGH"
 
-        return {
+        _route_cache_put(origin_lat, origin_lon, dest_lat, dest_lon, routing_pref, eta_min, distance_m)
+
+        result = {
             "route_id": route_id,
             "routing_mode": routing_pref,
             "eta_min": eta_min,
             "distance_m": distance_m,
             "polyline": polyline_encoded,
-            "coordinates": coordinates,
-            "segments": segments,
             "congestion_score": congestion_score,
             "congestion_label": congestion_label
         }
+        if response_format == "full":
+            result["coordinates"] = coordinates
+            result["segments"] = segments
+        elif response_format == "packed":
+            result.update(_pack_route(coordinates, segments))
+        return result
 
     except requests.exceptions.RequestException as e:
         logging.error(f"Route fetch failed: {e}")
         raise
 
 
+_ROUTE_FORMATS = ("full", "polyline", "packed")
+_SPEED_CATEGORIES = ["NORMAL", "SLOW", "TRAFFIC_JAM"]
+
+
+def _b64_array(typecode: str, values) -> str:
+    arr = array(typecode, values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return base64.b64encode(arr.tobytes()).decode("ascii")
+
+
+def _pack_route(coordinates: List[Tuple[float, float]], segments: List[Dict]) -> Dict:
+    """Route geometry as base64 little-endian arrays: float32 lat/lon pairs, int16 (start, end, category) triplets."""
+    categories = list(_SPEED_CATEGORIES)
+    triplets = []
+    for seg in segments:
+        if seg["speed_category"] not in categories:
+            categories.append(seg["speed_category"])
+        triplets.extend((seg["start"], seg["end"], categories.index(seg["speed_category"])))
+    seg_type = "h" if all(-32768 <= v <= 32767 for v in triplets) else "i"
+    return {
+        "coordinates_f32": _b64_array("f", [v for pt in coordinates for v in pt]),
+        "segments_packed": _b64_array(seg_type, triplets),
+        "segments_dtype": "int16" if seg_type == "h" else "int32",
+        "speed_categories": categories,
+    }
+
+
+# ---------- Route cache (ETA / distance per origin-destination pair) ----------
+# Shared by get_route and get_route_matrix within a worker; coordinates rounded to ~10 m.
+_ROUTE_CACHE_TTL_S = 120.0
+_ROUTE_CACHE_MAX = 10_000
+_ROUTE_CACHE: Dict[Tuple, Tuple[float, float, int]] = {}
+_ROUTE_CACHE_LOCK = threading.Lock()
+
+
+def _route_key(o_lat, o_lon, d_lat, d_lon, routing_pref) -> Tuple:
+    return (round(float(o_lat), 4), round(float(o_lon), 4), round(float(d_lat), 4), round(float(d_lon), 4), routing_pref)
+
+
+def _route_cache_put(o_lat, o_lon, d_lat, d_lon, routing_pref, eta_min, distance_m):
+    with _ROUTE_CACHE_LOCK:
+        if len(_ROUTE_CACHE) >= _ROUTE_CACHE_MAX:
+            _ROUTE_CACHE.pop(next(iter(_ROUTE_CACHE)))
+        _ROUTE_CACHE[_route_key(o_lat, o_lon, d_lat, d_lon, routing_pref)] = (time.time(), float(eta_min), int(distance_m))
+
+
+def _route_cache_get(o_lat, o_lon, d_lat, d_lon, routing_pref, ttl_s: float):
+    with _ROUTE_CACHE_LOCK:
+        hit = _ROUTE_CACHE.get(_route_key(o_lat, o_lon, d_lat, d_lon, routing_pref))
+    if hit and time.time() - hit[0] < ttl_s:
+        return hit[1], hit[2]
+    return None
+
+
+# computeRouteMatrix limits: 625 elements per request, 100 with TRAFFIC_AWARE_OPTIMAL, at most 25 waypoints per side here
+_MATRIX_MAX_ELEMENTS = {"TRAFFIC_AWARE_OPTIMAL": 100}
+_MATRIX_DEFAULT_ELEMENTS = 625
+_MATRIX_MAX_SIDE = 25
+
+
+def _matrix_chunks(origin_idx: List[int], dest_idx: List[int], routing_pref: str) -> List[Tuple[List[int], List[int]]]:
+    """Splits origins x destinations into blocks that respect the per-request element limit."""
+    limit = _MATRIX_MAX_ELEMENTS.get(routing_pref, _MATRIX_DEFAULT_ELEMENTS)
+    d_block = min(len(dest_idx), _MATRIX_MAX_SIDE, limit)
+    o_block = max(1, min(_MATRIX_MAX_SIDE, limit // d_block))
+    return [(origin_idx[i:i + o_block], dest_idx[j:j + d_block])
+            for i in range(0, len(origin_idx), o_block)
+            for j in range(0, len(dest_idx), d_block)]
+
+
+def _compute_matrix_chunk(origins, destinations, api_key: str, routing_pref: str) -> List[Dict]:
+    """One computeRouteMatrix call; returns the raw elements (originIndex/destinationIndex local to the chunk)."""
+    def waypoint(p):
+        return {"waypoint": {"location": {"latLng": {"latitude": float(p[0]), "longitude": float(p[1])}}}}
+
+    body = {
+        "origins": [waypoint(p) for p in origins],
+        "destinations": [waypoint(p) for p in destinations],
+        "travelMode": "DRIVE",
+    }
+    if routing_pref in ("TRAFFIC_AWARE", "TRAFFIC_AWARE_OPTIMAL"):
+        body["routingPreference"] = routing_pref
+        body["departureTime"] = (datetime.utcnow() + timedelta(minutes=1)).isoformat("T") + "Z"
+    else:
+        body["routingPreference"] = "TRAFFIC_UNAWARE"
+
+    resp = requests.post(
+        "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix",
+        headers={
+            "Content-Type": "application/json",
+            "X-Goog-Api-Key": api_key,
+            "X-Goog-FieldMask": "originIndex,destinationIndex,duration,distanceMeters,condition,status",
+        },
+        json=body,
+        timeout=20,
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+@udf.function()
+@_profiled
+def get_route_matrix(params: dict) -> dict:
+    """
+    ETAs and distances for every origin x destination pair with Google computeRouteMatrix.
+
+    params:
+      origins:            list[[lat, lon]]  e.g. vehicle positions
+      destinations:       list[[lat, lon]]  e.g. incidents or hospitals
+      api_key:            str
+      routing_preference: str   TRAFFIC_AWARE_OPTIMAL, TRAFFIC_AWARE or TRAFFIC_UNAWARE (default TRAFFIC_AWARE_OPTIMAL)
+      cache_ttl_s:        float Reuse ETAs of pairs computed in the last cache_ttl_s seconds (optional, default 120, 0 disables)
+      max_concurrency:    int   Parallel API requests (optional, default 8)
+
+    Returns:
+      {
+        "shape": [n_origins, n_destinations],
+        "eta_min": list[float|None],     # row-major, eta_min[i * n_destinations + j] is origin i -> destination j
+        "distance_m": list[int|None],    # same layout, None where no route exists
+        "routing_mode": str,
+        "requests": int, "elements_requested": int, "cache_hits": int
+      }
+    """
+    origins = _get_param(params, "origins") or []
+    destinations = _get_param(params, "destinations") or []
+    api_key = _get_param(params, "api_key")
+    routing_pref = _get_param(params, "routing_preference", "TRAFFIC_AWARE_OPTIMAL")
+    cache_ttl_s = float(_get_param(params, "cache_ttl_s", _ROUTE_CACHE_TTL_S))
+    max_concurrency = int(_get_param(params, "max_concurrency", 8))
+
+    if not origins or not destinations or not api_key:
+        raise ValueError("Missing required parameters: origins, destinations, api_key")
+
+    n_o, n_d = len(origins), len(destinations)
+    eta: List[Any] = [None] * (n_o * n_d)
+    dist: List[Any] = [None] * (n_o * n_d)
+
+    # --- Known pairs from the cache; only rows/columns with a missing pair are requested ---
+    cache_hits = 0
+    missing_o, missing_d = set(), set()
+    for i, o in enumerate(origins):
+        for j, d in enumerate(destinations):
+            hit = _route_cache_get(o[0], o[1], d[0], d[1], routing_pref, cache_ttl_s) if cache_ttl_s > 0 else None
+            if hit:
+                # the cache keeps the unrounded ETA (shared with get_route): same precision as fresh elements
+                eta[i * n_d + j], dist[i * n_d + j] = round(hit[0], 2), hit[1]
+                cache_hits += 1
+            else:
+                missing_o.add(i)
+                missing_d.add(j)
+
+    chunks = _matrix_chunks(sorted(missing_o), sorted(missing_d), routing_pref) if missing_o else []
+
+    def run_chunk(chunk):
+        o_idx, d_idx = chunk
+        elements = _compute_matrix_chunk([origins[i] for i in o_idx], [destinations[j] for j in d_idx], api_key, routing_pref)
+        return o_idx, d_idx, elements
+
+    # --- Chunks in parallel ---
+    if chunks:
+        with _io_time("http"), ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(chunks)))) as pool:
+            results = list(pool.map(run_chunk, chunks))
+        for o_idx, d_idx, elements in results:
+            for el in elements:
+                i, j = o_idx[el.get("originIndex", 0)], d_idx[el.get("destinationIndex", 0)]
+                if el.get("condition") != "ROUTE_EXISTS" or "duration" not in el:
+                    continue
+                eta_min = int(el["duration"].rstrip("s")) / 60
+                distance_m = int(el.get("distanceMeters", 0))
+                eta[i * n_d + j], dist[i * n_d + j] = round(eta_min, 2), distance_m
+                _route_cache_put(origins[i][0], origins[i][1], destinations[j][0], destinations[j][1],
+                                 routing_pref, eta_min, distance_m)
+
+    logging.info(f"Route matrix {n_o}x{n_d}: {len(chunks)} requests, {cache_hits} cached pairs")
+    return {
+        "shape": [n_o, n_d],
+        "eta_min": eta,
+        "distance_m": dist,
+        "routing_mode": routing_pref,
+        "requests": len(chunks),
+        "elements_requested": sum(len(o) * len(d) for o, d in chunks),
+        "cache_hits": cache_hits,
+    }
+
+
 def _get_param(params: dict, key: str, default=None):
     """Helper to extract parameter value from both flat and {value:...} formats."""
     v = params.get(key, default)
@@ -150,6 +505,38 @@ def _get_param(params: dict, key: str, default=None):
     return v
 
 
+def _epoch_ms() -> int:
+    """Current UTC time as epoch milliseconds."""
+    return int(time.time() * 1000)
+
+
+def _apply_schema(event: Dict, schema_name: str) -> Dict:
+    """
+    Coerce an event to its typed schema and stamp schema_version.
+    ISO timestamps are converted to epoch milliseconds; missing fields stay missing, extra fields are kept.
+    """
+    schema = EVENT_SCHEMAS.get(schema_name)
+    if schema is None:
+        raise ValueError(f"Unknown event schema '{schema_name}', expected one of {sorted(EVENT_SCHEMAS)}")
+
+    out = dict(event)
+    for field, typ in schema.items():
+        value = out.get(field)
+        if value is None:
+            continue
+        if field == "timestamp" and isinstance(value, str):
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            value = int(dt.timestamp() * 1000)
+        try:
+            out[field] = typ(round(value) if typ is int and isinstance(value, float) else value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Field '{field}' of {schema_name} event is not {typ.__name__}: {value!r}") from e
+    out["schema_version"] = EVENT_SCHEMA_VERSION
+    return out
+
+
 def _normalize_events(events_param: Any) -> List[Dict]:
     """Normalize events parameter to a list of dictionaries."""
     if isinstance(events_param, list):
@@ -160,6 +547,7 @@ def _normalize_events(events_param: Any) -> List[Dict]:
 
 
 @udf.function()
+@_profiled
 def publish_events(params: dict) -> dict:
     """
     Publishes events to Azure Event Hubs.
@@ -168,6 +556,8 @@ def publish_events(params: dict) -> dict:
       connection_string: str - Event Hubs-compatible connection string
       events: list[dict] or dict - Event(s) to publish
       partition_key: str (optional) - Partition key for routing
+      schema: str (optional) - Typed event schema (route_analysis, route_segments, vehicle_telemetry, pipeline_span);
+              events are coerced to it and stamped with schema_version
     
     Returns:
       dict with 'published' count and 'status'
@@ -178,6 +568,7 @@ def publish_events(params: dict) -> dict:
     conn_str = _get_param(params, "connection_string")
     events_param = _get_param(params, "events")
     partition_key = _get_param(params, "partition_key", None)
+    schema_name = _get_param(params, "schema", None)
 
     # Validate required parameters
     if not conn_str or events_param is None:
@@ -189,6 +580,9 @@ def publish_events(params: dict) -> dict:
     if not events:
         raise ValueError("Events list cannot be empty")
 
+    if schema_name:
+        events = [_apply_schema(event, schema_name) for event in events]
+
     # Clean connection string (remove whitespace/newlines)
     conn_str = str(conn_str).strip()
 
@@ -215,13 +609,15 @@ def publish_events(params: dict) -> dict:
                 event_batch.add(event_data)
             except ValueError:
                 # Batch is full, send it and create a new one
-                producer.send_batch(event_batch)
+                with _io_time("amqp"):
+                    producer.send_batch(event_batch)
                 event_batch = producer.create_batch(partition_key=partition_key)
                 event_batch.add(event_data)
         
         # Send remaining events
         if len(event_batch) > 0:
-            producer.send_batch(event_batch)
+            with _io_time("amqp"):
+                producer.send_batch(event_batch)
         
         logging.info(f"Successfully published {len(event_data_list)} event(s)")
         sys.stdout.flush()
@@ -242,6 +638,7 @@ def publish_events(params: dict) -> dict:
 
 
 @udf.function()
+@_profiled
 def publish_vehicle_telemetry(params: dict) -> dict:
     """
     Publish simulated vehicle telemetry to Event Hub.
@@ -294,7 +691,7 @@ def publish_vehicle_telemetry(params: dict) -> dict:
                 "vehicle_id": vehicle_id,
                 "route_id": route_id,
                 "sequence": seq,
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": _epoch_ms(),
                 "latitude": lat,
                 "longitude": lon,
                 "status": local_status,
@@ -305,9 +702,11 @@ def publish_vehicle_telemetry(params: dict) -> dict:
                 event_payload["speed_kmh"] = float(speed_kmh)
             if isinstance(extra, dict) and extra:
                 event_payload.update(extra)
+            event_payload = _apply_schema(event_payload, "vehicle_telemetry")
 
             # send one-by-one to preserve order and simplify error handling
-            producer.send_batch([EventData(json.dumps(event_payload))], partition_key=partition_key)
+            with _io_time("amqp"):
+                producer.send_batch([EventData(json.dumps(event_payload))], partition_key=partition_key)
 
         log.info(f"Published {total} telemetry events for {vehicle_id} [{first_seq}..{last_seq}]")
         return {"status": "success", "count": total, "first_seq": first_seq, "last_seq": last_seq}
@@ -322,7 +721,31 @@ def publish_vehicle_telemetry(params: dict) -> dict:
             except Exception:
                 pass
 
+_SHORT_URL_CACHE: Dict[str, str] = {}
+_SHORT_URL_CACHE_SIZE = 256
+
+
+def _shorten_url(url: str, timeout: float = 3.0) -> str:
+    """Shortens a URL with is.gd, cached per worker; falls back to the original URL on error or timeout."""
+    cached = _SHORT_URL_CACHE.get(url)
+    if cached:
+        return cached
+    try:
+        with _io_time("http"):
+            resp = requests.get("https://is.gd/create.php", params={"format": "simple", "url": url}, timeout=timeout)
+        resp.raise_for_status()
+        short = resp.text.strip()
+    except Exception as e:
+        logging.warning(f"URL shortener failed, sending full URL: {e}")
+        return url
+    if len(_SHORT_URL_CACHE) >= _SHORT_URL_CACHE_SIZE:
+        _SHORT_URL_CACHE.pop(next(iter(_SHORT_URL_CACHE)))
+    _SHORT_URL_CACHE[url] = short
+    return short
+
+
 @udf.function()
+@_profiled
 def send_sms_with_map(params: dict) -> dict:
     """
     Sends an SMS containing a Google Static Map link for the chosen route.
@@ -337,6 +760,7 @@ def send_sms_with_map(params: dict) -> dict:
       polyline:        str   Encoded polyline for path (preferred)
       coords:          list  Optional list of {lat,lon} if polyline not provided
       decision:        str   Hero decision
+      short_url:       str   Already shortened map URL (optional, skips the shortener)
     """
     to_phone      = params.get("to_phone")
     text_prefix   = params.get("text_prefix", "HERO alert:")
@@ -347,6 +771,7 @@ def send_sms_with_map(params: dict) -> dict:
     polyline      = params.get("polyline")
     coords        = params.get("coords", None)
     decision      = params.get("decision")
+    short_map_url = params.get("short_url")
 
     if not all([to_phone, gmaps_api_key, twilio_sid, twilio_token, twilio_from]) or (not polyline and not coords):
         raise ValueError("Missing required parameters.")
@@ -383,10 +808,8 @@ def send_sms_with_map(params: dict) -> dict:
     #     short_map_url = requests.get("https://tinyurl.com/api-create.php", params={"url": static_map_url}).text
     # except Exception: pass
 
-    try:
-        short_map_url = requests.get("https://is.gd/create.php", params={"format": "simple", "url": static_map_url}).text
-    except Exception:
-        short_map_url = static_map_url  # fallback to original
+    if not short_map_url:
+        short_map_url = _shorten_url(static_map_url)
 
     # body = f"{text_prefix} Suggested route map: {short_map_url}"
     body = f"""Emergency Dispatch
@@ -398,12 +821,13 @@ def send_sms_with_map(params: dict) -> dict:
 # https://demo.twilio.com/welcome/sms/reply/
     # Twilio SMS
     tw_url = f"https://api.twilio.com/2010-04-01/Accounts/{twilio_sid}/Messages.json"
-    resp = requests.post(
-        tw_url,
-        data={"To": to_phone, "From": twilio_from, "Body": body},
-        auth=(twilio_sid, twilio_token),
-        timeout=15
-    )
+    with _io_time("http"):
+        resp = requests.post(
+            tw_url,
+            data={"To": to_phone, "From": twilio_from, "Body": body},
+            auth=(twilio_sid, twilio_token),
+            timeout=15
+        )
     try:
         resp.raise_for_status()
     except Exception as e:
@@ -412,3 +836,67 @@ def send_sms_with_map(params: dict) -> dict:
 
     sid = resp.json().get("sid", "")
     return {"status": "sent", "twilio_sid": sid, "map_url": short_map_url}
+
+
+@udf.function()
+def get_udf_stats(params: dict) -> dict:
+    """
+    Returns the invocation stats recorded by the profiling wrapper in this worker.
+
+    params:
+      reset:            bool  Clear the stats after reading them (optional, default False)
+      include_profiles: bool  Include the sampled cProfile dumps (optional, default False)
+
+    Returns:
+      {
+        "profiling_enabled": bool,
+        "process_uptime_s": float,
+        "functions": {name: {calls, cold_calls, errors, wall_ms_avg/p50/p95/max,
+                             io_ms_avg: {http, amqp}, cpu_ms_avg, request_bytes_avg, response_bytes_avg, ...}},
+                     (wall, I/O and CPU over the last 1000 calls; cold_* survive a reset, a worker has one cold call)
+        "profiles": list[{function, timestamp, wall_ms, stats}]
+      }
+    """
+    reset = bool(_get_param(params or {}, "reset", False))
+    include_profiles = bool(_get_param(params or {}, "include_profiles", False))
+
+    functions = {}
+    with _STATS_LOCK:
+        for name, st in _STATS.items():
+            walls = sorted(st["wall_ms"])
+            n = len(walls)
+            calls = st["calls"] or 1
+            io_total = {}
+            for acc in st["io_ms"]:
+                for kind, ms in acc.items():
+                    io_total[kind] = io_total.get(kind, 0.0) + ms
+            io_avg = {kind: round(ms / n, 2) for kind, ms in io_total.items()}
+            wall_avg = sum(walls) / n if n else 0.0
+            cold = _COLD.get(name, {})
+            functions[name] = {
+                "calls": st["calls"],
+                "cold_calls": st["cold_calls"],
+                "errors": st["errors"],
+                "cold_wall_ms": cold.get("cold_wall_ms"),
+                "cold_after_process_start_s": cold.get("cold_after_process_start_s"),
+                "wall_ms_avg": round(wall_avg, 2),
+                "wall_ms_p50": round(walls[n // 2], 2) if n else None,
+                "wall_ms_p95": round(walls[min(n - 1, int(n * 0.95))], 2) if n else None,
+                "wall_ms_max": round(walls[-1], 2) if n else None,
+                "io_ms_avg": io_avg,
+                # everything that is not external I/O: serialization, decoding, local CPU
+                "cpu_ms_avg": round(max(0.0, wall_avg - sum(io_avg.values())), 2),
+                "request_bytes_avg": round(st["request_bytes"] / calls),
+                "response_bytes_avg": round(st["response_bytes"] / calls),
+            }
+        profiles = list(_PROFILES) if include_profiles else []
+        if reset:
+            _STATS.clear()
+            _PROFILES.clear()
+
+    return {
+        "profiling_enabled": _PROFILING,
+        "process_uptime_s": round(time.time() - _PROCESS_START, 2),
+        "functions": functions,
+        "profiles": profiles,
+    }
@@ -0,0 +1,408 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     },
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the engine with: %run hero_geofence
+benchmark_geofence = False
+geofences_path = "/lakehouse/default/Files/hero/geofences.json"   # hospitals and restricted zones, optional
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_position_index
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import json
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger("hero-geofence")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Streaming geofence engine
+# ----------------------------------------------------
+# - geofences: circles (incidents, hospitals) and polygons (restricted zones), registered in every
+#   cell of a uniform lat/lon grid their bounding box (+ hysteresis) overlaps
+# - a fix is tested only against the fences of its cell and the fences the vehicle is already in,
+#   so the cost per fix does not depend on how many fences are active
+# - hysteresis: enter inside the shape, exit only beyond hysteresis_m outside it, so GPS jitter on the
+#   border does not produce enter/exit storms
+# - events: enter, exit, dwell (inside for dwell_s, once per visit) and arrived (the vehicle's assigned
+#   destination reached: inside and slower than arrive_speed_kmh, or inside for arrive_after_s)
+# ====================================================
+
+class Geofence:
+    __slots__ = ("fence_id", "kind", "lat", "lon", "kx", "radius_m", "xy", "hysteresis_m", "dwell_s", "cells", "meta")
+
+    def __init__(self, fence_id, kind, lat, lon, radius_m=None, xy=None, hysteresis_m=25.0, dwell_s=120.0, meta=None):
+        self.fence_id, self.kind = fence_id, kind
+        self.lat, self.lon = lat, lon          # center (circle) or first vertex (polygon): origin of the local frame
+        self.kx = METERS_PER_DEG_LAT * math.cos(math.radians(lat))
+        self.radius_m = radius_m
+        self.xy = xy                           # polygon vertices in meters around (lat, lon), None for circles
+        self.hysteresis_m, self.dwell_s = hysteresis_m, dwell_s
+        self.cells = ()
+        self.meta = meta or {}
+
+    def _local(self, lat: float, lon: float):
+        """Equirectangular meters around the fence origin (exact enough at fence scale)."""
+        return (lon - self.lon) * self.kx, (lat - self.lat) * METERS_PER_DEG_LAT
+
+    def distance_outside(self, lat: float, lon: float) -> float:
+        """0 inside the fence, else meters to its border."""
+        x, y = self._local(lat, lon)
+        if self.xy is None:
+            return max(0.0, math.hypot(x, y) - self.radius_m)
+        inside, best = False, float("inf")
+        (x1, y1) = self.xy[-1]
+        for x2, y2 in self.xy:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+            dx, dy = x2 - x1, y2 - y1
+            t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy))) if dx or dy else 0.0
+            best = min(best, math.hypot(x - x1 - t * dx, y - y1 - t * dy))
+            x1, y1 = x2, y2
+        return 0.0 if inside else best
+
+
+class GeofenceEngine:
+    """
+    Per-vehicle geofence state fed by telemetry fixes; process() / ingest() return the events.
+    Out-of-order fixes (older than the vehicle's last one) are ignored.
+    Thread-safe: one lock around fence changes and fix processing.
+    """
+
+    def __init__(self, cell_size_deg: float = 0.005, arrive_speed_kmh: float = 10.0, arrive_after_s: float = 20.0):
+        self.cell_size_deg = float(cell_size_deg)
+        self.arrive_speed_kmh, self.arrive_after_s = arrive_speed_kmh, arrive_after_s
+        self._lock = threading.RLock()
+        self._fences = {}
+        self._grid = {}               # cell key -> [fence_id]
+        self._vehicles = {}           # vehicle_id -> {"ts", "inside": {fence_id: visit}, "targets": set}
+        self._occupants = {}          # fence_id -> set of vehicle_ids inside
+        self._assigned = {}           # fence_id -> set of vehicle_ids heading to it
+        self.fixes = 0
+        self.events = 0
+
+    # ---------- fences ----------
+    def _cell_key(self, lat: float, lon: float) -> int:
+        return (int(math.floor(lat / self.cell_size_deg)) << 32) ^ (int(math.floor(lon / self.cell_size_deg)) & 0xFFFFFFFF)
+
+    def _register(self, fence: Geofence, lat0, lat1, lon0, lon1):
+        margin = fence.hysteresis_m / METERS_PER_DEG_LAT
+        margin_lon = fence.hysteresis_m / (METERS_PER_DEG_LAT * max(0.01, math.cos(math.radians(fence.lat))))
+        cy0, cy1 = int(math.floor((lat0 - margin) / self.cell_size_deg)), int(math.floor((lat1 + margin) / self.cell_size_deg))
+        cx0, cx1 = int(math.floor((lon0 - margin_lon) / self.cell_size_deg)), int(math.floor((lon1 + margin_lon) / self.cell_size_deg))
+        with self._lock:
+            if fence.fence_id in self._fences:
+                self.remove(fence.fence_id)
+            fence.cells = tuple((cy << 32) ^ (cx & 0xFFFFFFFF) for cy in range(cy0, cy1 + 1) for cx in range(cx0, cx1 + 1))
+            for key in fence.cells:
+                self._grid.setdefault(key, []).append(fence.fence_id)
+            self._fences[fence.fence_id] = fence
+            self._occupants[fence.fence_id] = set()
+        return fence
+
+    def add_circle(self, fence_id: str, lat: float, lon: float, radius_m: float, kind: str = "zone",
+                   hysteresis_m: float = 25.0, dwell_s: float = 120.0, meta: dict = None) -> Geofence:
+        fence = Geofence(fence_id, kind, lat, lon, radius_m=radius_m, hysteresis_m=hysteresis_m, dwell_s=dwell_s, meta=meta)
+        dlat = radius_m / METERS_PER_DEG_LAT
+        dlon = radius_m / (METERS_PER_DEG_LAT * max(0.01, math.cos(math.radians(lat))))
+        return self._register(fence, lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+
+    def add_polygon(self, fence_id: str, vertices, kind: str = "restricted",
+                    hysteresis_m: float = 25.0, dwell_s: float = 120.0, meta: dict = None) -> Geofence:
+        """vertices: [(lat, lon), ...], open or closed ring."""
+        pts = [(float(a), float(b)) for a, b in vertices]
+        if len(pts) > 1 and pts[0] == pts[-1]:
+            pts = pts[:-1]
+        if len(pts) < 3:
+            raise ValueError(f"Polygon {fence_id} needs at least 3 vertices")
+        fence = Geofence(fence_id, kind, pts[0][0], pts[0][1], hysteresis_m=hysteresis_m, dwell_s=dwell_s, meta=meta)
+        fence.xy = [fence._local(a, b) for a, b in pts]
+        lats, lons = [p[0] for p in pts], [p[1] for p in pts]
+        return self._register(fence, min(lats), max(lats), min(lons), max(lons))
+
+    def remove(self, fence_id: str) -> bool:
+        """Drops the fence and its visits without exit events."""
+        with self._lock:
+            fence = self._fences.pop(fence_id, None)
+            if fence is None:
+                return False
+            for key in fence.cells:
+                bucket = self._grid.get(key)
+                if bucket is not None:
+                    bucket.remove(fence_id)
+                    if not bucket:
+                        del self._grid[key]
+            for vehicle_id in self._occupants.pop(fence_id, ()):
+                self._vehicles[vehicle_id]["inside"].pop(fence_id, None)
+            for vehicle_id in self._assigned.pop(fence_id, ()):
+                self._vehicles[vehicle_id]["targets"].discard(fence_id)
+            return True
+
+    def assign(self, vehicle_id: str, fence_id: str):
+        """fence_id is a destination of vehicle_id: reaching it emits 'arrived' (once)."""
+        with self._lock:
+            self._state(vehicle_id)["targets"].add(fence_id)
+            self._assigned.setdefault(fence_id, set()).add(vehicle_id)
+
+    def __len__(self):
+        return len(self._fences)
+
+    # ---------- fixes ----------
+    def _state(self, vehicle_id: str) -> dict:
+        state = self._vehicles.get(vehicle_id)
+        if state is None:
+            state = self._vehicles[vehicle_id] = {"ts": float("-inf"), "inside": {}, "targets": set()}
+        return state
+
+    def process(self, vehicle_id: str, lat: float, lon: float, ts=None, speed_kmh: float = None,
+                route_id: str = None) -> list:
+        ts_s = to_epoch_seconds(ts)
+        out = []
+        with self._lock:
+            state = self._state(vehicle_id)
+            if ts_s < state["ts"]:
+                return out
+            state["ts"] = ts_s
+            self.fixes += 1
+            inside = state["inside"]
+            candidates = self._grid.get(self._cell_key(lat, lon), ())
+            if inside:
+                candidates = set(candidates).union(inside)
+
+            for fence_id in candidates:
+                fence = self._fences[fence_id]
+                visit = inside.get(fence_id)
+                d = fence.distance_outside(lat, lon)
+                if visit is None:
+                    if d > 0.0:
+                        continue
+                    visit = inside[fence_id] = {"since": ts_s, "dwell": False, "arrived": False}
+                    self._occupants[fence_id].add(vehicle_id)
+                    out.append(self._event("enter", vehicle_id, fence, route_id, ts_s, lat, lon))
+                elif d > fence.hysteresis_m:
+                    del inside[fence_id]
+                    self._occupants[fence_id].discard(vehicle_id)
+                    out.append(self._event("exit", vehicle_id, fence, route_id, ts_s, lat, lon, ts_s - visit["since"]))
+                    continue
+                stay = ts_s - visit["since"]
+                if not visit["dwell"] and stay >= fence.dwell_s:
+                    visit["dwell"] = True
+                    out.append(self._event("dwell", vehicle_id, fence, route_id, ts_s, lat, lon, stay))
+                if fence_id in state["targets"] and not visit["arrived"] and d == 0.0 and (
+                        (speed_kmh is not None and speed_kmh <= self.arrive_speed_kmh) or stay >= self.arrive_after_s):
+                    visit["arrived"] = True
+                    state["targets"].discard(fence_id)
+                    self._assigned[fence_id].discard(vehicle_id)
+                    out.append(self._event("arrived", vehicle_id, fence, route_id, ts_s, lat, lon, stay))
+            self.events += len(out)
+        return out
+
+    @staticmethod
+    def _event(kind, vehicle_id, fence, route_id, ts_s, lat, lon, dwell_s=None) -> dict:
+        return {"event": kind, "vehicle_id": vehicle_id, "fence_id": fence.fence_id, "fence_kind": fence.kind,
+                "route_id": route_id, "timestamp": int(ts_s * 1000), "latitude": lat, "longitude": lon,
+                "dwell_s": None if dwell_s is None else round(dwell_s, 1)}
+
+    def ingest(self, events) -> list:
+        """Telemetry events as published by publish_vehicle_telemetry; returns the geofence events."""
+        out = []
+        for e in events:
+            lat, lon = e.get("latitude"), e.get("longitude")
+            if e.get("vehicle_id") is None or lat is None or lon is None:
+                continue
+            out += self.process(e["vehicle_id"], float(lat), float(lon), ts=e.get("timestamp"),
+                                speed_kmh=e.get("speed_kmh"), route_id=e.get("route_id"))
+        return out
+
+    def evict_stale(self, max_age_s: float, now: float = None) -> int:
+        """Forget vehicles silent for more than max_age_s (no exit events). Returns the number evicted."""
+        now = time.time() if now is None else now
+        with self._lock:
+            stale = [v for v, s in self._vehicles.items() if s["ts"] < now - max_age_s]
+            for vehicle_id in stale:
+                state = self._vehicles.pop(vehicle_id)
+                for fence_id in state["inside"]:
+                    self._occupants[fence_id].discard(vehicle_id)
+                for fence_id in state["targets"]:
+                    self._assigned[fence_id].discard(vehicle_id)
+            return len(stale)
+
+    def occupants(self, fence_id: str) -> list:
+        with self._lock:
+            return sorted(self._occupants.get(fence_id, ()))
+
+    def stats(self) -> dict:
+        return {"fences": len(self._fences), "vehicles": len(self._vehicles), "cells": len(self._grid),
+                "fixes": self.fixes, "events": self.events}
+
+
+def load_geofences(engine: GeofenceEngine, path: str = geofences_path) -> int:
+    """
+    Static fences from a JSON list: {"fence_id", "kind", "lat", "lon", "radius_m"} for circles,
+    {"fence_id", "kind", "polygon": [[lat, lon], ...]} for polygons; optional hysteresis_m, dwell_s.
+    A missing file loads nothing.
+    """
+    try:
+        with open(path) as f:
+            items = json.load(f)
+    except FileNotFoundError:
+        return 0
+    for item in items:
+        opts = {k: item[k] for k in ("hysteresis_m", "dwell_s") if k in item}
+        if "polygon" in item:
+            engine.add_polygon(item["fence_id"], item["polygon"], kind=item.get("kind", "restricted"), **opts)
+        else:
+            engine.add_circle(item["fence_id"], item["lat"], item["lon"], item["radius_m"],
+                              kind=item.get("kind", "zone"), **opts)
+    return len(items)
+
+
+def start_geofence_feed(engine: GeofenceEngine, conn_str: str, on_events, consumer_group: str = "$Default",
+                        max_age_s: float = 900.0, evict_every_s: float = 60.0):
+    """
+    Feeds the engine from the vehicles_telemetry stream in a background thread (as start_eventhub_feed of
+    hero_position_index) and passes every non-empty list of geofence events to on_events.
+    Returns (client, thread); call client.close() to stop.
+    """
+    from azure.eventhub import EventHubConsumerClient
+
+    client = EventHubConsumerClient.from_connection_string(conn_str.strip(), consumer_group=consumer_group)
+    last_evict = [time.time()]
+
+    def on_event_batch(partition_context, events):
+        out = engine.ingest(json.loads(e.body_as_str()) for e in events)
+        if out:
+            on_events(out)
+        if time.time() - last_evict[0] >= evict_every_s:
+            engine.evict_stale(max_age_s)
+            last_evict[0] = time.time()
+
+    def run():
+        try:
+            client.receive_batch(on_event_batch=on_event_batch, starting_position="@latest", max_wait_time=1)
+        except Exception:
+            log.exception("Geofence feed stopped")
+
+    thread = threading.Thread(target=run, name="hero-geofence-feed", daemon=True)
+    thread.start()
+    log.info(f"Geofence feed started ({len(engine)} fences)")
+    return client, thread
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Synthetic load test (benchmark_geofence = True)
+# ----------------------------------------------------
+# Vehicles random-walking, one fix every 5 s, with 1k and 50k active incident circles (plus hospitals and
+# restricted polygons) at the same density: the area grows with the number of fences, as it would when
+# one engine serves more regions. The cost per fix should not move.
+# ====================================================
+
+if benchmark_geofence:
+    rng = np.random.default_rng(41)
+    n_vehicles, n_steps = 5_000, 20
+    results = []
+    for n_fences in (1_000, 50_000):
+        scale = math.sqrt(n_fences / 1_000)              # Milan-sized box (0.15 x 0.25 deg) for 1k fences
+        lo, hi = np.array([45.40, 9.05]), np.array([45.40 + 0.15 * scale, 9.05 + 0.25 * scale])
+        engine = GeofenceEngine()
+        centers = rng.uniform(lo, hi, (n_fences, 2))
+        for i in range(n_fences):
+            engine.add_circle(f"incident-{i}", centers[i, 0], centers[i, 1], 75.0, kind="incident")
+        for i in range(int(20 * scale ** 2)):
+            engine.add_circle(f"hospital-{i}", *rng.uniform(lo, hi), 150.0, kind="hospital")
+        for i in range(int(50 * scale ** 2)):
+            lat0, lon0 = rng.uniform(lo, hi)
+            ang = np.sort(rng.uniform(0, 2 * np.pi, 8))
+            engine.add_polygon(f"zone-{i}", list(zip(lat0 + 0.004 * np.sin(ang), lon0 + 0.006 * np.cos(ang))))
+        ids = [f"AMB-{i:05d}" for i in range(n_vehicles)]
+        for v in range(0, n_vehicles, 10):
+            engine.assign(ids[v], f"incident-{v % n_fences}")
+
+        pos = rng.uniform(lo, hi, (n_vehicles, 2))
+        t = time.time()
+        n_events = 0
+        t0 = time.perf_counter()
+        for step in range(n_steps):
+            pos += rng.normal(0, [0.0004, 0.0006], (n_vehicles, 2))      # ~45 m per 5 s fix
+            speed = rng.uniform(0, 60, n_vehicles)
+            ts_ms = (t + 5 * step) * 1000
+            for v in range(n_vehicles):
+                n_events += len(engine.process(ids[v], pos[v, 0], pos[v, 1], ts=ts_ms, speed_kmh=speed[v]))
+        dt = time.perf_counter() - t0
+        n_fixes = n_vehicles * n_steps
+        results.append({"fences": len(engine), "fixes": n_fixes, "events": n_events,
+                        "fixes_per_s": round(n_fixes / dt), "us_per_fix": round(dt / n_fixes * 1e6, 2)})
+
+    # hysteresis: a vehicle jittering 10 m around a 75 m circle border enters once
+    engine = GeofenceEngine()
+    engine.add_circle("border", 45.46, 9.19, 75.0)
+    jitter = [engine.process("J", 45.46 + (75 + 10 * (-1) ** k) / METERS_PER_DEG_LAT, 9.19, ts=k * 1000) for k in range(20)]
+    assert sum(len(e) for e in jitter) == 1
+    print(results)
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -0,0 +1,348 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     },
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the tiler with: %run hero_hotspot_tiles
+# Schedule this notebook (e.g. hourly) with update_tiles = True to fold new traffic history into the tiles.
+update_tiles = False
+benchmark_tiles = False             # synthetic incremental-vs-batch and query latency check
+hotspot_state_path = "/lakehouse/default/Files/hero/hotspot_tiles/state.parquet"
+hotspot_table = "/lakehouse/default/Tables/dbo/tb_congestion_hotspots"
+hotspot_half_life_days = 7.0
+hotspot_levels = 5                  # zoom 0 = archive cell (~500 m) ... zoom 4 = 16 x 16 cells (~8 km)
+hotspot_min_visits = 3.0            # decayed route visits a tile needs to be published
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_traffic_history
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+log = logging.getLogger("hero-hotspot-tiles")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Congestion hotspot tiles
+# ----------------------------------------------------
+# - source: the traffic archive (hero_traffic_history), i.e. every live get_route response's speed
+#   intervals mapped onto its polyline segments, in meters per (grid cell, speed category)
+# - tiles form a quadtree over the archive grid: zoom z covers 2^z x 2^z cells, tile id = row * 100_000 + col
+#   as for cells, so zoom 0 tiles are the archive cells
+# - per tile: decayed meters NORMAL / SLOW / TRAFFIC_JAM and decayed route visits, all additive, so
+#   partial_fit() folds in only the rows written after the watermark (archive ingestion time, late flushes
+#   included, decayed from their own observed_at) and every zoom is updated the same way
+# - the dashboard reads hotspot_table (one row per published tile, bounds and center included);
+#   tiles_in_view() picks the finest zoom that covers a map view with at most max_tiles tiles
+# ====================================================
+
+TILE_COLUMNS = ["normal_m", "slow_m", "jam_m", "visits"]
+PRUNE_VISITS = 0.05                 # below this (one visit ~4 half lives ago) a tile is dropped from the state
+
+
+def tile_ids(cells, zoom: int) -> np.ndarray:
+    """Tile id at zoom of each archive cell id."""
+    cells = np.asarray(cells, dtype=np.int64)
+    return (cells // 100_000 >> zoom) * 100_000 + (cells % 100_000 >> zoom)
+
+
+def tile_bounds(zoom, tiles):
+    """(lat_min, lon_min, lat_max, lon_max) arrays of tile ids at zoom."""
+    size = CELL_DEG * 2.0 ** np.asarray(zoom)
+    tiles = np.asarray(tiles, dtype=np.int64)
+    lat_min = (tiles // 100_000) * size - 90.0
+    lon_min = (tiles % 100_000) * size - 180.0
+    return lat_min, lon_min, lat_min + size, lon_min + size
+
+
+class HotspotTiler:
+
+    def __init__(self, stats: pd.DataFrame = None, watermark=None, half_life_days: float = hotspot_half_life_days,
+                 levels: int = hotspot_levels, as_of=None):
+        """
+        stats:     TILE_COLUMNS indexed by (zoom, tile)
+        watermark: written_at of the newest archive row folded in, for TrafficArchive.read(since=watermark)
+        as_of:     observed_at the stats are decayed to (defaults to watermark, as in states saved before as_of)
+        """
+        if stats is None:
+            index = pd.MultiIndex.from_arrays([np.array([], np.int8), np.array([], np.int64)], names=["zoom", "tile"])
+            stats = pd.DataFrame({c: np.array([], float) for c in TILE_COLUMNS}, index=index)
+        self.stats = stats
+        self.watermark = pd.Timestamp(watermark) if watermark is not None else None
+        self.as_of = pd.Timestamp(as_of) if as_of is not None else self.watermark
+        self.half_life_days = half_life_days
+        self.levels = levels
+
+    # ---------- incremental update ----------
+    def partial_fit(self, obs: pd.DataFrame):
+        """obs: archive rows (TrafficArchive.read(since=watermark)); late rows are decayed from their own time."""
+        if obs.empty:
+            return self
+        now = obs["observed_at"].max()
+        if self.as_of is not None:
+            if now > self.as_of:
+                self.stats = self.stats * self._decay((now - self.as_of).total_seconds())
+            now = max(now, self.as_of)
+        k = self._decay((now - obs["observed_at"]).dt.total_seconds().to_numpy())
+        length = obs["length_m"].to_numpy(dtype=float) * k
+        category = obs["category"].to_numpy()
+        cells = obs["cell"].to_numpy(dtype=np.int64)
+        route = pd.factorize(obs["route_id"])[0].astype(np.int64)
+        meters = np.column_stack([length * (category == c) for c in range(len(SPEED_CATEGORIES))])
+
+        batch = []
+        for zoom in range(self.levels):
+            tile = tile_ids(cells, zoom)
+            tiles, inverse = np.unique(tile, return_inverse=True)
+            # one visit per route and tile at every zoom, however many cells (and categories) it has there;
+            # tile ids are < 10^10, and a route's rows share one observed_at, so any of its rows carries its decay
+            _, first = np.unique(route * 10 ** 10 + tile, return_index=True)
+            sums = np.column_stack([np.bincount(inverse, weights=meters[:, j], minlength=len(tiles))
+                                    for j in range(meters.shape[1])]
+                                   + [np.bincount(inverse[first], weights=k[first], minlength=len(tiles))])
+            index = pd.MultiIndex.from_arrays([np.full(len(tiles), zoom, np.int8), tiles], names=["zoom", "tile"])
+            batch.append(pd.DataFrame(sums, index=index, columns=TILE_COLUMNS))
+        self.stats = self.stats.add(pd.concat(batch), fill_value=0.0)
+        self.stats = self.stats[self.stats["visits"] >= PRUNE_VISITS]
+        self.as_of = now
+        self.watermark = _advance_watermark(self.watermark, obs)
+        return self
+
+    def _decay(self, age_s):
+        return 0.5 ** (np.asarray(age_s, dtype=float) / 86400.0 / self.half_life_days)
+
+    # ---------- dashboard frame ----------
+    def frame(self, min_visits: float = hotspot_min_visits, as_of=None) -> pd.DataFrame:
+        """
+        One row per tile with at least min_visits, values decayed to as_of (default: the state's as_of).
+        congestion: length-weighted mean of the congestion values (get_route's weights, but its congestion_score
+        averages them per speed interval); visits: decayed distinct routes through the tile;
+        exposure_m: decayed meters driven in SLOW or TRAFFIC_JAM; hotspot_rank: by exposure within the zoom.
+        """
+        k = 1.0
+        if as_of is not None and self.as_of is not None:
+            k = float(self._decay(max(0.0, (pd.Timestamp(as_of) - self.as_of).total_seconds())))
+        s = self.stats[self.stats["visits"] * k >= min_visits]
+        zoom = s.index.get_level_values("zoom").to_numpy()
+        tiles = s.index.get_level_values("tile").to_numpy()
+        meters = s[["normal_m", "slow_m", "jam_m"]].to_numpy() * k
+        observed = meters.sum(axis=1)
+        lat_min, lon_min, lat_max, lon_max = tile_bounds(zoom, tiles)
+        out = pd.DataFrame({
+            "zoom": zoom.astype(np.int8),
+            "tile": tiles,
+            "lat": ((lat_min + lat_max) / 2).astype(np.float32),
+            "lon": ((lon_min + lon_max) / 2).astype(np.float32),
+            "lat_min": lat_min, "lon_min": lon_min, "lat_max": lat_max, "lon_max": lon_max,
+            "observed_m": observed.astype(np.float32),
+            "slow_m": meters[:, 1].astype(np.float32),
+            "jam_m": meters[:, 2].astype(np.float32),
+            "exposure_m": (meters[:, 1] + meters[:, 2]).astype(np.float32),
+            "congestion": np.divide(meters @ CONGESTION_VALUES, observed, out=np.zeros(len(s)),
+                                    where=observed > 0).astype(np.float32),
+            "visits": (s["visits"].to_numpy() * k).astype(np.float32),
+        })
+        out["hotspot_rank"] = out.groupby("zoom")["exposure_m"].rank(ascending=False, method="first").astype(np.int32)
+        out["updated_at"] = pd.Timestamp(as_of or self.as_of or datetime.utcnow())
+        return out.sort_values(["zoom", "hotspot_rank"], ignore_index=True)
+
+    def tiles_in_view(self, lat_min: float, lon_min: float, lat_max: float, lon_max: float,
+                      max_tiles: int = 256, min_visits: float = hotspot_min_visits) -> pd.DataFrame:
+        """Known tiles of the finest zoom whose grid covers the view with at most max_tiles tiles."""
+        for zoom in range(self.levels):
+            corners = tile_ids(cell_ids([lat_min, lat_max], [lon_min, lon_max]), zoom)
+            (r0, r1), (c0, c1) = corners // 100_000, corners % 100_000
+            if (r1 - r0 + 1) * (c1 - c0 + 1) <= max_tiles or zoom == self.levels - 1:
+                break
+        rows, cols = np.meshgrid(np.arange(r0, r1 + 1), np.arange(c0, c1 + 1), indexing="ij")
+        index = pd.MultiIndex.from_arrays([np.full(rows.size, zoom, np.int8), (rows * 100_000 + cols).ravel()],
+                                          names=["zoom", "tile"])
+        view = self.stats.reindex(index).dropna()
+        return HotspotTiler(view[view["visits"] >= min_visits], self.watermark, self.half_life_days,
+                            self.levels, self.as_of).frame(min_visits)
+
+    # ---------- persistence ----------
+    def save(self, path: str = hotspot_state_path):
+        table = pa.Table.from_pandas(self.stats.reset_index(), preserve_index=False)
+        table = table.replace_schema_metadata({
+            "watermark": self.watermark.isoformat() if self.watermark is not None else "",
+            "as_of": self.as_of.isoformat() if self.as_of is not None else "",
+            "half_life_days": str(self.half_life_days),
+            "levels": str(self.levels),
+        })
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str = hotspot_state_path):
+        """Empty tiler when there is no state yet."""
+        if not os.path.exists(path):
+            return cls()
+        meta = pq.read_schema(path).metadata or {}
+        stats = pq.read_table(path).to_pandas().set_index(["zoom", "tile"])
+        return cls(stats, meta.get(b"watermark", b"").decode() or None,
+                   float(meta.get(b"half_life_days", hotspot_half_life_days)),
+                   int(meta.get(b"levels", hotspot_levels)),
+                   meta.get(b"as_of", b"").decode() or None)
+
+
+def publish_hotspots(tiler: HotspotTiler, table_path: str = hotspot_table, min_visits: float = hotspot_min_visits) -> int:
+    """Overwrites the dashboard Delta table with the current tiles; returns the number of rows."""
+    from deltalake import write_deltalake
+
+    df = tiler.frame(min_visits)
+    write_deltalake(table_path, df, mode="overwrite")
+    return len(df)
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Incremental update (update_tiles = True) ----------
+if update_tiles:
+    t0 = time.perf_counter()
+    tiler = HotspotTiler.load(hotspot_state_path)
+    new_rows = TrafficArchive(traffic_history_root).read(since=tiler.watermark)
+    tiler.partial_fit(new_rows).save(hotspot_state_path)
+    published = publish_hotspots(tiler, hotspot_table)
+    log.info(f"Hotspot tiles: {len(new_rows)} new rows, {len(tiler.stats)} tiles in state, {published} published, "
+             f"watermark={tiler.watermark}, as_of={tiler.as_of} in {time.perf_counter() - t0:.1f}s")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Benchmark (benchmark_tiles = True) ----------
+# The forecaster's synthetic corridors (60, observed hourly for 4 weeks): tiles folded in day by day
+# vs one fit over the whole history, then a city view from the tiles vs aggregating the raw archive.
+if benchmark_tiles:
+    import tempfile
+
+    rng = np.random.default_rng(47)
+    corridors = [np.asarray(synthetic_route(rng, 150)[0]) for _ in range(60)]
+    severity = rng.uniform(0.2, 0.9, len(corridors))
+    start = datetime(2025, 1, 6)
+
+    archive = TrafficArchive(tempfile.mkdtemp(), flush_rows=10 ** 9)
+    for c, coords in enumerate(corridors):
+        for t in np.sort(rng.uniform(0, 28 * 86400, 28 * 24)):
+            when = start + timedelta(seconds=float(t))
+            archive.record(_observed_route(rng, coords, float(_rush_level(np.array(hour_of_week(when)), severity[c]))), when)
+    archive.flush()
+    history = archive.read()
+
+    incremental, fit_ms = HotspotTiler(), []
+    for day in range(28):
+        lo, hi = pd.Timestamp(start + timedelta(days=day)), pd.Timestamp(start + timedelta(days=day + 1))
+        t0 = time.perf_counter()
+        incremental.partial_fit(history[(history["observed_at"] >= lo) & (history["observed_at"] < hi)])
+        fit_ms.append((time.perf_counter() - t0) * 1000)
+    batch = HotspotTiler().partial_fit(history)
+    joined = incremental.stats.join(batch.stats, rsuffix="_batch", how="outer").fillna(0.0)
+    max_rel_diff = float(max((joined[c] - joined[f"{c}_batch"]).abs().max() / joined[f"{c}_batch"].abs().max()
+                             for c in TILE_COLUMNS))
+
+    state_path = os.path.join(tempfile.mkdtemp(), "state.parquet")
+    incremental.save(state_path)
+    frame = incremental.frame()
+    view = (45.40, 9.05, 45.60, 9.35)          # Milan
+    t0 = time.perf_counter()
+    for _ in range(20):
+        tiles = incremental.tiles_in_view(*view)
+    view_ms = (time.perf_counter() - t0) * 1000 / 20
+
+    # the alternative: aggregate the raw history for the view on every render
+    t0 = time.perf_counter()
+    cell_lat = (history["cell"] // 100_000) * CELL_DEG - 90.0
+    cell_lon = (history["cell"] % 100_000) * CELL_DEG - 180.0
+    in_view = history[(cell_lat >= view[0]) & (cell_lat < view[2]) & (cell_lon >= view[1]) & (cell_lon < view[3])]
+    k = 0.5 ** ((in_view["observed_at"].max() - in_view["observed_at"]).dt.total_seconds() / 86400.0 / hotspot_half_life_days)
+    scan = (in_view.assign(w=in_view["length_m"] * k * (in_view["category"] > 0)).groupby("cell")["w"].sum())
+    scan_ms = (time.perf_counter() - t0) * 1000
+
+    assert max_rel_diff < 1e-6
+    print({
+        "archive_rows": len(history),
+        "fit_ms_per_day_p50": round(float(np.median(fit_ms)), 1),
+        "incremental_vs_batch_max_rel_diff": max_rel_diff,
+        "tiles_per_zoom": frame.groupby("zoom").size().to_dict(),
+        "state_bytes": os.path.getsize(state_path),
+        "view_zoom": int(tiles["zoom"].iloc[0]) if len(tiles) else None,
+        "view_tiles": len(tiles),
+        "view_ms": round(view_ms, 2),
+        "scan_history_ms": round(scan_ms, 1),
+        "top_hotspot": frame[frame["zoom"] == 0].iloc[0][["lat", "lon", "congestion", "exposure_m"]].astype(float).round(3).to_dict(),
+    })
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -0,0 +1,425 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     },
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the online corrector with: %run hero_online_model
+# Schedule with fold_online_completions = True when hero_dispatch_consumer (which folds the inbox itself) is not running.
+fold_online_completions = False
+benchmark_online_model = False
+online_model_root = "/lakehouse/default/Files/hero/online_model"
+online_min_updates = 30             # corrections are applied only after this many completions
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+log = logging.getLogger("hero-online-model")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Online residual corrector for the siren-advantage model
+# ----------------------------------------------------
+# - the registered AutoML model stays the baseline; a small linear model learns its residual
+#   (siren_advantage_real - baseline prediction) from each completed mission
+# - sufficient statistics only: X'X (8x8) and X'r with exponential forgetting, so memory is
+#   constant and old missions fade out (effective window ~ 1 / (1 - forgetting) missions)
+# - every completion is scored before it is learned (prequential), which drives the drift monitor
+# - a new baseline model (other model_uri) resets the corrector
+# ====================================================
+
+ONLINE_STATE_PATH = f"{online_model_root}/state.json"
+ONLINE_INBOX = f"{online_model_root}/inbox"
+FEATURE_NAMES = ["intercept", "congestion_score", "log_eta", "distance_10km", "hour_sin", "hour_cos",
+                 "is_weekend", "baseline"]
+
+
+def feature_vector(features: dict, baseline: float) -> np.ndarray:
+    """Corrector inputs from the decision features (hero_route_decision names, dow as datetime.weekday())."""
+    hour = 2.0 * math.pi * float(features["hour_of_day"]) / 24.0
+    return np.array([
+        1.0,
+        float(features["congestion_score"]),
+        math.log1p(float(features["eta_theoretical_min"])) / 3.0,
+        float(features["distance_m_theoretical"]) / 10_000.0,
+        math.sin(hour),
+        math.cos(hour),
+        1.0 if int(features["dow"]) >= 5 else 0.0,
+        float(baseline),
+    ])
+
+
+def completion_target(eta_theoretical_min: float, actual_eta_min: float):
+    """siren_advantage_real as in ml_data_prep, None when its cleaning rule would drop the mission."""
+    if not eta_theoretical_min or actual_eta_min is None or actual_eta_min <= 0:
+        return None
+    target = round((eta_theoretical_min - actual_eta_min) / eta_theoretical_min, 4)
+    return target if -0.5 < target < 1.0 else None
+
+
+class DriftMonitor:
+    """
+    Prequential errors of the AutoML baseline and of the corrected prediction.
+    - mae_baseline / mae_online: exponentially weighted absolute errors
+    - reference_mae: baseline MAE over the first warmup completions
+    - two-sided Page-Hinkley on the baseline residual flags a sustained shift of its mean
+    retrain_recommended when Page-Hinkley fires or the baseline MAE exceeds degrade_ratio x reference.
+    """
+
+    def __init__(self, alpha: float = 0.05, warmup: int = 50, ph_delta: float = 0.005,
+                 ph_threshold: float = 0.5, degrade_ratio: float = 1.25):
+        self.alpha, self.warmup = alpha, warmup
+        self.ph_delta, self.ph_threshold, self.degrade_ratio = ph_delta, ph_threshold, degrade_ratio
+        self.n = 0
+        self.mae_baseline = self.mae_online = None
+        self.reference_sum = 0.0
+        self.residual_mean = 0.0
+        self.ph_up = self.ph_down = 0.0
+        self.alarm_at = None             # completion count when Page-Hinkley first fired
+
+    def observe(self, target: float, baseline: float, corrected: float):
+        self.n += 1
+        e_b, e_o = abs(target - baseline), abs(target - corrected)
+        self.mae_baseline = e_b if self.mae_baseline is None else (1 - self.alpha) * self.mae_baseline + self.alpha * e_b
+        self.mae_online = e_o if self.mae_online is None else (1 - self.alpha) * self.mae_online + self.alpha * e_o
+        if self.n <= self.warmup:
+            self.reference_sum += e_b
+        r = target - baseline
+        self.residual_mean += (r - self.residual_mean) / self.n
+        self.ph_up = max(0.0, self.ph_up + r - self.residual_mean - self.ph_delta)
+        self.ph_down = max(0.0, self.ph_down - (r - self.residual_mean) - self.ph_delta)
+        if self.alarm_at is None and max(self.ph_up, self.ph_down) > self.ph_threshold:
+            self.alarm_at = self.n
+
+    def status(self) -> dict:
+        reference = self.reference_sum / min(self.n, self.warmup) if self.n else None
+        degraded = (self.n > self.warmup and reference is not None
+                    and self.mae_baseline > self.degrade_ratio * reference)
+        return {
+            "completions": self.n,
+            "mae_baseline": round(self.mae_baseline, 4) if self.mae_baseline is not None else None,
+            "mae_online": round(self.mae_online, 4) if self.mae_online is not None else None,
+            "reference_mae": round(reference, 4) if reference is not None else None,
+            "baseline_bias": round(self.residual_mean, 4),
+            "page_hinkley_alarm_at": self.alarm_at,
+            "retrain_recommended": bool(self.alarm_at is not None or degraded),
+        }
+
+
+class OnlineResidualModel:
+
+    def __init__(self, baseline: str = "", forgetting: float = 0.995, ridge: float = 5.0,
+                 max_correction: float = 0.15, dedupe_size: int = 4096):
+        """
+        baseline:       model_uri of the AutoML model the residuals refer to
+        forgetting:     per-completion decay of the statistics (0.995 ~ last 200 missions)
+        ridge:          L2 prior pulling the correction to 0 while there is little data
+        max_correction: cap on |correction| in advantage units
+        """
+        d = len(FEATURE_NAMES)
+        self.baseline = baseline
+        self.forgetting, self.ridge, self.max_correction = forgetting, ridge, max_correction
+        self.xtx = np.zeros((d, d))
+        self.xtr = np.zeros(d)
+        self.n_eff = 0.0
+        self.updates = 0
+        self.drift = DriftMonitor()
+        self._seen = OrderedDict()          # recent mission ids, a replayed completion is learned once
+        self._dedupe_size = dedupe_size
+        self._weights = np.zeros(d)
+        self._lock = threading.Lock()
+        self._saved_updates = 0
+        self._saved_at = time.time()
+
+    # ---------- serving ----------
+    def correction(self, features: dict, baseline_pred: float) -> float:
+        x = feature_vector(features, baseline_pred)
+        with self._lock:
+            w = self._weights
+        return float(np.clip(x @ w, -self.max_correction, self.max_correction))
+
+    def predict(self, features: dict, baseline_pred: float) -> float:
+        return baseline_pred + self.correction(features, baseline_pred)
+
+    # ---------- learning ----------
+    def update(self, features: dict, baseline_pred: float, target: float, mission_id=None) -> bool:
+        """Learns one completed mission; False when it was already learned."""
+        x = feature_vector(features, baseline_pred)
+        with self._lock:
+            if mission_id is not None:
+                if mission_id in self._seen:
+                    return False
+                self._seen[mission_id] = True
+                if len(self._seen) > self._dedupe_size:
+                    self._seen.popitem(last=False)
+            corrected = baseline_pred + float(np.clip(x @ self._weights, -self.max_correction, self.max_correction))
+            self.drift.observe(target, baseline_pred, corrected)
+            self.xtx = self.forgetting * self.xtx + np.outer(x, x)
+            self.xtr = self.forgetting * self.xtr + x * (target - baseline_pred)
+            self.n_eff = self.forgetting * self.n_eff + 1.0
+            self.updates += 1
+            self._weights = np.linalg.solve(self.xtx + self.ridge * np.eye(len(x)), self.xtr)
+        return True
+
+    # ---------- checkpoint ----------
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "baseline": self.baseline,
+                "forgetting": self.forgetting,
+                "ridge": self.ridge,
+                "max_correction": self.max_correction,
+                "features": FEATURE_NAMES,
+                "xtx": self.xtx.tolist(),
+                "xtr": self.xtr.tolist(),
+                "n_eff": self.n_eff,
+                "updates": self.updates,
+                "drift": dict(self.drift.__dict__),
+                "recent_missions": list(self._seen),
+                "updated_at": time.time(),
+            }
+
+    def save(self, path: str = ONLINE_STATE_PATH):
+        state = self.to_dict()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+        self._saved_updates, self._saved_at = state["updates"], time.time()
+
+    def maybe_save(self, path: str = ONLINE_STATE_PATH, every_updates: int = 25, every_s: float = 300.0) -> bool:
+        """Checkpoints when every_updates completions or every_s seconds passed since the last one."""
+        pending = self.updates - self._saved_updates
+        if pending and (pending >= every_updates or time.time() - self._saved_at >= every_s):
+            self.save(path)
+            return True
+        return False
+
+    @classmethod
+    def load(cls, path: str = ONLINE_STATE_PATH, baseline: str = None):
+        """Fresh corrector when there is no state, or when it was learned against another baseline model."""
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return cls(baseline or "")
+        if baseline is not None and state.get("baseline") != baseline:
+            log.info(f"Online corrector reset: baseline changed {state.get('baseline')} -> {baseline}")
+            return cls(baseline)
+        if state.get("features") != FEATURE_NAMES:
+            log.info("Online corrector reset: feature map changed")
+            return cls(state.get("baseline", ""))
+        model = cls(state["baseline"], state["forgetting"], state["ridge"], state["max_correction"])
+        model.xtx = np.array(state["xtx"])
+        model.xtr = np.array(state["xtr"])
+        model.n_eff, model.updates = state["n_eff"], state["updates"]
+        model.drift.__dict__.update(state["drift"])
+        model._seen.update((m, True) for m in state["recent_missions"])
+        model._weights = np.linalg.solve(model.xtx + model.ridge * np.eye(len(FEATURE_NAMES)), model.xtr)
+        model._saved_updates = model.updates
+        return model
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Completion inbox
+# ----------------------------------------------------
+# Per-dispatch runs of hero_route_decision cannot share one in-memory model, so each run
+# drops its completed mission as a small JSON file; a single writer (hero_dispatch_consumer
+# or this notebook on a schedule) folds the inbox into the corrector and checkpoints it.
+# ====================================================
+
+def completion_record(mission_id, features: dict, baseline_pred: float, eta_theoretical_min: float,
+                      actual_eta_min: float, baseline_uri: str = ""):
+    """Inbox record of one completed mission, None when the target is not usable.
+
+    baseline_uri stamps the model that produced baseline_pred, so the folding writer learns
+    against the same baseline the decision path loads the corrector with.
+    """
+    target = completion_target(eta_theoretical_min, actual_eta_min)
+    if target is None:
+        return None
+    return {
+        "mission_id": mission_id,
+        "features": {k: float(v) for k, v in features.items()},
+        "baseline": float(baseline_pred),
+        "baseline_uri": baseline_uri,
+        "target": target,
+        "completed_at": time.time(),
+    }
+
+
+def post_completion(record: dict, inbox: str = ONLINE_INBOX) -> str:
+    os.makedirs(inbox, exist_ok=True)
+    path = os.path.join(inbox, f"{int(time.time() * 1000)}-{record['mission_id']}-{uuid.uuid4().hex[:6]}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp, path)
+    return path
+
+
+def fold_inbox(model: OnlineResidualModel, inbox: str = ONLINE_INBOX, state_path: str = ONLINE_STATE_PATH,
+               max_files: int = 10_000) -> int:
+    """Learns the queued completions in arrival order, checkpoints, then deletes them. Returns missions learned."""
+    if not os.path.isdir(inbox):
+        return 0
+    files = sorted(f for f in os.listdir(inbox) if f.endswith(".json"))[:max_files]
+    learned = 0
+    for name in files:
+        try:
+            with open(os.path.join(inbox, name)) as f:
+                rec = json.load(f)
+            uri = rec.get("baseline_uri", "")
+            if uri and not model.baseline:
+                model.baseline = uri           # fresh state adopts the decision path's baseline
+            if uri and uri != model.baseline:
+                log.warning(f"Skipping completion {name}: learned against {uri}, corrector tracks {model.baseline}")
+                continue
+            learned += model.update(rec["features"], rec["baseline"], rec["target"], rec["mission_id"])
+        except (ValueError, KeyError) as e:
+            log.warning(f"Skipping malformed completion {name}: {e}")
+    if files:
+        model.save(state_path)
+        # deleted only after the checkpoint; a crash in between replays them, and mission ids dedupe the replay
+        for name in files:
+            os.remove(os.path.join(inbox, name))
+    return learned
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Fold queued completions (fold_online_completions = True) ----------
+if fold_online_completions:
+    t0 = time.perf_counter()
+    # same baseline as hero_route_decision / hero_dispatch_consumer, or load() would reset on their next run
+    variable_lib = notebookutils.variableLibrary.getLibrary("Variables")
+    online_model = OnlineResidualModel.load(baseline=f"models:/{variable_lib.getVariable('siren-model')}/2")
+    learned = fold_inbox(online_model)
+    log.info(f"Online corrector: {learned} completion(s) folded, {online_model.updates} total, "
+             f"drift={online_model.drift.status()} in {time.perf_counter() - t0:.2f}s")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Synthetic drift check (benchmark_online_model = True)
+# ----------------------------------------------------
+# The baseline under-weights congestion; after 1500 missions the true advantage
+# shifts (e.g. a new bus-lane policy). Errors are prequential: each mission is
+# scored before the corrector learns it.
+# ====================================================
+
+def _synthetic_missions(rng, n: int):
+    for _ in range(n):
+        eta = float(rng.uniform(4, 40))
+        yield {
+            "congestion_score": float(rng.choice([0.0, 0.25, 0.5, 0.75, 1.0])),
+            "eta_theoretical_min": eta,
+            "distance_m_theoretical": eta * 600.0 * float(rng.uniform(0.8, 1.2)),
+            "hour_of_day": int(rng.integers(0, 24)),
+            "dow": int(rng.integers(0, 7)),
+            "telemetry_points": int(eta * 15),
+        }
+
+
+if benchmark_online_model:
+    rng = np.random.default_rng(44)
+    model = OnlineResidualModel("models:/synthetic/1")
+    err_b, err_o, update_us, predict_us = [], [], [], []
+    for i, f in enumerate(_synthetic_missions(rng, 3000)):
+        rush = math.exp(-0.5 * ((f["hour_of_day"] - 8) / 1.5) ** 2) + math.exp(-0.5 * ((f["hour_of_day"] - 18) / 1.5) ** 2)
+        truth = 0.10 + 0.20 * f["congestion_score"] + 0.03 * rush + (0.05 if i >= 1500 else 0.0)
+        baseline = 0.12 + 0.12 * f["congestion_score"]
+        target = float(truth + rng.normal(0, 0.02))
+        t0 = time.perf_counter()
+        corrected = model.predict(f, baseline)
+        predict_us.append((time.perf_counter() - t0) * 1e6)
+        err_b.append(abs(target - baseline))
+        err_o.append(abs(target - corrected))
+        t0 = time.perf_counter()
+        model.update(f, baseline, target, mission_id=i)
+        update_us.append((time.perf_counter() - t0) * 1e6)
+    err_b, err_o = np.array(err_b), np.array(err_o)
+    print({
+        "mae_baseline_before_shift": round(float(err_b[200:1500].mean()), 4),
+        "mae_online_before_shift": round(float(err_o[200:1500].mean()), 4),
+        "mae_baseline_after_shift": round(float(err_b[1700:].mean()), 4),
+        "mae_online_after_shift": round(float(err_o[1700:].mean()), 4),
+        "drift": model.drift.status(),
+        "update_us_p50": round(float(np.median(update_us)), 1),
+        "predict_us_p50": round(float(np.median(predict_us)), 1),
+        "state_bytes": len(json.dumps(model.to_dict())),
+    })
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
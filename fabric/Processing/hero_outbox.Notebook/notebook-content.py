@@ -0,0 +1,222 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "environment": {}
+# META   }
+# META }
+
+# CELL ********************
+
+# Load with: %run hero_outbox
+
+import heapq
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("hero-outbox")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Notification outbox
+# ----------------------------------------------------
+# - enqueue() returns immediately, the decision path never waits for SMS
+# - one background worker takes messages in order and hands every send attempt to a small pool,
+#   so a slow or failing recipient never holds back the messages queued after it
+# - the shortened map URL is cached per polyline and reused for every recipient
+# - a failed attempt is not retried in place: it goes back to the worker with a due time
+#   (exponential backoff) and no pool thread sleeps meanwhile
+# - delivery latency (enqueue -> provider accepted) is recorded per recipient; counters are
+#   kept for the session, records and latencies for the latest recent_size recipients only
+# ====================================================
+
+_WAKE = object()                    # queue marker: a retry was scheduled or the last recipient is done
+
+
+class NotificationOutbox:
+
+    def __init__(self, send_fn, max_parallel: int = 4, max_attempts: int = 4,
+                 base_backoff_s: float = 1.0, url_cache_size: int = 256, on_delivery=None,
+                 recent_size: int = 1000):
+        """
+        send_fn:     callable(params=dict) -> dict, e.g. hero_functions.send_sms_with_map
+        on_delivery: optional callable(record) called after each recipient is delivered or given up
+        """
+        self._send_fn = send_fn
+        self._max_attempts = max_attempts
+        self._base_backoff_s = base_backoff_s
+        self._on_delivery = on_delivery
+        self._queue = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="hero-sms")
+        self._url_cache = OrderedDict()
+        self._url_cache_size = url_cache_size
+        self._lock = threading.Lock()
+        self._retries = []              # heap of (due, seq, attempt)
+        self._seq = 0
+        self._pending = 0               # recipients enqueued and not yet delivered or given up
+        self.records = deque(maxlen=recent_size)
+        self.delivered = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._run, name="hero-outbox", daemon=True)
+        self._worker.start()
+
+    # ---------- producer side ----------
+    def enqueue(self, recipients, params: dict) -> str:
+        """Queue one message for all recipients (str, comma-separated str or list). Returns the message id."""
+        if isinstance(recipients, str):
+            recipients = [r.strip() for r in recipients.split(",") if r.strip()]
+        message_id = uuid.uuid4().hex
+        with self._lock:
+            self._pending += len(recipients)
+        self._queue.put({
+            "message_id": message_id,
+            "recipients": list(recipients),
+            "params": dict(params),
+            "enqueued_at": time.time(),
+        })
+        return message_id
+
+    def close(self, timeout: float = 60.0) -> bool:
+        """Stop accepting work and wait until queued messages are delivered. Returns False on timeout."""
+        self._queue.put(None)
+        self._worker.join(timeout)
+        drained = not self._worker.is_alive()
+        self._pool.shutdown(wait=drained)
+        return drained
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(r["latency_ms"] for r in self.records if r["status"] == "sent")
+            delivered, failed, pending = self.delivered, self.failed, self._pending
+        n = len(latencies)
+        return {
+            "delivered": delivered,
+            "failed": failed,
+            "pending": pending,
+            "latency_ms_p50": latencies[n // 2] if n else None,
+            "latency_ms_max": latencies[-1] if n else None,
+        }
+
+    # ---------- worker side ----------
+    def _run(self):
+        closing = False
+        while True:
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                while self._retries and self._retries[0][0] <= now:
+                    due.append(heapq.heappop(self._retries)[2])
+                wait = self._retries[0][0] - now if self._retries else None
+                done = closing and self._pending == 0
+            for attempt in due:
+                self._pool.submit(self._attempt, attempt)
+            if done:
+                break
+            try:
+                msg = self._queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if msg is None:
+                closing = True
+            elif msg is not _WAKE:
+                self._pool.submit(self._start, msg)
+
+    def _start(self, msg: dict):
+        recipients = msg["recipients"]
+        if not recipients:
+            return
+        key = msg["params"].get("polyline")
+        with self._lock:
+            short_url = self._url_cache.get(key) if key else None
+            if short_url is not None:
+                self._url_cache.move_to_end(key)
+
+        # the first recipient resolves the short URL (unless cached), the others reuse it in parallel;
+        # when that first attempt fails, each of the others resolves its own
+        if short_url is None:
+            result = self._attempt({"msg": msg, "to_phone": recipients[0], "short_url": None, "n": 1})
+            short_url = (result or {}).get("map_url")
+            if key and short_url:
+                with self._lock:
+                    self._url_cache[key] = short_url
+                    if len(self._url_cache) > self._url_cache_size:
+                        self._url_cache.popitem(last=False)
+            rest = recipients[1:]
+        else:
+            rest = recipients
+        for to_phone in rest:
+            self._pool.submit(self._attempt, {"msg": msg, "to_phone": to_phone, "short_url": short_url, "n": 1})
+
+    def _attempt(self, attempt: dict):
+        """One send; a failure with attempts left is rescheduled on the worker after its backoff."""
+        msg, to_phone, n = attempt["msg"], attempt["to_phone"], attempt["n"]
+        params = dict(msg["params"], to_phone=to_phone)
+        if attempt["short_url"]:
+            params["short_url"] = attempt["short_url"]
+        try:
+            result = self._send_fn(params=params)
+        except Exception as e:
+            if n < self._max_attempts:
+                with self._lock:
+                    self._seq += 1
+                    heapq.heappush(self._retries, (time.monotonic() + self._base_backoff_s * 2 ** (n - 1),
+                                                   self._seq, dict(attempt, n=n + 1)))
+                self._queue.put(_WAKE)
+                return None
+            self._finish(msg, to_phone, n, e)
+            return None
+        self._finish(msg, to_phone, n, None)
+        return result
+
+    def _finish(self, msg: dict, to_phone: str, attempts: int, error):
+        record = {
+            "message_id": msg["message_id"],
+            "to_phone": to_phone,
+            "status": "sent" if error is None else "failed",
+            "attempts": attempts,
+            "latency_ms": round((time.time() - msg["enqueued_at"]) * 1000, 1),
+            "error": None if error is None else type(error).__name__,
+        }
+        with self._lock:
+            self.records.append(record)
+            self.delivered += error is None
+            self.failed += error is not None
+            self._pending -= 1
+            last = self._pending == 0
+        if last:
+            self._queue.put(_WAKE)
+        if error is None:
+            log.info(f"SMS to {to_phone} delivered in {record['latency_ms']} ms ({attempts} attempt(s))")
+        else:
+            log.error(f"SMS to {to_phone} failed after {attempts} attempts: {error}")
+        if self._on_delivery:
+            try:
+                self._on_delivery(record)
+            except Exception:
+                log.exception("on_delivery callback failed")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -0,0 +1,430 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# set to True to run the synthetic load test at the end of the notebook.
+# Other notebooks load the index with: %run hero_position_index
+run_benchmark = False
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+log = logging.getLogger("hero-position-index")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# In-memory index of live vehicle positions
+# ----------------------------------------------------
+# - One slot per vehicle in flat numpy arrays (lat, lon, ts)
+# - Uniform lat/lon grid: cell -> set of slots
+# - Radius and k-nearest queries without calling Eventhouse
+# ====================================================
+
+EARTH_RADIUS_M = 6_371_000.0
+METERS_PER_DEG_LAT = 111_320.0
+
+
+def to_epoch_seconds(ts) -> float:
+    """
+    Normalize a telemetry timestamp to epoch seconds (UTC).
+    Accepts epoch milliseconds (int/float), datetime or ISO string (with or without 'Z').
+    """
+    if ts is None:
+        return time.time()
+    if isinstance(ts, (int, float)):
+        return float(ts) / 1000.0
+    if isinstance(ts, datetime):
+        dt = ts
+    else:
+        dt = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters, vectorized over numpy arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2.0) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+
+class VehiclePositionIndex:
+    """
+    Latest fix per vehicle, kept in array-backed slots and bucketed in a uniform grid.
+
+    - update() is O(1) amortized: overwrite the slot, move it between two grid cells
+      only when the vehicle crosses a cell border; arrays double when full
+    - radius() scans only the cells overlapping the query circle
+    - nearest() expands rings of cells around the query point until the k-th
+      candidate is closer than anything left unscanned
+    - evict_stale() frees slots whose last fix is older than max_age_s
+    Thread-safe: a single lock guards writers (stream feed) and readers (queries).
+    """
+
+    def __init__(self, cell_size_deg: float = 0.005, capacity: int = 1024):
+        self.cell_size_deg = float(cell_size_deg)
+        self._lock = threading.RLock()
+
+        self._lat = np.full(capacity, np.nan, dtype=np.float32)
+        self._lon = np.full(capacity, np.nan, dtype=np.float32)
+        self._ts = np.zeros(capacity, dtype=np.float64)
+        self._cell = np.zeros(capacity, dtype=np.int64)
+        self._active = np.zeros(capacity, dtype=bool)
+
+        self._vehicle_ids = [None] * capacity
+        self._route_ids = [None] * capacity
+        self._status = [None] * capacity
+
+        self._slot_by_vehicle = {}
+        self._free = list(range(capacity - 1, -1, -1))
+        self._grid = {}
+
+    # ---------- internals ----------
+    def _cell_xy(self, lat: float, lon: float):
+        return int(math.floor(lat / self.cell_size_deg)), int(math.floor(lon / self.cell_size_deg))
+
+    @staticmethod
+    def _cell_key(cy: int, cx: int) -> int:
+        # pack the two signed cell coordinates into one int key
+        return (cy << 32) ^ (cx & 0xFFFFFFFF)
+
+    def _grow(self):
+        old = len(self._lat)
+        new = old * 2
+        for name, fill in (("_lat", np.nan), ("_lon", np.nan), ("_ts", 0.0), ("_cell", 0), ("_active", False)):
+            arr = getattr(self, name)
+            grown = np.full(new, fill, dtype=arr.dtype)
+            grown[:old] = arr
+            setattr(self, name, grown)
+        for name in ("_vehicle_ids", "_route_ids", "_status"):
+            getattr(self, name).extend([None] * old)
+        self._free.extend(range(new - 1, old - 1, -1))
+
+    def _release(self, slot: int):
+        bucket = self._grid.get(int(self._cell[slot]))
+        if bucket is not None:
+            bucket.discard(slot)
+            if not bucket:
+                del self._grid[int(self._cell[slot])]
+        del self._slot_by_vehicle[self._vehicle_ids[slot]]
+        self._active[slot] = False
+        self._lat[slot] = self._lon[slot] = np.nan
+        self._vehicle_ids[slot] = self._route_ids[slot] = self._status[slot] = None
+        self._free.append(slot)
+
+    def _slots_in_cells(self, cy0: int, cy1: int, cx0: int, cx1: int, out: list):
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                bucket = self._grid.get(self._cell_key(cy, cx))
+                if bucket:
+                    out.extend(bucket)
+
+    def _rows(self, slots, dist):
+        return [
+            {
+                "vehicle_id": self._vehicle_ids[s],
+                "route_id": self._route_ids[s],
+                "status": self._status[s],
+                "latitude": float(self._lat[s]),
+                "longitude": float(self._lon[s]),
+                "timestamp": float(self._ts[s]),
+                "distance_m": round(float(d), 1),
+            }
+            for s, d in zip(slots, dist)
+        ]
+
+    # ---------- writes ----------
+    def update(self, vehicle_id: str, lat: float, lon: float, ts=None, route_id: str = None, status: str = None) -> bool:
+        """
+        Upsert the latest fix of a vehicle. Out-of-order fixes (older than the stored one) are ignored.
+        Returns True when the fix was applied.
+        """
+        ts_s = to_epoch_seconds(ts)
+        key = self._cell_key(*self._cell_xy(lat, lon))
+        with self._lock:
+            slot = self._slot_by_vehicle.get(vehicle_id)
+            if slot is None:
+                if not self._free:
+                    self._grow()
+                slot = self._free.pop()
+                self._slot_by_vehicle[vehicle_id] = slot
+                self._vehicle_ids[slot] = vehicle_id
+                self._active[slot] = True
+                self._grid.setdefault(key, set()).add(slot)
+            else:
+                if ts_s < self._ts[slot]:
+                    return False
+                old_key = int(self._cell[slot])
+                if old_key != key:
+                    bucket = self._grid[old_key]
+                    bucket.discard(slot)
+                    if not bucket:
+                        del self._grid[old_key]
+                    self._grid.setdefault(key, set()).add(slot)
+
+            self._lat[slot] = lat
+            self._lon[slot] = lon
+            self._ts[slot] = ts_s
+            self._cell[slot] = key
+            if route_id is not None:
+                self._route_ids[slot] = route_id
+            if status is not None:
+                self._status[slot] = status
+            return True
+
+    def ingest(self, events) -> int:
+        """
+        Apply telemetry events as published by publish_vehicle_telemetry
+        (vehicle_id, route_id, latitude, longitude, timestamp, status).
+        Returns the number of applied fixes.
+        """
+        applied = 0
+        for e in events:
+            lat, lon = e.get("latitude"), e.get("longitude")
+            if e.get("vehicle_id") is None or lat is None or lon is None:
+                continue
+            applied += self.update(e["vehicle_id"], float(lat), float(lon),
+                                   ts=e.get("timestamp"), route_id=e.get("route_id"), status=e.get("status"))
+        return applied
+
+    def remove(self, vehicle_id: str) -> bool:
+        with self._lock:
+            slot = self._slot_by_vehicle.get(vehicle_id)
+            if slot is None:
+                return False
+            self._release(slot)
+            return True
+
+    def evict_stale(self, max_age_s: float, now: float = None) -> int:
+        """Drop vehicles whose last fix is older than max_age_s. Returns the number evicted."""
+        now = time.time() if now is None else now
+        with self._lock:
+            stale = np.flatnonzero(self._active & (self._ts < now - max_age_s))
+            for slot in stale:
+                self._release(int(slot))
+            return len(stale)
+
+    # ---------- reads ----------
+    def __len__(self):
+        return len(self._slot_by_vehicle)
+
+    def get(self, vehicle_id: str):
+        with self._lock:
+            slot = self._slot_by_vehicle.get(vehicle_id)
+            if slot is None:
+                return None
+            return self._rows([slot], [0.0])[0]
+
+    def radius(self, lat: float, lon: float, radius_m: float, max_age_s: float = None, now: float = None) -> list:
+        """Vehicles within radius_m of (lat, lon), closest first."""
+        dlat = radius_m / METERS_PER_DEG_LAT
+        dlon = radius_m / (METERS_PER_DEG_LAT * max(0.01, math.cos(math.radians(lat))))
+        cy0, cx0 = self._cell_xy(lat - dlat, lon - dlon)
+        cy1, cx1 = self._cell_xy(lat + dlat, lon + dlon)
+        with self._lock:
+            cand = []
+            self._slots_in_cells(cy0, cy1, cx0, cx1, cand)
+            if not cand:
+                return []
+            slots = np.fromiter(cand, dtype=np.int64, count=len(cand))
+            if max_age_s is not None:
+                now = time.time() if now is None else now
+                slots = slots[self._ts[slots] >= now - max_age_s]
+            dist = haversine_m(lat, lon, self._lat[slots].astype(np.float64), self._lon[slots].astype(np.float64))
+            keep = dist <= radius_m
+            slots, dist = slots[keep], dist[keep]
+            order = np.argsort(dist, kind="stable")
+            return self._rows(slots[order].tolist(), dist[order])
+
+    def nearest(self, lat: float, lon: float, k: int = 5, max_radius_m: float = 50_000.0,
+                max_age_s: float = None, now: float = None) -> list:
+        """k vehicles closest to (lat, lon), searched ring by ring up to max_radius_m."""
+        if k <= 0:
+            return []
+        now = time.time() if now is None else now
+        cy, cx = self._cell_xy(lat, lon)
+        # smallest metric extent of a cell, used as the guaranteed distance gained per ring
+        cell_m = self.cell_size_deg * METERS_PER_DEG_LAT * min(1.0, max(0.01, math.cos(math.radians(lat))))
+        max_ring = max(1, int(math.ceil(max_radius_m / cell_m)))
+
+        with self._lock:
+            slots = np.empty(0, dtype=np.int64)
+            dist = np.empty(0, dtype=np.float64)
+            for ring in range(max_ring + 1):
+                cand = []
+                if ring == 0:
+                    self._slots_in_cells(cy, cy, cx, cx, cand)
+                else:
+                    # top and bottom rows, then left and right columns of the ring
+                    self._slots_in_cells(cy - ring, cy - ring, cx - ring, cx + ring, cand)
+                    self._slots_in_cells(cy + ring, cy + ring, cx - ring, cx + ring, cand)
+                    self._slots_in_cells(cy - ring + 1, cy + ring - 1, cx - ring, cx - ring, cand)
+                    self._slots_in_cells(cy - ring + 1, cy + ring - 1, cx + ring, cx + ring, cand)
+                if cand:
+                    new = np.fromiter(cand, dtype=np.int64, count=len(cand))
+                    if max_age_s is not None:
+                        new = new[self._ts[new] >= now - max_age_s]
+                    d = haversine_m(lat, lon, self._lat[new].astype(np.float64), self._lon[new].astype(np.float64))
+                    slots = np.concatenate([slots, new])
+                    dist = np.concatenate([dist, d])
+                # anything outside the scanned square is at least ring * cell_m away
+                if len(dist) >= k and np.partition(dist, k - 1)[k - 1] <= ring * cell_m:
+                    break
+
+            keep = dist <= max_radius_m
+            slots, dist = slots[keep], dist[keep]
+            order = np.argsort(dist, kind="stable")[:k]
+            return self._rows(slots[order].tolist(), dist[order])
+
+    def snapshot(self):
+        """Copies of the active slots taken under the lock: (vehicle_ids, lat, lon, ts), unaffected by later updates."""
+        with self._lock:
+            active = np.flatnonzero(self._active)
+            return [self._vehicle_ids[s] for s in active], self._lat[active], self._lon[active], self._ts[active]
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Stream feed
+# ====================================================
+
+def start_eventhub_feed(index: VehiclePositionIndex, conn_str: str, consumer_group: str = "$Default",
+                        max_age_s: float = 300.0, evict_every_s: float = 30.0):
+    """
+    Feeds the index from the vehicles_telemetry stream in a background thread.
+    - conn_str must be a Listen-enabled Event Hub connection string
+      (e.g. a custom endpoint destination on the vehicles_telemetry Eventstream)
+    - Starts from the latest events: the index only needs current positions
+    - Evicts vehicles silent for more than max_age_s every evict_every_s
+    Returns (client, thread); call client.close() to stop.
+    """
+    import json
+    from azure.eventhub import EventHubConsumerClient
+
+    client = EventHubConsumerClient.from_connection_string(conn_str.strip(), consumer_group=consumer_group)
+    last_evict = [time.time()]
+
+    def on_event_batch(partition_context, events):
+        index.ingest(json.loads(e.body_as_str()) for e in events)
+        if time.time() - last_evict[0] >= evict_every_s:
+            evicted = index.evict_stale(max_age_s)
+            last_evict[0] = time.time()
+            if evicted:
+                log.info(f"Evicted {evicted} stale vehicles, {len(index)} live")
+
+    def run():
+        try:
+            client.receive_batch(on_event_batch=on_event_batch, starting_position="@latest", max_wait_time=1)
+        except Exception:
+            log.exception("Telemetry feed stopped")
+
+    thread = threading.Thread(target=run, name="hero-position-feed", daemon=True)
+    thread.start()
+    log.info("Telemetry feed started")
+    return client, thread
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Synthetic load test (run_benchmark = True)
+# ====================================================
+
+if run_benchmark:
+    rng = np.random.default_rng(41)
+    n_vehicles, n_updates, n_queries = 5_000, 200_000, 2_000
+    index = VehiclePositionIndex()
+
+    # vehicles moving around Milan (roughly 45.40–45.55 N, 9.05–9.30 E)
+    ids = [f"AMB-{i:05d}" for i in range(n_vehicles)]
+    veh = rng.integers(0, n_vehicles, n_updates)
+    lats = rng.uniform(45.40, 45.55, n_updates)
+    lons = rng.uniform(9.05, 9.30, n_updates)
+    now = time.time()
+
+    t0 = time.perf_counter()
+    for i in range(n_updates):
+        index.update(ids[veh[i]], lats[i], lons[i], ts=(now + i * 1e-3) * 1000.0)
+    t_upd = time.perf_counter() - t0
+
+    q_lat = rng.uniform(45.40, 45.55, n_queries)
+    q_lon = rng.uniform(9.05, 9.30, n_queries)
+
+    t0 = time.perf_counter()
+    for i in range(n_queries):
+        index.radius(q_lat[i], q_lon[i], 1_000)
+    t_rad = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for i in range(n_queries):
+        index.nearest(q_lat[i], q_lon[i], k=5)
+    t_knn = time.perf_counter() - t0
+
+    # brute-force check of the k-nearest answer
+    _, all_lat, all_lon, _ = index.snapshot()
+    d_all = np.sort(haversine_m(q_lat[0], q_lon[0], all_lat.astype(np.float64), all_lon.astype(np.float64)))[:5]
+    d_knn = np.array([r["distance_m"] for r in index.nearest(q_lat[0], q_lon[0], k=5)])
+    assert np.allclose(d_all, d_knn, atol=0.1), (d_all, d_knn)
+
+    print({
+        "vehicles": len(index),
+        "updates_per_s": round(n_updates / t_upd),
+        "radius_1km_ms": round(1000 * t_rad / n_queries, 3),
+        "knn5_ms": round(1000 * t_knn / n_queries, 3),
+    })
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -28,6 +28,11 @@ mission_id = 5000
 vehicle_id = "AMB-30"
 origin_coord = "45.51013857141289,9.184226615721908"
 incident_coord = "45.52490166289738,9.187160360153706"
+telemetry_mode = "adaptive"          # "adaptive" (dead reckoning) | "every_point"
+telemetry_tolerance_m = 30.0
+telemetry_max_interval_s = 30.0
+traffic_forecast = "auto"            # "auto" (forecast when confident or on quota errors) | "off" | "force"
+forecast_min_confidence = 0.8
 
 # METADATA ********************
 
@@ -63,6 +68,9 @@ import mlflow
 from mlflow.pyfunc import load_model
 import time
 import random
+import json
+import uuid
+from contextlib import contextmanager
 import pandas as pd
 
 # METADATA ********************
@@ -74,11 +82,152 @@ import pandas as pd
 
 # CELL ********************
 
+%run hero_outbox
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_dead_reckoning
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_trajectory
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_traffic_history
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_online_model
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_route_store
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_dag
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
 # ---------- LOGGING ----------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", force=True)
 log = logging.getLogger("hero-notebook")
 log.info("HERO route decision pipeline starting")
 
+
+# ---------- TRACING ----------
+class Tracer:
+    """
+    Per-stage spans for one dispatch:
+    - trace_id ties all spans of a run to its mission_id
+    - each span records start (epoch ms), duration, payload size and outcome
+    - flush() publishes the collected spans to the pipeline_metrics stream (tb_pipeline_spans)
+    Tracing never fails the pipeline: flush errors are only logged.
+    """
+
+    def __init__(self, mission_id, vehicle_id):
+        self.mission_id = int(mission_id)
+        self.vehicle_id = vehicle_id
+        self.trace_id = f"{self.mission_id}-{uuid.uuid4().hex[:12]}"
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage: str):
+        record = {
+            "trace_id": self.trace_id,
+            "mission_id": self.mission_id,
+            "vehicle_id": self.vehicle_id,
+            "stage": stage,
+            "start_ts": int(time.time() * 1000),
+            "payload_bytes": None,
+            "outcome": "ok",
+            "error": None,
+        }
+        t0 = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["outcome"] = "error"
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            self.spans.append(record)
+            log.info(f"span {stage}: {record['duration_ms']} ms ({record['outcome']})")
+
+    def flush(self, publish_fn, conn_str: str):
+        if not self.spans or not conn_str:
+            return
+        # swap first: stages running on other threads keep appending to the new list
+        spans, self.spans = self.spans, []
+        try:
+            publish_fn(params={
+                "connection_string": conn_str,
+                "events": spans,
+                "partition_key": str(self.mission_id),
+                "schema": "pipeline_span"
+            })
+        except Exception as e:
+            log.warning(f"Span publish failed: {e}")
+
+
+def payload_size(obj) -> int:
+    return len(json.dumps(obj, default=str))
+
+
+tracer = Tracer(mission_id, vehicle_id)
+log.info(f"trace_id={tracer.trace_id}")
+
 # METADATA ********************
 
 # META {
@@ -102,6 +251,10 @@ API_KEY = notebookutils.credentials.getSecret(VAULT_URL,"google-maps-api-key")
 EH_CONN_ANALYSIS = notebookutils.credentials.getSecret(VAULT_URL,"conn-str-route-analysis")
 EH_CONN_SEGMENTS = notebookutils.credentials.getSecret(VAULT_URL,"conn-str-route-segments")
 EH_CONN_TELEMETRY = notebookutils.credentials.getSecret(VAULT_URL,"conn-str-vehicles-telemetry")
+try:
+    EH_CONN_METRICS = notebookutils.credentials.getSecret(VAULT_URL,"conn-str-pipeline-metrics")
+except Exception:
+    EH_CONN_METRICS = None  # tracing is optional: spans are only logged
 TWILIO_SID = notebookutils.credentials.getSecret(VAULT_URL,"twilio-sid")
 TWILIO_FROM = notebookutils.credentials.getSecret(VAULT_URL,"twilio-from-number")
 TWILIO_TOKEN = notebookutils.credentials.getSecret(VAULT_URL,"twilio-token")
@@ -112,6 +265,22 @@ WORKSPACE_ID = fabric.get_workspace_id()
 FUNC_COLLECTION = "hero_functions"
 hero_functions = notebookutils.udf.getFunctions(FUNC_COLLECTION, WORKSPACE_ID)
 
+# SMS leave the decision path: enqueue returns immediately, delivery spans are flushed with the others
+def record_sms_delivery(record):
+    tracer.spans.append({
+        "trace_id": tracer.trace_id,
+        "mission_id": tracer.mission_id,
+        "vehicle_id": tracer.vehicle_id,
+        "stage": "sms_delivery",
+        "start_ts": int(time.time() * 1000 - record["latency_ms"]),
+        "payload_bytes": None,
+        "outcome": "ok" if record["status"] == "sent" else "error",
+        "error": record["error"],
+        "duration_ms": record["latency_ms"],
+    })
+
+outbox = NotificationOutbox(hero_functions.send_sms_with_map, on_delivery=record_sms_delivery)
+
 log.info("Config done")
 
 # METADATA ********************
@@ -126,7 +295,8 @@ log.info("Config done")
 # Load latest version from Fabric MLflow model registry
 
 model_uri = f"models:/{MODEL_NAME}/2"
-ml_model = load_model(model_uri)
+with tracer.span("model_load"):
+    ml_model = load_model(model_uri)
 
 log.info("Loaded model: {MODEL_NAME}")
 
@@ -143,10 +313,11 @@ log.info("Loaded model: {MODEL_NAME}")
 # ============================================================
 #  HERO Route Decision Python Notebook 
 # ------------------------------------------------------------
-# - Gets Google traffic-aware optimal route (as baseline)
 # - Gets theoretical route with TRAFFIC_UNAWARE
+# - Gets Google traffic-aware optimal route (as baseline), or its forecast from the traffic history
 # - Applies HERO (emergency) advantage to theoretical and google route
 # - Picks faster option and publishes to Eventstream via UDF
+# - Steps run as hero_dag stages: SMS, publishes and telemetry in parallel once decided
 # ============================================================
 
 dispatch = {
@@ -158,54 +329,69 @@ dispatch = {
     "dest_lon": dest_lon
 }
 
+# Each step is a stage of a hero_dag StageDAG (wired in the "Run" cell): a stage receives the results of
+# the stages it depends on as keyword arguments, and stages that do not depend on each other run
+# concurrently.
 
-# ---------- 1) Google traffic-aware optimal (baseline) ----------
-try:
-    log.info("Fetching Google TRAFFIC_AWARE_OPTIMAL route...")
-    aware = hero_functions.get_route(params={
-        "origin_lat": dispatch["origin_lat"],
-        "origin_lon": dispatch["origin_lon"],
-        "dest_lat":   dispatch["dest_lat"],
-        "dest_lon":   dispatch["dest_lon"],
-        "api_key":    API_KEY,
-        "routing_preference": "TRAFFIC_AWARE_OPTIMAL"
-    })
-
-    eta_google = float(aware["eta_min"])
-    dist_google = int(aware["distance_m"])
-    congestion_score = aware["congestion_score"]
-    congestion_label = aware["congestion_label"]
-    pts_google = aware["coordinates"]           # list of (lat, lon)
-    route_id_google = aware["route_id"]
-
+# ---------- 1) Theoretical (no live traffic) ----------
+def stage_theoretical():
+    log.info("Fetching Google TRAFFIC_UNAWARE (theoretical) route...")
+    with tracer.span("get_route_theoretical") as sp:
+        theoretical = hero_functions.get_route(params={
+            "origin_lat": dispatch["origin_lat"],
+            "origin_lon": dispatch["origin_lon"],
+            "dest_lat":   dispatch["dest_lat"],
+            "dest_lon":   dispatch["dest_lon"],
+            "api_key":    API_KEY,
+            "routing_preference": "TRAFFIC_UNAWARE",
+            "response_format": "packed"     # base64 float32/int16 arrays instead of JSON lists
+        })
+        sp["payload_bytes"] = payload_size(theoretical)
+        theoretical = unpack_route(theoretical)
+
+    log.info(f"Theoretical: ETA={float(theoretical['eta_min']):.2f} min, "
+             f"dist={int(theoretical['distance_m'])/1000:.2f} km")
+    return theoretical
+
+# ---------- 2) Google traffic-aware optimal (baseline) ----------
+# Live call, or the congestion forecast of hero_traffic_history on the theoretical geometry when it is
+# confident enough for these cells at this hour of week (or when the live call hits the API quota).
+# Live responses are archived for the forecaster. With traffic_forecast="off" the stage has no
+# dependency and runs concurrently with the theoretical route.
+def fetch_aware():
+    with tracer.span("get_route_aware") as sp:
+        route = hero_functions.get_route(params={
+            "origin_lat": dispatch["origin_lat"],
+            "origin_lon": dispatch["origin_lon"],
+            "dest_lat":   dispatch["dest_lat"],
+            "dest_lon":   dispatch["dest_lon"],
+            "api_key":    API_KEY,
+            "routing_preference": "TRAFFIC_AWARE_OPTIMAL",
+            "response_format": "packed"     # base64 float32/int16 arrays instead of JSON lists
+        })
+        sp["payload_bytes"] = payload_size(route)
+    return unpack_route(route)
 
-    log.info(f"Google aware: ETA={eta_google:.2f} min, dist={dist_google/1000:.2f} km, congestion={congestion_label}")
-except Exception as e:
-    log.exception("get_route failed for Google-aware")
-    raise
+traffic_archive = TrafficArchive()
 
-# ---------- 2) Theoretical (no live traffic) ----------
-try:
-    log.info("Fetching Google TRAFFIC_UNAWARE (theoretical) route...")
-    theoretical = hero_functions.get_route(params={
-        "origin_lat": dispatch["origin_lat"],
-        "origin_lon": dispatch["origin_lon"],
-        "dest_lat":   dispatch["dest_lat"],
-        "dest_lon":   dispatch["dest_lon"],
-        "api_key":    API_KEY,
-        "routing_preference": "TRAFFIC_UNAWARE"
-    })
-    
-    eta_theoretical = float(theoretical["eta_min"])
-    dist_theoretical = int(theoretical["distance_m"])
-    pts_theoretical = theoretical["coordinates"] # list of (lat, lon)
-    route_id_theoretical = theoretical["route_id"]
+def stage_aware(theoretical=None):
+    forecaster = None
+    if theoretical is not None:
+        try:
+            with tracer.span("load_forecaster"):
+                forecaster = CongestionForecaster.load(cells=route_cells(theoretical["coordinates"]))
+        except Exception as e:
+            log.warning(f"Congestion forecaster unavailable, live traffic only: {e}")
 
-    log.info(f"Theoretical: ETA={eta_theoretical:.2f} min, dist={dist_theoretical/1000:.2f} km")
+    log.info("Fetching Google TRAFFIC_AWARE_OPTIMAL route...")
+    aware, source = traffic_aware_route(fetch_aware, theoretical, forecaster, traffic_forecast,
+                                        forecast_min_confidence, traffic_archive)
+    aware["traffic_source"] = source
 
-except Exception as e:
-    log.exception("get_route failed for Google-aware")
-    raise
+    log.info(f"Google aware ({source}): ETA={float(aware['eta_min']):.2f} min, "
+             f"dist={int(aware['distance_m'])/1000:.2f} km, congestion={aware['congestion_label']}, "
+             f"forecast confidence={aware.get('forecast_confidence')}")
+    return aware
 
 #---------- 3) HERO adjustment (apply ONLY to theoretical) ----------
 def compute_hero_eta(eta_min: float, congestion_score: float) -> float:
@@ -214,7 +400,7 @@ def compute_hero_eta(eta_min: float, congestion_score: float) -> float:
     - Base advantage 10% -> reflects use of sirens, right-of-way, priority lanes (buses), skip queues and traffic signals
     - The advantage increases as congestion grows
     - Cap at 35% reduction -> failsafe tp prevent the model from exaggerating emergency gains and to stay realistic
-    This is a simple PoC heuristic, it will be replaced in the furure by an ML model 
+    This is a simple PoC heuristic, it will be replaced in the furure by an ML model
     train on the telemetry and route decision historical data accumulated by this solution.
     """
     advantage = 0.10 + 0.25 * congestion_score
@@ -222,144 +408,173 @@ def compute_hero_eta(eta_min: float, congestion_score: float) -> float:
     return round(eta_min * (1 - advantage), 2)
 
 
-# Create a pandas DF 
-features_for_current_trip = pd.DataFrame([{
-    "congestion_score": congestion_score,
-    "eta_theoretical_min": eta_theoretical,
-    "distance_m_theoretical": dist_theoretical,
-    "hour_of_day": datetime.utcnow().hour,
-    "dow": datetime.utcnow().weekday(),
-    "avg_speed_kmh": 50, #in the future replace with avg speed from all segments from tomtom or custom model      
-    "telemetry_points": len(pts_theoretical)
-}])
-
-# Cast all to float64 to match MLflow schema
-features_for_current_trip = features_for_current_trip.astype({
-    "congestion_score": "float64",
-    "eta_theoretical_min": "float64",
-    "distance_m_theoretical": "float64",
-    "hour_of_day": "float64",
-    "dow": "float64",
-    "avg_speed_kmh": "float64",
-    "telemetry_points": "float64"
-})
-
-# eta hero theoretical: apply ml model
-try:
-    predicted_adv = float(ml_model.predict(features_for_current_trip)[0])
-    # sanity clamp
-    predicted_adv = max(0.05, min(predicted_adv, 0.35))  # between 5% and 35% improvement
-    eta_theoretical_hero = round(eta_theoretical * (1 - predicted_adv), 2)
-    used_model = "ml"
-except Exception as e:
-    log.warning(f"ML prediction failed, fallback to heuristic: {e}")
-    predicted_adv = None
-    eta_theoretical_hero = compute_hero_eta(eta_theoretical, congestion_score)  # heuristic
-    used_model = "heuristic"
-
-time_saved_vs_google = round(eta_google - eta_theoretical_hero, 2)
-saved_min = -time_saved_vs_google if time_saved_vs_google < 0 else time_saved_vs_google
-
-# Decision rule 
 REROUTE_THRESHOLD_MIN = 2.0
-if eta_theoretical_hero < eta_google - REROUTE_THRESHOLD_MIN:
-    decision = "hero"
-else:
-    decision = "google"
 
-log.info(f"Decision={decision} | Model={used_model} | PredAdv={predicted_adv}")
+def stage_decide(theoretical, aware):
+    eta_theoretical = float(theoretical["eta_min"])
+    dist_theoretical = int(theoretical["distance_m"])
+    pts_theoretical = theoretical["coordinates"] # (n, 2) array of lat, lon
+    eta_google = float(aware["eta_min"])
+    congestion_score = aware["congestion_score"]
+
+    # Create a pandas DF
+    features_for_current_trip = pd.DataFrame([{
+        "congestion_score": congestion_score,
+        "eta_theoretical_min": eta_theoretical,
+        "distance_m_theoretical": dist_theoretical,
+        "hour_of_day": datetime.utcnow().hour,
+        "dow": datetime.utcnow().weekday(),
+        "avg_speed_kmh": 50, #in the future replace with avg speed from all segments from tomtom or custom model
+        "telemetry_points": len(pts_theoretical)
+    }])
 
-chosen_pts = pts_theoretical if decision == "hero" else pts_google
-chosen_dist = dist_theoretical if decision == "hero" else dist_google
-chosen_eta  = eta_theoretical_hero if decision == "hero" else eta_google
-chosen_route_id = route_id_theoretical if decision == "hero" else route_id_google
-chosen_mode = "TRAFFIC_UNAWARE" if decision == "hero" else "TRAFFIC_AWARE_OPTIMAL"
+    # Cast to the dtypes of the MLflow input schema (float32/int16 since the Arrow loader), float64 if unknown
+    try:
+        input_schema = ml_model.metadata.get_input_schema()
+        schema_dtypes = {c.name: c.type.to_numpy() for c in input_schema.inputs} if input_schema else {}
+    except Exception:
+        schema_dtypes = {}
+    features_for_current_trip = features_for_current_trip.astype({
+        col: schema_dtypes.get(col, "float64") for col in features_for_current_trip.columns
+    })
+    online_features = {k: float(v) for k, v in features_for_current_trip.iloc[0].items()}
 
+    # eta hero theoretical: apply ml model
+    try:
+        with tracer.span("predict") as sp:
+            sp["payload_bytes"] = int(features_for_current_trip.memory_usage(deep=True).sum())
+            predicted_adv = float(ml_model.predict(features_for_current_trip)[0])
+        baseline_adv = predicted_adv
+        used_model = "ml"
+        # online residual correction (hero_online_model), learned from completed missions since the last AutoML run
+        try:
+            online_model = OnlineResidualModel.load(baseline=model_uri)
+            if online_model.updates >= online_min_updates:
+                predicted_adv = online_model.predict(online_features, baseline_adv)
+                used_model = "ml+online"
+        except Exception as e:
+            log.warning(f"Online correction skipped: {e}")
+        # sanity clamp
+        predicted_adv = max(0.05, min(predicted_adv, 0.35))  # between 5% and 35% improvement
+        eta_theoretical_hero = round(eta_theoretical * (1 - predicted_adv), 2)
+    except Exception as e:
+        log.warning(f"ML prediction failed, fallback to heuristic: {e}")
+        predicted_adv = None
+        baseline_adv = None
+        eta_theoretical_hero = compute_hero_eta(eta_theoretical, congestion_score)  # heuristic
+        used_model = "heuristic"
+
+    time_saved_vs_google = round(eta_google - eta_theoretical_hero, 2)
+    saved_min = -time_saved_vs_google if time_saved_vs_google < 0 else time_saved_vs_google
+
+    # Decision rule
+    if eta_theoretical_hero < eta_google - REROUTE_THRESHOLD_MIN:
+        decision = "hero"
+    else:
+        decision = "google"
 
-log.info(f"Decision: {decision.upper()} | google={eta_google:.2f} | hero={eta_theoretical_hero:.2f} | saved={saved_min:.2f} min")
+    log.info(f"Decision={decision} | Model={used_model} | PredAdv={predicted_adv}")
+    log.info(f"Decision: {decision.upper()} | google={eta_google:.2f} | hero={eta_theoretical_hero:.2f} | saved={saved_min:.2f} min")
 
+    chosen = theoretical if decision == "hero" else aware
+    return {
+        "decision": decision,
+        "used_model": used_model,
+        "baseline_adv": baseline_adv,
+        "online_features": online_features,
+        "eta_theoretical": eta_theoretical,
+        "eta_google": eta_google,
+        "saved_min": saved_min,
+        "chosen_pts": chosen["coordinates"],
+        "chosen_eta": eta_theoretical_hero if decision == "hero" else eta_google,
+        "chosen_route_id": chosen["route_id"],
+        "chosen_mode": "TRAFFIC_UNAWARE" if decision == "hero" else "TRAFFIC_AWARE_OPTIMAL",
+        "chosen_segments": chosen.get("segments"),
+        "ts": int(time.time() * 1000),  # epoch milliseconds, event schema v2; shared by analysis and segments
+    }
 
-#  -----------   4) send sms with static map ------------
-try:
-    hero_functions.send_sms_with_map(params={
-        "to_phone": TO_PHONE,
-        "text_prefix": f"HERO REROUTE for {dispatch['vehicle_id']}:", 
-        "gmaps_api_key": API_KEY,
-        "twilio_sid": TWILIO_SID,
-        "twilio_token": TWILIO_TOKEN,
-        "twilio_from": TWILIO_FROM,
-        "polyline": aware["polyline"] if decision=="GOOGLE" else theoretical["polyline"],
-        "decision": decision
-    })
-    log.info(f"Sent SMS message")
-except Exception as e:
-    log.exception("SMS sending failed")
+
+#  -----------   4) queue sms with static map (delivered in background) ------------
+def stage_sms(theoretical, aware, decide):
+    decision = decide["decision"]
+    with tracer.span("send_sms"):
+        sms_id = outbox.enqueue(TO_PHONE, {
+            "text_prefix": f"HERO REROUTE for {dispatch['vehicle_id']}:",
+            "gmaps_api_key": API_KEY,
+            "twilio_sid": TWILIO_SID,
+            "twilio_token": TWILIO_TOKEN,
+            "twilio_from": TWILIO_FROM,
+            "polyline": aware["polyline"] if decision=="GOOGLE" else theoretical["polyline"],
+            "decision": decision
+        })
+    log.info(f"Queued SMS message {sms_id}")
+    return sms_id
 
 # ---------- 5) Publish route_analysis ----------
-try:
-    ts = datetime.utcnow().isoformat() + "Z"
+def stage_publish_analysis(theoretical, aware, decide):
     analysis_event = {
-        "mission_id": dispatch["mission_id"],
-        "timestamp": ts,
+        "mission_id": int(dispatch["mission_id"]),
+        "timestamp": decide["ts"],
         "vehicle_id": dispatch["vehicle_id"],
-        "route_id": chosen_route_id,
-        "eta_google_aware_min": eta_google,
-        "eta_theoretical_min": eta_theoretical,
-        "eta_hero_min": chosen_eta,
-        "time_saved_vs_google_min": saved_min,
-        "distance_m_theoretical": dist_theoretical,
-        "distance_m_google": dist_google,
-        "decision": decision,
-        "congestion_score": congestion_score,
-        "congestion_label": congestion_label
+        "route_id": decide["chosen_route_id"],
+        "eta_google_aware_min": decide["eta_google"],
+        "eta_theoretical_min": decide["eta_theoretical"],
+        "eta_hero_min": decide["chosen_eta"],
+        "time_saved_vs_google_min": decide["saved_min"],
+        "distance_m_theoretical": int(theoretical["distance_m"]),
+        "distance_m_google": int(aware["distance_m"]),
+        "decision": decide["decision"],
+        "congestion_score": aware["congestion_score"],
+        "congestion_label": aware["congestion_label"],
+        # "forecast" / "forecast_quota": eta_google_aware_min is the forecaster's, not Google's
+        "traffic_source": aware["traffic_source"],
+        "forecast_confidence": aware.get("forecast_confidence")
     }
 
-    if analysis_event:
+    with tracer.span("publish_analysis") as sp:
+        sp["payload_bytes"] = payload_size(analysis_event)
         hero_functions.publish_events(params={
             "connection_string": EH_CONN_ANALYSIS,
             "events": analysis_event,
-            "partition_key": str(dispatch["mission_id"]) 
+            "partition_key": str(dispatch["mission_id"]),
+            "schema": "route_analysis"
         })
-        log.info(f"Published {len(analysis_event)} route_analysis events")
-    else:
-        log.warning("No analysis events to publish (empty coordinates list)")
-except Exception as e:
-    log.exception("Route_analysis publish failed")
-    print(e)
+    log.info(f"Published {len(analysis_event)} route_analysis events")
+
 # ---------- 6) Publish route_segments ----------
-try:
+def stage_publish_segments(decide):
     segment_events = [
         {
-            "mission_id": dispatch["mission_id"],
-            "route_id": chosen_route_id,
-            "timestamp": ts,
+            "mission_id": int(dispatch["mission_id"]),
+            "route_id": decide["chosen_route_id"],
+            "timestamp": decide["ts"],
             "sequence": i,
             "latitude": float(lat),
             "longitude": float(lon)
-        } for i, (lat, lon) in enumerate(chosen_pts)
+        } for i, (lat, lon) in enumerate(decide["chosen_pts"])
     ]
 
-    if segment_events:
+    if not segment_events:
+        log.warning("No segment events to publish (empty coordinates list)")
+        return 0
+    with tracer.span("publish_segments") as sp:
+        sp["payload_bytes"] = payload_size(segment_events)
         hero_functions.publish_events(params={
             "connection_string": EH_CONN_SEGMENTS,
             "events": segment_events,
-            "partition_key": str(dispatch["mission_id"]) 
+            "partition_key": str(dispatch["mission_id"]),
+            "schema": "route_segments"
         })
-        log.info(f"Published {len(segment_events)} route_segments")
-    else:
-        log.warning("No segment events to publish (empty coordinates list)")
-except Exception as e:
-    log.exception("Route_segments publish failed")
-# ---------- SUMMARY ----------
-log.info("HERO pipeline completed.")
-print({
-    "eta_google_min": eta_google,
-    "eta_theoretical_min": eta_theoretical,
-    "eta_hero_min": chosen_eta,
-    "decision": decision,
-    "points": len(chosen_pts)
-})
+    log.info(f"Published {len(segment_events)} route_segments")
+    return len(segment_events)
+
+# ---------- archive the live traffic response for the forecaster ----------
+def stage_archive_flush(aware):
+    return traffic_archive.flush()
 
+# ---------- both geometries to the hero_route_store inbox (appended by the single writer session) ----------
+def stage_store_routes(theoretical, aware):
+    return post_routes([theoretical, aware])
 
 # METADATA ********************
 
@@ -375,12 +590,16 @@ print({
 # ====================================================
 
 
-def stream_telemetry_eta_based(points, vehicle_id, route_id, eta_min):
+def stream_telemetry_eta_based(points, vehicle_id, route_id, eta_min, segments=None):
     """
     Streams telemetry in the background.
     - Stops at destination.
-    - Interval chosen so total time ~ ETA.
+    - Timing from route_profile (hero_trajectory): segment lengths and speedReadingIntervals,
+      scaled so total time ~ ETA; speed_kmh is the speed actually driven on each segment.
     - Sequence increments from 0..N-1.
+    - telemetry_mode="adaptive" publishes only the fixes the dead-reckoning emitter asks for
+      (deviation > telemetry_tolerance_m, telemetry_max_interval_s elapsed, or status change).
+    Returns the actual trip duration in minutes, None if the simulation did not complete.
     """
     try:
         n = len(points)
@@ -390,51 +609,120 @@ def stream_telemetry_eta_based(points, vehicle_id, route_id, eta_min):
             return
 
         total_sec = max(10.0, float(eta_min) * 60.0)
-        # spread intervals over transitions (n-1 gaps). Keep last point immediate.
-        base_interval = total_sec / max(1, (n - 1))
+        profile = route_profile(points, segments or [], total_sec / 60.0)
+        # arrival time at each point relative to the start; the last point is the arrival
+        t_start = time.time()
 
         last_idx  = max(0, n - 1)
+        emitter = DeadReckoningEmitter(RouteTrack(points), telemetry_tolerance_m, telemetry_max_interval_s) \
+            if telemetry_mode == "adaptive" else None
 
         for i, (lat, lon) in enumerate(points):
-            # small variation for realism (±20%)
-            jitter = random.uniform(0.8, 1.2)
-            interval = base_interval * jitter
-            # progress = 0 if last_idx == 0 else int(round(100.0 * i / last_idx))
-            progress = 0 if i==0 else int(round(100.0 * i / last_idx))
+            # progress along the route distance, speed of the segment being driven (0 on arrival)
+            progress = int(round(100.0 * profile["cum_m"][i] / profile["cum_m"][-1])) if profile["cum_m"][-1] > 0 else 0
             status   = "arrived" if i == last_idx else "en_route"
-
-            # synthesize plausible speed/heading
-            speed_kmh = round(random.uniform(35, 75), 1)
-            heading_deg = round(random.uniform(0, 360), 1)
-
-            hero_functions.publish_vehicle_telemetry(params={
-                "connection_string": EH_CONN_TELEMETRY,
-                "vehicle_id": vehicle_id,
-                "route_id": route_id,
-                "points": [(lat, lon)],     # one point per call
-                "sequence": i,              # explicit sequence used by UDF
-                "speed_kmh": speed_kmh,
-                "status": status,
-                "progress_pct": progress
-            })
-
-            # sleep only between points; after last point we stop immediately
+            speed_kmh = round(float(profile["speed_kmh"][i]), 1) if i < last_idx else 0.0
+
+            if emitter is None or emitter.offer(i, lat, lon, time.time(), status):
+                hero_functions.publish_vehicle_telemetry(params={
+                    "connection_string": EH_CONN_TELEMETRY,
+                    "vehicle_id": vehicle_id,
+                    "route_id": route_id,
+                    "points": [(lat, lon)],     # one point per call
+                    "sequence": i,              # explicit sequence used by UDF
+                    "speed_kmh": speed_kmh,
+                    "status": status,
+                    "progress_pct": progress
+                })
+
+            # sleep until the next point is reached; after last point we stop immediately
             if i < n - 1:
-                time.sleep(interval)
+                time.sleep(max(0.0, t_start + profile["t_s"][i + 1] - time.time()))
 
         log.info(f"Telemetry complete for {vehicle_id} — arrived at destination.")
+        if emitter is not None:
+            log.info(f"Adaptive telemetry: {emitter.stats()}")
+        return (time.time() - t_start) / 60.0
 
     except Exception as e:
         log.error(f"Telemetry simulation error: {e}")
 
 
-# Start streaming telemetry
-telemetry_thread = stream_telemetry_eta_based(
-    points=chosen_pts,
-    vehicle_id=dispatch["vehicle_id"],
-    route_id=chosen_route_id,
-    eta_min=chosen_eta
-)
+def stage_telemetry(decide):
+    with tracer.span("telemetry"):
+        return stream_telemetry_eta_based(
+            points=decide["chosen_pts"],
+            vehicle_id=dispatch["vehicle_id"],
+            route_id=decide["chosen_route_id"],
+            eta_min=decide["chosen_eta"],
+            segments=decide["chosen_segments"]
+        )
+
+# completed mission -> online corrector inbox (folded by hero_dispatch_consumer or a scheduled hero_online_model);
+# missions decided on a forecast are left out, their congestion_score is not the live one the model learns from
+def stage_online_completion(aware, decide, telemetry):
+    if telemetry is None or decide["baseline_adv"] is None or aware["traffic_source"] != "live":
+        return None
+    completion = completion_record(int(dispatch["mission_id"]), decide["online_features"], decide["baseline_adv"],
+                                   decide["eta_theoretical"], telemetry, baseline_uri=model_uri)
+    if completion:
+        post_completion(completion)
+    return completion
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Run
+# ----------------------------------------------------
+# theoretical -> aware -> decide, then SMS, both publishes and telemetry start together; the
+# traffic archive and the route store are written as soon as the aware route is in. A failed side branch is logged
+# and only skips its own descendants; the notebook fails only when no decision could be made.
+# ====================================================
+
+dag = StageDAG()
+dag.add("theoretical", stage_theoretical)
+dag.add("aware", stage_aware, deps=("theoretical",) if traffic_forecast != "off" else ())
+dag.add("decide", stage_decide, deps=("theoretical", "aware"))
+dag.add("archive_flush", stage_archive_flush, deps=("aware",))
+dag.add("store_routes", stage_store_routes, deps=("theoretical", "aware"))
+dag.add("sms", stage_sms, deps=("theoretical", "aware", "decide"))
+dag.add("publish_analysis", stage_publish_analysis, deps=("theoretical", "aware", "decide"))
+dag.add("publish_segments", stage_publish_segments, deps=("decide",))
+dag.add("telemetry", stage_telemetry, deps=("decide",))
+dag.add("online_completion", stage_online_completion, deps=("aware", "decide", "telemetry"))
+
+try:
+    report = dag.run(required=("decide",))
+finally:
+    # wait for queued SMS before the session ends
+    if not outbox.close(timeout=60):
+        log.warning("SMS outbox not drained within 60s")
+    log.info(f"SMS outbox: {outbox.stats()}")
+    tracer.flush(hero_functions.publish_events, EH_CONN_METRICS)
+
+# ---------- SUMMARY ----------
+decide = report.result("decide")
+log.info(f"Stages: {report.stages}")
+log.info(f"DAG: {report.summary()}")
+log.info(f"Outputs ready after {report.ready_ms('sms', 'publish_analysis', 'publish_segments')} ms")
+log.info("HERO pipeline completed.")
+print({
+    "eta_google_min": decide["eta_google"],
+    "eta_theoretical_min": decide["eta_theoretical"],
+    "eta_hero_min": decide["chosen_eta"],
+    "decision": decide["decision"],
+    "traffic_source": report.result("aware")["traffic_source"],
+    "points": len(decide["chosen_pts"]),
+    "actual_eta_min": report.result("telemetry"),
+    "failed_stages": report.summary()["failed"]
+})
 
 
 # METADATA ********************
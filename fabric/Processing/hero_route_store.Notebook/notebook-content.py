@@ -0,0 +1,376 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     },
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the store with: %run hero_route_store
+# Schedule with fold_routes = True when hero_dispatch_consumer (which folds the inbox itself) is not running.
+fold_routes = False
+benchmark_route_store = False
+route_store_root = "/lakehouse/default/Files/hero/route_store"
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_trajectory
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+log = logging.getLogger("hero-route-store")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Route geometry store
+# ----------------------------------------------------
+# - coords.f32: (lat, lon) float32 pairs of every route, appended back to back
+# - segments.i32: (start, end, speed category) int32 triplets, category = index in SPEED_CATEGORIES
+# - index.bin: one fixed-size record per route (route_id, offsets and lengths in both files)
+# - HEAD: committed sizes of the three files, replaced atomically at the end of each write
+# Readers memory-map the committed part of the files and return read-only views into the map: no
+# copy, no decoding. Bytes past HEAD (a write in progress or a crashed one) are never read, and the
+# writer truncates them. Any number of readers, in this session or others.
+# A single writer session appends (hero_dispatch_consumer, or this notebook on a schedule): flock does
+# not coordinate Fabric sessions on the OneLake mount, so per-dispatch runs post their routes to the
+# inbox (one small file each, atomic rename) and the writer folds it, as for hero_online_model.
+# ====================================================
+
+INDEX_DTYPE = np.dtype([("route_id", "S48"), ("coord_start", "<i8"), ("n_points", "<i4"),
+                        ("seg_start", "<i8"), ("n_segments", "<i4")])
+_FILES = {"coords": "coords.f32", "segments": "segments.i32", "index": "index.bin"}
+ROUTE_INBOX = f"{route_store_root}/inbox"
+_ROW_BYTES = {"coords": 8, "segments": 12, "index": INDEX_DTYPE.itemsize}
+
+
+def read_head(root: str = route_store_root) -> dict:
+    try:
+        with open(os.path.join(root, "HEAD")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"routes": 0, "coords": 0, "segments": 0}
+
+
+def encode_segments(segments) -> np.ndarray:
+    """get_route 'segments' ({start, end, speed_category}) -> (m, 3) int32, category -1 if unknown."""
+    codes = {name: i for i, name in enumerate(SPEED_CATEGORIES)}
+    return np.array([(int(s["start"]), int(s["end"]), codes.get(s.get("speed_category"), -1)) for s in segments or []],
+                    dtype=np.int32).reshape(-1, 3)
+
+
+def decode_segments(packed: np.ndarray) -> list:
+    return [{"start": int(a), "end": int(b), "speed_category": SPEED_CATEGORIES[c] if c >= 0 else None}
+            for a, b, c in packed.tolist()]
+
+
+class RouteStoreWriter:
+    """
+    Appends routes (unpack_route shape: route_id, coordinates, segments). Each put_many is one
+    transaction, threads of the session are serialized; a route_id already in the store is skipped.
+    Only one writer session per store: a HEAD that moved since this writer's last commit means another
+    writer, and the append is refused instead of truncating its bytes.
+    sync=True fsyncs the data files before HEAD is replaced.
+    """
+
+    def __init__(self, root: str = route_store_root, sync: bool = False):
+        self.root = root
+        self.sync = sync
+        self._known = set()
+        self._head = None                       # HEAD sizes as last committed (or first read) by this writer
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, route: dict) -> bool:
+        return self.put_many([route]) == 1
+
+    def put_many(self, routes) -> int:
+        routes = [r for r in routes if str(r["route_id"]) not in self._known]
+        if not routes:
+            return 0                            # e.g. an inbox file folded twice: no I/O
+        with self._lock:
+            return self._append(routes)
+
+    def _append(self, routes) -> int:
+        head = read_head(self.root)
+        if self._head is None:
+            self._load_known(head)              # the whole index once per writer session, then only its own appends
+        elif {k: head[k] for k in ("routes", "coords", "segments")} != self._head:
+            raise RuntimeError(f"Route store {self.root}: HEAD moved under this writer, another writer session is running")
+        coords, segments, index, ids = [], [], [], set()
+        n_coords, n_segments = head["coords"], head["segments"]
+        for route in routes:
+            route_id = str(route["route_id"])
+            if route_id in self._known or route_id in ids:
+                continue
+            ids.add(route_id)
+            xy = np.ascontiguousarray(route["coordinates"], dtype=np.float32).reshape(-1, 2)
+            seg = encode_segments(route.get("segments"))
+            index.append((route_id.encode(), n_coords, len(xy), n_segments, len(seg)))
+            coords.append(xy)
+            segments.append(seg)
+            n_coords += len(xy)
+            n_segments += len(seg)
+        if not index:
+            return 0
+
+        parts = {"coords": coords, "segments": segments, "index": [np.array(index, dtype=INDEX_DTYPE)]}
+        for name, arrays in parts.items():
+            path = os.path.join(self.root, _FILES[name])
+            with open(path, "ab") as f:
+                committed = head[name if name != "index" else "routes"] * _ROW_BYTES[name]
+                if f.tell() > committed:
+                    f.truncate(committed)           # leftovers of a writer that died before HEAD
+                for a in arrays:
+                    f.write(a.tobytes())
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+
+        new_head = {"routes": head["routes"] + len(index), "coords": n_coords, "segments": n_segments,
+                    "updated_at": time.time()}
+        tmp = os.path.join(self.root, f"HEAD.{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(new_head, f)
+        os.replace(tmp, os.path.join(self.root, "HEAD"))
+        self._known.update(ids)
+        self._head = {k: new_head[k] for k in ("routes", "coords", "segments")}
+        return len(index)
+
+    def _load_known(self, head: dict):
+        """route_ids already committed when this writer session starts."""
+        if head["routes"]:
+            records = np.fromfile(os.path.join(self.root, _FILES["index"]), dtype=INDEX_DTYPE, count=head["routes"])
+            self._known.update(r.decode() for r in records["route_id"])
+        self._head = {k: head[k] for k in ("routes", "coords", "segments")}
+
+
+class RouteStore:
+    """
+    Reader: coordinates(route_id) and segments(route_id) are read-only numpy views into the memory-mapped
+    files, valid for the life of the array even after refresh(). A lookup miss refreshes once, so routes
+    written after the reader was opened are found without an explicit refresh().
+    """
+
+    def __init__(self, root: str = route_store_root):
+        self.root = root
+        self._index = {}
+        self._routes = 0
+        self._coords = np.empty((0, 2), dtype=np.float32)
+        self._segments = np.empty((0, 3), dtype=np.int32)
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Maps the routes committed since the last refresh; returns how many."""
+        with self._lock:
+            head = read_head(self.root)
+            new = head["routes"] - self._routes
+            if new <= 0:
+                return 0
+            records = np.fromfile(os.path.join(self.root, _FILES["index"]), dtype=INDEX_DTYPE, count=new,
+                                  offset=self._routes * INDEX_DTYPE.itemsize)
+            if head["coords"]:
+                # plain ndarray over the map: slicing a np.memmap subclass costs ~10x more
+                self._coords = np.asarray(np.memmap(os.path.join(self.root, _FILES["coords"]), dtype=np.float32,
+                                                    mode="r", shape=(head["coords"], 2)))
+            if head["segments"]:
+                self._segments = np.asarray(np.memmap(os.path.join(self.root, _FILES["segments"]), dtype=np.int32,
+                                                      mode="r", shape=(head["segments"], 3)))
+            for r in records.tolist():
+                self._index[r[0].decode()] = r[1:]
+            self._routes = head["routes"]
+            return new
+
+    def _entry(self, route_id: str):
+        entry = self._index.get(route_id)
+        if entry is None and self.refresh():
+            entry = self._index.get(route_id)
+        if entry is None:
+            raise KeyError(route_id)
+        return entry
+
+    def coordinates(self, route_id: str) -> np.ndarray:
+        """(n, 2) float32 lat, lon."""
+        start, n, _, _ = self._entry(route_id)
+        return self._coords[start:start + n]
+
+    def segments(self, route_id: str) -> np.ndarray:
+        """(m, 3) int32 start, end, SPEED_CATEGORIES index (-1 if unknown)."""
+        _, _, start, m = self._entry(route_id)
+        return self._segments[start:start + m]
+
+    def route(self, route_id: str) -> dict:
+        """unpack_route shape, for route_profile / RouteTrack / forecast_route."""
+        return {"route_id": route_id, "coordinates": self.coordinates(route_id),
+                "segments": decode_segments(self.segments(route_id))}
+
+    def __contains__(self, route_id: str) -> bool:
+        return route_id in self._index or (self.refresh() > 0 and route_id in self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def route_ids(self) -> list:
+        return list(self._index)
+
+
+def post_routes(routes, inbox: str = ROUTE_INBOX) -> str:
+    """For sessions that are not the writer: one .npz per call, renamed into the inbox once complete."""
+    os.makedirs(inbox, exist_ok=True)
+    arrays = {"route_ids": np.array([str(r["route_id"]) for r in routes])}
+    for i, route in enumerate(routes):
+        arrays[f"coords_{i}"] = np.ascontiguousarray(route["coordinates"], dtype=np.float32).reshape(-1, 2)
+        arrays[f"segments_{i}"] = encode_segments(route.get("segments"))
+    path = os.path.join(inbox, f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.npz")
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+    return path
+
+
+def fold_route_inbox(writer: RouteStoreWriter, inbox: str = ROUTE_INBOX, max_files: int = 10_000) -> int:
+    """Appends the posted routes in posting order, then removes their files; returns the routes appended."""
+    if not os.path.isdir(inbox):
+        return 0
+    files = sorted(f for f in os.listdir(inbox) if f.endswith(".npz"))[:max_files]
+    routes, folded = [], []
+    for name in files:
+        try:
+            with np.load(os.path.join(inbox, name)) as z:
+                for i, route_id in enumerate(z["route_ids"].tolist()):
+                    routes.append({"route_id": route_id, "coordinates": z[f"coords_{i}"],
+                                   "segments": decode_segments(z[f"segments_{i}"])})
+            folded.append(name)
+        except Exception:
+            log.exception(f"Route inbox file {name} skipped")
+    appended = writer.put_many(routes) if routes else 0
+    for name in folded:
+        os.remove(os.path.join(inbox, name))
+    return appended
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Fold posted routes (fold_routes = True) ----------
+if fold_routes:
+    t0 = time.perf_counter()
+    appended = fold_route_inbox(RouteStoreWriter())
+    log.info(f"Route store: {appended} posted route(s) appended in {time.perf_counter() - t0:.1f}s")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Benchmark (benchmark_route_store = True) ----------
+# 20k synthetic routes: write throughput, then geometry lookup vs decoding a packed get_route response.
+if benchmark_route_store:
+    import base64
+    import tempfile
+
+    rng = np.random.default_rng(3)
+    bench_root = tempfile.mkdtemp(prefix="route_store_")
+    routes_in = []
+    for _ in range(20_000):
+        pts, segs = synthetic_route(rng, int(rng.integers(50, 400)))
+        routes_in.append({"route_id": str(uuid.uuid4()), "coordinates": np.asarray(pts), "segments": segs})
+
+    writer = RouteStoreWriter(bench_root)
+    t0 = time.perf_counter()
+    for i in range(0, len(routes_in), 100):
+        writer.put_many(routes_in[i:i + 100])
+    t_write = time.perf_counter() - t0
+
+    store = RouteStore(bench_root)
+    ids = [r["route_id"] for r in routes_in]
+    sample = [ids[i] for i in rng.integers(0, len(ids), 50_000)]
+    t0 = time.perf_counter()
+    for rid in sample:
+        xy = store.coordinates(rid)
+    t_view = (time.perf_counter() - t0) / len(sample)
+    t0 = time.perf_counter()
+    for rid in sample[:5_000]:
+        store.route(rid)
+    t_route = (time.perf_counter() - t0) / 5_000
+
+    # the alternative: keep the packed get_route response and decode it on every read
+    packed = {"route_id": ids[0], "coordinates_f32": base64.b64encode(routes_in[0]["coordinates"].astype("<f4").tobytes()).decode(),
+              "segments_packed": base64.b64encode(encode_segments(routes_in[0]["segments"]).astype("<i2").tobytes()).decode(),
+              "segments_dtype": "int16", "speed_categories": SPEED_CATEGORIES}
+    t0 = time.perf_counter()
+    for _ in range(5_000):
+        unpack_route(packed)
+    t_unpack = (time.perf_counter() - t0) / 5_000
+
+    assert np.allclose(store.coordinates(ids[-1]), routes_in[-1]["coordinates"], atol=1e-5)
+    print({"routes": len(store), "points": int(read_head(bench_root)["coords"]),
+           "write_routes_per_s": round(len(routes_in) / t_write),
+           "coordinates_us": round(t_view * 1e6, 2), "route_with_segments_us": round(t_route * 1e6, 2),
+           "unpack_packed_us": round(t_unpack * 1e6, 2)})
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
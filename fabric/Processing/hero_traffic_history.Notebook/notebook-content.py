@@ -0,0 +1,613 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "1d7761b2-7df4-4f89-b042-3fd49f3bd776",
+# META       "default_lakehouse_name": "lakehouse",
+# META       "default_lakehouse_workspace_id": "31f66446-fbac-4a10-b8cd-612c2c7b9c9d",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "1d7761b2-7df4-4f89-b042-3fd49f3bd776"
+# META         }
+# META       ]
+# META     },
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the archive and the forecaster with: %run hero_traffic_history
+# Schedule this notebook (e.g. daily) with train_forecaster = True to fold new history into the forecaster.
+train_forecaster = False
+benchmark_forecaster = False        # synthetic accuracy / latency check at the end of the notebook
+traffic_history_root = "/lakehouse/default/Files/hero/traffic_history"
+forecaster_half_life_days = 28.0
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+log = logging.getLogger("hero-traffic-history")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+%run hero_trajectory
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Traffic-interval archive
+# ----------------------------------------------------
+# - every live get_route response is reduced to one row per (grid cell, speed category)
+#   with the meters of route covered, instead of keeping only its congestion_score
+# - rows carry the hour of week (UTC, Monday 00:00 = 0) of the call
+# - Parquet files under traffic_history_root, Hive-partitioned by day (date=YYYY-MM-DD)
+# - written_at is the flush time, also in the file name (part-<epoch ms>-...): writers flush late, so
+#   incremental readers key on it, not on observed_at, and never skip a row flushed after their watermark
+# ====================================================
+
+CELL_DEG = 0.005                    # ~550 m north-south, ~390 m east-west around Milan
+HOURS_PER_WEEK = 168
+FORECASTER_STATE_PATH = f"{traffic_history_root}/_forecaster/state.parquet"   # "_" keeps it out of the dataset
+
+# congestion value of each speed category: get_route's weights, which its congestion_score averages per interval
+CONGESTION_VALUES = np.array([0.0, 0.5, 1.0])       # NORMAL / SLOW / TRAFFIC_JAM (SPEED_CATEGORIES order)
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("observed_at", pa.timestamp("ms")),
+    ("hour_of_week", pa.int16()),
+    ("cell", pa.int64()),
+    ("category", pa.int8()),
+    ("length_m", pa.float32()),
+    ("route_id", pa.string()),
+    ("written_at", pa.timestamp("ms")),
+])
+OBSERVATION_COLUMNS = ARCHIVE_SCHEMA.names[:-1]    # written_at is stamped by flush()
+
+
+def cell_ids(lat, lon) -> np.ndarray:
+    """Grid cell id (int64) of each coordinate."""
+    row = np.floor((np.asarray(lat, dtype=float) + 90.0) / CELL_DEG).astype(np.int64)
+    col = np.floor((np.asarray(lon, dtype=float) + 180.0) / CELL_DEG).astype(np.int64)
+    return row * 100_000 + col
+
+
+def hour_of_week(ts: datetime) -> int:
+    return ts.weekday() * 24 + ts.hour
+
+
+def _segment_cells(coordinates):
+    """Length (m) and grid cell of the midpoint of every polyline segment."""
+    pts = np.asarray(coordinates, dtype=float)
+    length, _ = _segment_geometry(pts[:, 0], pts[:, 1])
+    mid = (pts[:-1] + pts[1:]) / 2.0
+    return length, cell_ids(mid[:, 0], mid[:, 1])
+
+
+def route_cells(coordinates) -> np.ndarray:
+    """Distinct grid cells crossed by a route."""
+    return np.unique(_segment_cells(coordinates)[1])
+
+
+def route_observations(route: dict, observed_at: datetime) -> dict:
+    """
+    Archive rows of one unpacked get_route response, as OBSERVATION_COLUMNS (numpy arrays);
+    None when it has no speed intervals.
+    """
+    pts = route.get("coordinates")
+    if pts is None or len(pts) < 2 or not route.get("segments"):
+        return None
+    length, cells = _segment_cells(pts)
+    codes = segment_categories(len(length), route["segments"])
+    keep = codes >= 0
+    # sum the meters per (cell, category)
+    key, inverse = np.unique(cells[keep] * 4 + codes[keep], return_inverse=True)
+    meters = np.bincount(inverse, weights=length[keep])
+    n = len(key)
+    return {
+        "observed_at": np.full(n, np.datetime64(observed_at, "ms")),
+        "hour_of_week": np.full(n, hour_of_week(observed_at), dtype=np.int16),
+        "cell": key // 4,
+        "category": (key % 4).astype(np.int8),
+        "length_m": meters.astype(np.float32),
+        "route_id": np.full(n, str(route.get("route_id", "")), dtype=object),
+    }
+
+
+class TrafficArchive:
+    """
+    Append-only Parquet archive of speed intervals.
+    - record() buffers numpy columns in memory and is safe to call from several threads
+    - flush() writes one zstd Parquet file per day touched (also triggered every flush_rows rows, and by
+      record() / flush_due() once the oldest buffered row is flush_s old)
+    - compact() merges the small files of a closed day into one
+    """
+
+    def __init__(self, root: str = traffic_history_root, flush_rows: int = 50_000, flush_s: float = None):
+        self.root = root
+        self.flush_rows = flush_rows
+        self.flush_s = flush_s
+        self._buffer = []
+        self._rows = 0
+        self._since = None              # monotonic time of the oldest buffered row
+        self._lock = threading.Lock()
+
+    def record(self, route: dict, observed_at: datetime = None) -> int:
+        rows = route_observations(route, observed_at or datetime.utcnow())
+        if rows is None:
+            return 0
+        n = len(rows["cell"])
+        with self._lock:
+            self._buffer.append(rows)
+            self._rows += n
+            if self._since is None:
+                self._since = time.monotonic()
+            full = self._rows >= self.flush_rows
+        if full or self._due():
+            self.flush()
+        return n
+
+    def _due(self) -> bool:
+        since = self._since
+        return self.flush_s is not None and since is not None and time.monotonic() - since >= self.flush_s
+
+    def flush_due(self) -> list:
+        """flush() when the oldest buffered row is flush_s old; for long-running sessions with idle spells."""
+        return self.flush() if self._due() else []
+
+    def flush(self) -> list:
+        with self._lock:
+            buffer, self._buffer, self._rows, self._since = self._buffer, [], 0, None
+        if not buffer:
+            return []
+        cols = {name: np.concatenate([rows[name] for rows in buffer]) for name in OBSERVATION_COLUMNS}
+        day = cols["observed_at"].astype("datetime64[D]")
+        written_ms = int(time.time() * 1000)
+        paths = []
+        for d in np.unique(day):
+            sel = day == d
+            path = os.path.join(self.root, f"date={d}", f"part-{written_ms}-{uuid.uuid4().hex[:8]}.parquet")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            table = pa.table({**{name: col[sel] for name, col in cols.items()},
+                              "written_at": np.full(int(sel.sum()), np.datetime64(written_ms, "ms"))},
+                             schema=ARCHIVE_SCHEMA)
+            pq.write_table(table, path, compression="zstd")
+            paths.append(path)
+        return paths
+
+    def days(self) -> list:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d.split("=", 1)[1] for d in os.listdir(self.root) if d.startswith("date="))
+
+    def files(self, since=None) -> list:
+        """Parquet files of every day; with since, only those written after it (by the epoch ms in their name)."""
+        since_ms = pd.Timestamp(since).value // 1_000_000 if since is not None else None
+        out = []
+        for day in self.days():
+            folder = os.path.join(self.root, f"date={day}")
+            out += [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+                    if f.endswith(".parquet") and (since_ms is None or _written_ms(f) > since_ms)]
+        return out
+
+    def read(self, since=None) -> pd.DataFrame:
+        """
+        Rows written (flushed) strictly after since, all rows when None. Late flushes of old observations
+        are included; only the files written after since are scanned, whatever day they belong to.
+        """
+        files = self.files(since)
+        if not files:
+            return ARCHIVE_SCHEMA.empty_table().to_pandas()
+        dataset = ds.dataset(files, schema=ARCHIVE_SCHEMA, format="parquet")
+        flt = ds.field("written_at") > pa.scalar(pd.Timestamp(since), pa.timestamp("ms")) if since is not None else None
+        return dataset.to_table(filter=flt).to_pandas()
+
+    def compact(self, day: str) -> bool:
+        folder = os.path.join(self.root, f"date={day}")
+        files = sorted(f for f in os.listdir(folder) if f.endswith(".parquet"))
+        if len(files) < 2:
+            return False
+        table = ds.dataset([os.path.join(folder, f) for f in files], schema=ARCHIVE_SCHEMA, format="parquet").to_table()
+        # rows keep their written_at; the file is named after the newest one, so read(since) still finds it
+        written_ms = max(_written_ms(f) for f in files)
+        pq.write_table(table.sort_by([("cell", "ascending"), ("observed_at", "ascending")]),
+                       os.path.join(folder, f"part-{written_ms}-compacted-{uuid.uuid4().hex[:8]}.parquet"),
+                       compression="zstd")
+        for f in files:
+            os.remove(os.path.join(folder, f))
+        return True
+
+
+def _written_ms(file_name: str) -> int:
+    """Flush time (epoch ms) in an archive file name; 0 for names without one."""
+    head = file_name.split("-")[1] if file_name.count("-") >= 2 else ""
+    return int(head) if head.isdigit() and len(head) >= 12 else 0
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Congestion forecaster
+# ----------------------------------------------------
+# - per (cell, hour of week): length-weighted running moments of the congestion value,
+#   exponentially decayed so that recent weeks count more (half life forecaster_half_life_days)
+# - partial_fit() only folds in the archive rows written after its watermark (ingestion time); the moments are
+#   decayed to as_of, the newest observed_at folded in, and late rows are decayed from their own observed_at
+# - forecast() pools the neighbouring hours, predicts the route score from the cells it crosses
+#   and a confidence from coverage and predictive spread
+# ====================================================
+
+MIN_OBSERVATIONS = 3.0              # decayed observations a cell needs to count as known
+VARIANCE_FLOOR = 0.01               # prior variance, few identical readings are not certainty
+STD_SCALE = 0.5                     # route score std at which confidence reaches 0 (0.8 <-> std 0.1)
+HOUR_POOL = np.array([0.5, 1.0, 0.5])
+
+
+def _advance_watermark(watermark, obs: pd.DataFrame):
+    """Newest written_at folded in; rows of files written before written_at existed do not move it."""
+    written = obs["written_at"].max() if "written_at" in obs else pd.NaT
+    if pd.isna(written):
+        return watermark
+    return max(written, watermark) if watermark is not None else written
+
+
+class CongestionForecaster:
+
+    def __init__(self, stats: pd.DataFrame = None, watermark=None, half_life_days: float = forecaster_half_life_days,
+                 as_of=None):
+        """
+        stats:     moments w (meters), s (meters x value), q (meters x value^2), n (observations),
+                   indexed by (cell, hour_of_week)
+        watermark: written_at of the newest archive row folded in, for TrafficArchive.read(since=watermark)
+        as_of:     observed_at the moments are decayed to (defaults to watermark, as in states saved before as_of)
+        """
+        if stats is None:
+            index = pd.MultiIndex.from_arrays([np.array([], np.int64), np.array([], np.int16)],
+                                              names=["cell", "hour_of_week"])
+            stats = pd.DataFrame({c: np.array([], float) for c in "wsqn"}, index=index)
+        self.stats = stats
+        self.watermark = pd.Timestamp(watermark) if watermark is not None else None
+        self.as_of = pd.Timestamp(as_of) if as_of is not None else self.watermark
+        self.half_life_days = half_life_days
+
+    # ---------- training ----------
+    def partial_fit(self, obs: pd.DataFrame):
+        if obs.empty:
+            return self
+        newest = obs["observed_at"].max()
+        if self.as_of is not None:
+            if newest > self.as_of:
+                self.stats = self.stats * self._decay((newest - self.as_of).total_seconds())
+            newest = max(newest, self.as_of)
+        k = self._decay((newest - obs["observed_at"]).dt.total_seconds().to_numpy())
+        x = CONGESTION_VALUES[obs["category"].to_numpy()]
+        w = obs["length_m"].to_numpy(dtype=float) * k
+        # one observation per route and cell, split over the categories the route saw there
+        rows_per_visit = obs.groupby(["route_id", "cell"])["cell"].transform("size").to_numpy()
+        batch = (pd.DataFrame({"cell": obs["cell"].to_numpy(), "hour_of_week": obs["hour_of_week"].to_numpy(),
+                               "w": w, "s": w * x, "q": w * x * x, "n": k / rows_per_visit})
+                 .groupby(["cell", "hour_of_week"]).sum())
+        self.stats = self.stats.add(batch, fill_value=0.0)
+        self.as_of = newest
+        self.watermark = _advance_watermark(self.watermark, obs)
+        return self
+
+    def _decay(self, age_s):
+        return 0.5 ** (np.asarray(age_s, dtype=float) / 86400.0 / self.half_life_days)
+
+    # ---------- persistence ----------
+    def save(self, path: str = FORECASTER_STATE_PATH):
+        table = pa.Table.from_pandas(self.stats.reset_index(), preserve_index=False)
+        table = table.replace_schema_metadata({
+            "watermark": self.watermark.isoformat() if self.watermark is not None else "",
+            "as_of": self.as_of.isoformat() if self.as_of is not None else "",
+            "half_life_days": str(self.half_life_days),
+        })
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str = FORECASTER_STATE_PATH, cells=None):
+        """Empty forecaster when there is no state yet; cells restricts loading to the cells of a route."""
+        if not os.path.exists(path):
+            return cls()
+        meta = pq.read_schema(path).metadata or {}
+        filters = [("cell", "in", [int(c) for c in np.unique(cells)])] if cells is not None else None
+        stats = pq.read_table(path, filters=filters).to_pandas().set_index(["cell", "hour_of_week"])
+        return cls(stats, meta.get(b"watermark", b"").decode() or None,
+                   float(meta.get(b"half_life_days", forecaster_half_life_days)),
+                   meta.get(b"as_of", b"").decode() or None)
+
+    # ---------- prediction ----------
+    def _pooled_moments(self, cells: np.ndarray, how: int) -> np.ndarray:
+        """(w, s, q, n) per cell over how-1, how, how+1 weighted by HOUR_POOL."""
+        hours = [(how - 1) % HOURS_PER_WEEK, how, (how + 1) % HOURS_PER_WEEK]
+        index = pd.MultiIndex.from_product([cells, hours], names=["cell", "hour_of_week"])
+        m = self.stats.reindex(index, fill_value=0.0)[list("wsqn")].to_numpy().reshape(len(cells), 3, 4)
+        return (m * HOUR_POOL[None, :, None]).sum(axis=1)
+
+    def forecast(self, coordinates, when: datetime) -> dict:
+        """
+        Congestion of a route at time when (UTC).
+        - congestion_mean: length-weighted mean of the congestion value over the known cells (None when no cell
+          is known); not get_route's congestion_score, which forecast_route() derives from the forecast intervals
+        - coverage: share of the route length in known cells
+        - score_std: predictive std of the route score, cells treated as independent
+        - confidence: coverage x (1 - score_std / STD_SCALE)
+        - segment_congestion: expected value per polyline segment, NaN in unknown cells
+        """
+        length, seg_cells = _segment_cells(coordinates)
+        cells = np.unique(seg_cells)
+        w, s, q, n = self._pooled_moments(cells, hour_of_week(when)).T
+        mean = np.divide(s, w, out=np.zeros_like(s), where=w > 0)
+        var = np.maximum(np.divide(q, w, out=np.zeros_like(q), where=w > 0) - mean ** 2, 0.0)
+        # predictive variance of the cell value: spread of the readings + uncertainty of their mean
+        pred_var = var + (var + VARIANCE_FLOOR) / np.maximum(n, 1e-9)
+        known = n >= MIN_OBSERVATIONS
+
+        pos = np.searchsorted(cells, seg_cells)
+        cell_len = np.bincount(pos, weights=length, minlength=len(cells)) * known
+        total, covered = length.sum(), cell_len.sum()
+        if covered > 0:
+            share = cell_len / covered
+            score = float((share * mean).sum())
+            score_std = float(np.sqrt((share ** 2 * pred_var).sum()))
+        else:
+            score, score_std = None, None
+        coverage = float(covered / total) if total > 0 else 0.0
+        confidence = coverage * max(0.0, 1.0 - score_std / STD_SCALE) if score_std is not None else 0.0
+        return {
+            "congestion_mean": score,
+            "score_std": score_std,
+            "coverage": round(coverage, 3),
+            "confidence": round(confidence, 3),
+            "segment_congestion": np.where(known[pos], mean[pos], np.nan),
+        }
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Forecast instead of a live traffic-aware call
+# ----------------------------------------------------
+# forecast_route() builds a get_route-shaped traffic-aware route from the theoretical one:
+# same geometry, speed intervals and congestion from the forecaster, ETA scaled by the
+# expected slowdown. traffic_aware_route() picks live or forecast per call.
+# ====================================================
+
+def _congestion_label(score: float) -> str:
+    """Same thresholds as get_route."""
+    return "LOW" if score < 0.3 else "MEDIUM" if score < 0.7 else "HIGH"
+
+
+def forecast_route(theoretical: dict, forecaster: CongestionForecaster, when: datetime) -> dict:
+    """Traffic-aware route forecast on the theoretical geometry; routing_mode 'FORECAST'."""
+    coords = np.asarray(theoretical["coordinates"], dtype=float)
+    f = forecaster.forecast(coords, when)
+    expected = f["segment_congestion"]
+    known = ~np.isnan(expected)
+    length, _ = _segment_geometry(coords[:, 0], coords[:, 1])
+    factor = np.where(known, np.interp(np.nan_to_num(expected), CONGESTION_VALUES, list(SPEED_FACTORS.values())), 1.0)
+    slowdown = float((length / factor).sum() / length.sum()) if length.sum() > 0 else 1.0
+
+    # speed intervals: category nearest to the expected value, run-length encoded over the segments
+    codes = np.where(known, np.digitize(np.nan_to_num(expected), [0.25, 0.75]), -1)
+    change = np.flatnonzero(np.diff(codes)) + 1
+    starts, ends = np.concatenate(([0], change)), np.append(change, len(codes))
+    route_id = str(uuid.uuid4())
+    segments = [{"route_id": route_id, "start": int(a), "end": int(b), "speed_category": SPEED_CATEGORIES[c]}
+                for a, b, c in zip(starts, ends, codes[starts]) if c >= 0]
+
+    # the live feature is per interval (get_route), so the forecast scores its own intervals the same way
+    score = interval_congestion_score(segments)
+    return dict(theoretical,
+                route_id=route_id,
+                routing_mode="FORECAST",
+                eta_min=round(float(theoretical["eta_min"]) * slowdown, 2),
+                segments=segments,
+                congestion_score=score,
+                congestion_label=_congestion_label(score),
+                forecast_confidence=f["confidence"],
+                forecast_coverage=f["coverage"])
+
+
+def is_quota_error(e: Exception) -> bool:
+    text = str(e)
+    return "429" in text or "RESOURCE_EXHAUSTED" in text or "quota" in text.lower()
+
+
+def traffic_aware_route(fetch_live, theoretical: dict, forecaster: CongestionForecaster = None,
+                        mode: str = "auto", min_confidence: float = 0.8, archive: TrafficArchive = None,
+                        when: datetime = None):
+    """
+    Traffic-aware route from the live API or from the forecaster.
+    - fetch_live: callable() -> unpacked get_route response (TRAFFIC_AWARE_OPTIMAL)
+    - mode "off": always live; "auto": forecast when its confidence >= min_confidence, live otherwise,
+      and the forecast whatever its confidence when the live call fails on quota; "force": always forecast
+    - live responses are recorded in archive
+    Returns (route, source) with source "live" | "forecast" | "forecast_quota".
+    """
+    when = when or datetime.utcnow()
+    forecast = forecast_route(theoretical, forecaster, when) if forecaster is not None and mode != "off" else None
+    if forecast is not None and (mode == "force" or forecast["forecast_confidence"] >= min_confidence):
+        return forecast, "forecast"
+    try:
+        route = fetch_live()
+    except Exception as e:
+        if forecast is None or not is_quota_error(e):
+            raise
+        log.warning(f"Traffic-aware quota exhausted, using forecast (confidence={forecast['forecast_confidence']}): {e}")
+        return forecast, "forecast_quota"
+    if archive is not None:
+        try:
+            archive.record(route, when)
+        except Exception:
+            log.exception("Traffic archive record failed")
+    return route, "live"
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Incremental training (train_forecaster = True) ----------
+if train_forecaster:
+    t0 = time.perf_counter()
+    archive = TrafficArchive(traffic_history_root)
+    forecaster = CongestionForecaster.load(FORECASTER_STATE_PATH)
+    new_rows = archive.read(since=forecaster.watermark)
+    forecaster.partial_fit(new_rows).save(FORECASTER_STATE_PATH)
+    # closed days are now folded in, merge their per-call files
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    compacted = sum(archive.compact(day) for day in archive.days() if day < today)
+    log.info(f"Forecaster: {len(new_rows)} new rows, {len(forecaster.stats)} (cell, hour) keys, "
+             f"watermark={forecaster.watermark}, as_of={forecaster.as_of}, {compacted} day(s) compacted in {time.perf_counter() - t0:.1f}s")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Synthetic evaluation (benchmark_forecaster = True)
+# ----------------------------------------------------
+# Fixed corridors around Milan with weekday rush hours; each corridor is observed
+# every few hours for 4 weeks, then forecasts are scored on a 5th week.
+# ====================================================
+
+def _rush_level(how: np.ndarray, severity: float) -> np.ndarray:
+    hour, weekday = how % 24, how // 24 < 5
+    peak = np.exp(-0.5 * ((hour - 8) / 1.0) ** 2) + np.exp(-0.5 * ((hour - 18) / 1.5) ** 2)
+    return np.clip(0.05 + severity * peak * np.where(weekday, 1.0, 0.3), 0.0, 0.95)
+
+
+def _observed_route(rng, coords, level: float) -> dict:
+    # per ~10 points: NORMAL / SLOW / TRAFFIC_JAM with binomial(2, level) odds
+    bounds = np.arange(0, len(coords), 10)
+    cats = rng.choice(3, size=len(bounds), p=[(1 - level) ** 2, 2 * level * (1 - level), level ** 2])
+    ends = np.append(bounds[1:], len(coords) - 1)
+    return {"route_id": uuid.uuid4().hex, "coordinates": coords,
+            "segments": [{"start": int(a), "end": int(b), "speed_category": SPEED_CATEGORIES[c]}
+                         for a, b, c in zip(bounds, ends, cats)]}
+
+
+if benchmark_forecaster:
+    import tempfile
+
+    rng = np.random.default_rng(43)
+    corridors = [np.asarray(synthetic_route(rng, 150)[0]) for _ in range(30)]
+    severity = rng.uniform(0.2, 0.9, len(corridors))
+    start = datetime(2025, 1, 6)            # a Monday
+
+    archive = TrafficArchive(tempfile.mkdtemp(), flush_rows=10 ** 9)
+    t0 = time.perf_counter()
+    n_calls = 0
+    for c, coords in enumerate(corridors):
+        for t in np.sort(rng.uniform(0, 28 * 86400, 28 * 24)):
+            when = start + timedelta(seconds=float(t))
+            archive.record(_observed_route(rng, coords, float(_rush_level(np.array(hour_of_week(when)), severity[c]))), when)
+            n_calls += 1
+    record_ms = (time.perf_counter() - t0) * 1000 / n_calls
+    archive.flush()
+    size = sum(os.path.getsize(os.path.join(dp, f)) for dp, _, fs in os.walk(archive.root) for f in fs)
+
+    t0 = time.perf_counter()
+    forecaster = CongestionForecaster().partial_fit(archive.read())
+    fit_s = time.perf_counter() - t0
+
+    errors, score_errors, confident, latency = [], [], [], []
+    for _ in range(500):
+        c = int(rng.integers(len(corridors)))
+        when = start + timedelta(days=28, seconds=float(rng.uniform(0, 7 * 86400)))
+        truth = _observed_route(rng, corridors[c], float(_rush_level(np.array(hour_of_week(when)), severity[c])))
+        length, _ = _segment_geometry(corridors[c][:, 0], corridors[c][:, 1])
+        true_score = float((CONGESTION_VALUES[segment_categories(len(length), truth["segments"])] * length).sum() / length.sum())
+        t0 = time.perf_counter()
+        f = forecaster.forecast(corridors[c], when)
+        latency.append((time.perf_counter() - t0) * 1000)
+        errors.append(abs((f["congestion_mean"] or 0.0) - true_score))
+        forecast = forecast_route({"coordinates": corridors[c], "eta_min": 10.0}, forecaster, when)
+        score_errors.append(abs(forecast["congestion_score"] - interval_congestion_score(truth["segments"])))
+        confident.append(f["confidence"] >= 0.8)
+    errors, confident = np.array(errors), np.array(confident)
+    print({
+        "calls_archived": n_calls,
+        "record_ms_per_call": round(record_ms, 2),
+        "archive_bytes_per_call": round(size / n_calls, 1),
+        "fit_s": round(fit_s, 2),
+        "keys": len(forecaster.stats),
+        "forecast_ms_p50": round(float(np.median(latency)), 2),
+        "mae_all": round(float(errors.mean()), 3),
+        "share_confident_0_8": round(float(confident.mean()), 3),
+        "mae_confident": round(float(errors[confident].mean()), 3) if confident.any() else None,
+        "mae_interval_score": round(float(np.mean(score_errors)), 3),
+    })
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
@@ -0,0 +1,374 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "jupyter",
+# META     "jupyter_kernel_name": "python3.11"
+# META   },
+# META   "dependencies": {
+# META     "environment": {}
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Other notebooks load the generator with: %run hero_trajectory
+run_benchmark = False
+synthetic_days = 0                  # > 0 writes synthetic training telemetry to synthetic_table
+synthetic_routes_per_day = 2000
+synthetic_step_s = 5.0
+synthetic_table = "/lakehouse/default/Tables/dbo/tb_vehicles_telemetry_synthetic"
+synthetic_analysis_table = "/lakehouse/default/Tables/dbo/tb_route_analysis_synthetic"   # the matching decision rows
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+import base64
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger("hero-trajectory")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Timed trajectories from route geometry
+# ----------------------------------------------------
+# - segment lengths and bearings from the decoded polyline
+# - relative speed per segment from Google speedReadingIntervals (NORMAL / SLOW / TRAFFIC_JAM)
+# - speeds scaled so the trip lasts exactly the chosen ETA
+# - resample() interpolates the timed route at a fixed time step
+# All steps are numpy array operations over the whole route, no per-point Python loop.
+# ====================================================
+
+EARTH_RADIUS_M = 6_371_000.0
+
+# speed relative to free flow for each Google speed category
+SPEED_FACTORS = {"NORMAL": 1.0, "SLOW": 0.5, "TRAFFIC_JAM": 0.15}
+SPEED_CATEGORIES = list(SPEED_FACTORS)
+
+
+def _segment_geometry(lat, lon):
+    """Lengths (m) and initial bearings (deg) of the n-1 segments between consecutive points."""
+    p1, p2 = np.radians(lat[:-1]), np.radians(lat[1:])
+    dl = np.radians(lon[1:] - lon[:-1])
+    a = np.sin((p2 - p1) / 2.0) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2.0) ** 2
+    length = 2.0 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+    bearing = np.degrees(np.arctan2(np.sin(dl) * np.cos(p2),
+                                    np.cos(p1) * np.sin(p2) - np.sin(p1) * np.cos(p2) * np.cos(dl))) % 360.0
+    return length, bearing
+
+
+def segment_categories(n_segments: int, segments: list) -> np.ndarray:
+    """Index into SPEED_CATEGORIES per polyline segment, -1 where no interval (or an unknown category) covers it."""
+    codes = np.full(n_segments, -1, dtype=int)
+    if segments:
+        start = np.array([s["start"] for s in segments], dtype=int)
+        end = np.array([s["end"] for s in segments], dtype=int)
+        value = np.array([SPEED_CATEGORIES.index(s["speed_category"]) if s["speed_category"] in SPEED_FACTORS else -1
+                          for s in segments])
+        # paint each interval on the segment axis: segment i belongs to the interval with the last start <= i
+        order = np.argsort(start)
+        idx = np.searchsorted(start[order], np.arange(n_segments), side="right") - 1
+        covered = (idx >= 0) & (np.arange(n_segments) < end[order][np.maximum(idx, 0)])
+        codes[covered] = value[order][idx[covered]]
+    return codes
+
+
+def interval_congestion_score(segments: list) -> float:
+    """get_route's congestion_score: SLOW 0.5 / TRAFFIC_JAM 1 averaged over the speed intervals (not the meters)."""
+    slow = sum(s["speed_category"] == "SLOW" for s in segments)
+    jam = sum(s["speed_category"] == "TRAFFIC_JAM" for s in segments)
+    return round((slow * 0.5 + jam * 1.0) / (len(segments) or 1), 2)
+
+
+def speed_factors(n_segments: int, segments: list) -> np.ndarray:
+    """Relative speed per polyline segment; intervals are the get_route 'segments' ({start, end, speed_category})."""
+    codes = segment_categories(n_segments, segments)
+    return np.where(codes >= 0, np.array(list(SPEED_FACTORS.values()))[codes], 1.0)
+
+
+def route_profile(coordinates, segments, eta_min: float, noise: float = 0.1, rng=None) -> dict:
+    """
+    Timed route: arrival time at every polyline point.
+    - coordinates: list of (lat, lon); segments: get_route speed intervals (may be empty)
+    - noise: std of a smoothed multiplicative speed perturbation (0 = deterministic)
+    Returns arrays lat, lon, cum_m, t_s (n points) and speed_kmh, heading_deg (n-1 segments).
+    """
+    pts = np.asarray(coordinates, dtype=float)
+    lat, lon = pts[:, 0], pts[:, 1]
+    length, heading = _segment_geometry(lat, lon)
+    rel_speed = speed_factors(len(length), segments)
+    if noise and len(length) > 1:
+        rng = rng or np.random.default_rng()
+        wobble = np.convolve(rng.normal(0.0, noise, len(length)), np.ones(5) / 5.0, mode="same")
+        rel_speed = rel_speed * np.exp(wobble)
+    # time per segment at unit free-flow speed, then scale to the ETA
+    unit_time = length / np.maximum(rel_speed, 1e-3)
+    total = unit_time.sum()
+    seg_time = unit_time * (float(eta_min) * 60.0 / total) if total > 0 else np.zeros_like(unit_time)
+    return {
+        "lat": lat,
+        "lon": lon,
+        "cum_m": np.concatenate(([0.0], np.cumsum(length))),
+        "t_s": np.concatenate(([0.0], np.cumsum(seg_time))),
+        "speed_kmh": np.divide(length, seg_time, out=np.zeros_like(length), where=seg_time > 0) * 3.6,
+        "heading_deg": heading,
+    }
+
+
+def resample(profile: dict, step_s: float = 5.0) -> dict:
+    """
+    Positions every step_s seconds along the timed route (plus the arrival fix).
+    Returns arrays t_s, lat, lon, along_m, speed_kmh, heading_deg, progress_pct, route_index.
+    """
+    t_pts, cum_m = profile["t_s"], profile["cum_m"]
+    t = np.append(np.arange(0.0, t_pts[-1], step_s), t_pts[-1])
+    seg = np.clip(np.searchsorted(t_pts, t, side="right") - 1, 0, len(t_pts) - 2)
+    seg_dt = t_pts[seg + 1] - t_pts[seg]
+    f = np.divide(t - t_pts[seg], seg_dt, out=np.zeros_like(t), where=seg_dt > 0)
+    lat, lon = profile["lat"], profile["lon"]
+    along = cum_m[seg] + f * (cum_m[seg + 1] - cum_m[seg])
+    speed = profile["speed_kmh"][seg].copy()
+    speed[-1] = 0.0
+    return {
+        "t_s": t,
+        "lat": lat[seg] + f * (lat[seg + 1] - lat[seg]),
+        "lon": lon[seg] + f * (lon[seg + 1] - lon[seg]),
+        "along_m": along,
+        "speed_kmh": speed,
+        "heading_deg": profile["heading_deg"][seg],
+        "progress_pct": np.rint(100.0 * along / cum_m[-1]).astype(int) if cum_m[-1] > 0 else np.zeros(len(t), int),
+        "route_index": seg,
+    }
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# get_route payloads
+# ----------------------------------------------------
+# response_format="polyline" returns only the encoded polyline,
+# "packed" returns base64 float32 coordinates and int16/int32 segment triplets.
+# unpack_route() turns any of the three formats into numpy coordinates + segments.
+# ====================================================
+
+def decode_polyline(encoded: str) -> np.ndarray:
+    """Google encoded polyline -> (n, 2) float64 array of lat, lon (vectorized over the 5-bit chunks)."""
+    b = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if b.size == 0:
+        return np.empty((0, 2))
+    # a value ends at every chunk without the continuation bit
+    starts = np.concatenate(([0], np.flatnonzero(b < 0x20)[:-1] + 1))
+    shift = 5 * (np.arange(b.size) - np.repeat(starts, np.diff(np.append(starts, b.size))))
+    acc = np.add.reduceat((b & 0x1F) << shift, starts)
+    deltas = np.where(acc & 1, ~(acc >> 1), acc >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 1e5
+
+
+def unpack_route(route: dict) -> dict:
+    """
+    Adds 'coordinates' ((n, 2) float64 array) and 'segments' (list of {start, end, speed_category})
+    to a get_route response of any response_format; full responses are returned unchanged.
+    """
+    if "coordinates" in route:
+        return route
+    out = dict(route)
+    if "coordinates_f32" in route:
+        coords = np.frombuffer(base64.b64decode(route["coordinates_f32"]), dtype="<f4").reshape(-1, 2)
+        out["coordinates"] = coords.astype(np.float64)
+        dtype = "<i2" if route.get("segments_dtype", "int16") == "int16" else "<i4"
+        triplets = np.frombuffer(base64.b64decode(route["segments_packed"]), dtype=dtype).reshape(-1, 3)
+        names = route["speed_categories"]
+        out["segments"] = [{"start": int(a), "end": int(b), "speed_category": names[c]} for a, b, c in triplets]
+        for key in ("coordinates_f32", "segments_packed", "segments_dtype", "speed_categories"):
+            out.pop(key, None)
+    else:
+        out["coordinates"] = decode_polyline(route["polyline"])
+        out["segments"] = []
+    return out
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ====================================================
+# Synthetic training telemetry
+# ----------------------------------------------------
+# Routes are smooth random walks around Milan with ~40 m between points;
+# congestion is a Markov chain over the speed categories, and the ETA follows
+# from distance, free-flow speed and congestion, like a Google route would.
+# ====================================================
+
+_CATEGORIES = np.array(["NORMAL", "SLOW", "TRAFFIC_JAM"])
+_TRANSITIONS = np.array([[0.90, 0.08, 0.02],
+                         [0.25, 0.65, 0.10],
+                         [0.10, 0.30, 0.60]])
+
+
+def synthetic_route(rng, n_points: int, spacing_m: float = 40.0):
+    """Random-walk polyline and its speed intervals, in the get_route shapes."""
+    heading = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0.0, 0.25, n_points - 1))
+    lat0, lon0 = 45.40 + rng.uniform(0, 0.15), 9.05 + rng.uniform(0, 0.25)
+    lat = lat0 + np.concatenate(([0.0], np.cumsum(spacing_m * np.cos(heading) / 111_320.0)))
+    lon = lon0 + np.concatenate(([0.0], np.cumsum(spacing_m * np.sin(heading) / (111_320.0 * np.cos(np.radians(lat0))))))
+
+    # one speed reading every ~10 points
+    n_int = max(1, (n_points - 1) // 10)
+    state = np.empty(n_int, dtype=int)
+    state[0] = rng.choice(3, p=[0.7, 0.2, 0.1])
+    u = rng.random(n_int)
+    for k in range(1, n_int):          # n_int is small (tens), the chain itself is sequential
+        state[k] = np.searchsorted(np.cumsum(_TRANSITIONS[state[k - 1]]), u[k])
+    bounds = np.linspace(0, n_points - 1, n_int + 1).astype(int)
+    segments = [{"start": int(s), "end": int(e), "speed_category": str(_CATEGORIES[c])}
+                for s, e, c in zip(bounds[:-1], bounds[1:], state)]
+    return list(zip(lat, lon)), segments
+
+
+SIREN_SPEEDUP = 1.25                # siren driving vs the free-flow (traffic-unaware) ETA
+SIREN_TRAFFIC_SHARE = 0.15          # share of the traffic delay a siren vehicle still pays
+
+
+def synthesize_fleet(n_routes: int, start: datetime, days: int, step_s: float = 5.0, seed: int = 41,
+                     prefix: str = "syn", mission_base: int = 0):
+    """
+    n_routes missions spread over days, as two frames joined on route_id:
+    - telemetry rows (tb_vehicles_telemetry_silver columns), one fix every step_s with the index of the
+      route point it is on as sequence (the arrival fix is the last point), as the live telemetry
+    - one decision row per mission (tb_route_analysis_silver columns): free-flow ETA as theoretical,
+      traffic ETA as Google's, the driven route is the Google one; traffic_source "synthetic"
+    """
+    rng = np.random.default_rng(seed)
+    free_flow_kmh = 45.0
+    starts = np.sort(rng.uniform(0, days * 86400.0, n_routes))
+    frames, decisions = [], []
+    for r in range(n_routes):
+        coords, segments = synthetic_route(rng, int(rng.integers(60, 300)))
+        factors = speed_factors(len(coords) - 1, segments)
+        length, _ = _segment_geometry(*np.asarray(coords).T)
+        eta_theoretical = length.sum() / (free_flow_kmh / 3.6) / 60.0
+        eta_google = (length / (free_flow_kmh / 3.6 * factors)).sum() / 60.0
+        eta_driven = eta_theoretical / SIREN_SPEEDUP + SIREN_TRAFFIC_SHARE * (eta_google - eta_theoretical)
+        traj = resample(route_profile(coords, segments, eta_driven, rng=rng), step_s)
+        n = len(traj["t_s"])
+        route_id = f"{prefix}-{r}"
+        ts = pd.Timestamp(start) + pd.to_timedelta(starts[r] + traj["t_s"], unit="s")
+        frames.append(pd.DataFrame({
+            "route_id": route_id,
+            "vehicle_id": f"AMB-{r % 60}",
+            "latitude": traj["lat"],
+            "longitude": traj["lon"],
+            "sequence": np.where(np.arange(n) == n - 1, len(coords) - 1, traj["route_index"]).astype(np.int32),
+            "timestamp": ts,
+            "progress_pct": traj["progress_pct"].astype(np.int32),
+            "speed_kmh": traj["speed_kmh"].round(1),
+            "status": np.where(np.arange(n) == n - 1, "arrived", "en_route"),
+            "processed_timestamp": ts,
+        }))
+        congestion = interval_congestion_score(segments)        # as get_route, per interval, same thresholds
+        decisions.append({
+            "mission_id": mission_base + r,
+            "route_id": route_id,
+            "vehicle_id": f"AMB-{r % 60}",
+            "timestamp": ts[0],
+            "eta_google_aware_min": round(eta_google, 2),
+            "eta_theoretical_min": round(eta_theoretical, 2),
+            "eta_hero_min": round(eta_google, 2),
+            "time_saved_vs_google_min": 0.0,
+            "distance_m_theoretical": int(length.sum()),
+            "distance_m_google": int(length.sum()),
+            "decision": "google",
+            "congestion_score": congestion,
+            "congestion_label": "LOW" if congestion < 0.3 else "MEDIUM" if congestion < 0.7 else "HIGH",
+            "traffic_source": "synthetic",
+            "forecast_confidence": np.nan,
+            "processed_timestamp": ts[0],
+        })
+    return pd.concat(frames, ignore_index=True), pd.DataFrame(decisions)
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }
+
+# CELL ********************
+
+# ---------- Synthetic history (synthetic_days > 0) ----------
+if synthetic_days > 0:
+    from deltalake import write_deltalake
+
+    t0 = time.perf_counter()
+    start = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=synthetic_days)
+    for day in range(synthetic_days):
+        # negative mission ids keep synthetic missions apart from the dispatch ids
+        df, analysis = synthesize_fleet(synthetic_routes_per_day, start + timedelta(days=day), 1, synthetic_step_s,
+                                        seed=day, prefix=f"syn-d{day}",
+                                        mission_base=-(day + 1) * synthetic_routes_per_day)
+        mode = "overwrite" if day == 0 else "append"
+        write_deltalake(synthetic_table, df, mode=mode)
+        write_deltalake(synthetic_analysis_table, analysis, mode=mode)
+    log.info(f"{synthetic_days} days x {synthetic_routes_per_day} routes written to {synthetic_table} "
+             f"and {synthetic_analysis_table} in {time.perf_counter() - t0:.1f}s")
+
+# ---------- Benchmark ----------
+if run_benchmark:
+    rng = np.random.default_rng(7)
+    coords, segments = synthetic_route(rng, 250)
+    n_bench = 1000
+    t0 = time.perf_counter()
+    for _ in range(n_bench):
+        resample(route_profile(coords, segments, 12.0, rng=rng), 5.0)
+    per_route_ms = (time.perf_counter() - t0) * 1000 / n_bench
+    t0 = time.perf_counter()
+    df, _ = synthesize_fleet(2000, datetime(2025, 1, 1), 1)
+    day_s = time.perf_counter() - t0
+    # consistency: distance covered between fixes matches the reported speed
+    traj = resample(route_profile(coords, segments, 12.0, noise=0.0), 1.0)
+    implied = np.diff(traj["along_m"])[:-1] / np.diff(traj["t_s"])[:-1] * 3.6
+    print({
+        "route_250_points_ms": round(per_route_ms, 3),
+        "one_day_2000_routes_s": round(day_s, 2),
+        "rows_per_day": len(df),
+        "est_90_days_min": round(day_s * 90 / 60, 1),
+        "speed_mismatch_kmh_p95": round(float(np.percentile(np.abs(implied - traj["speed_kmh"][:-2]), 95)), 2),
+    })
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "jupyter_python"
+# META }